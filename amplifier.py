@@ -12,7 +12,9 @@ from __future__ import (division, print_function, absolute_import,
                         unicode_literals)
 
 from distutils.dir_util import mkpath
-from utils import biweight_location, biweight_filter
+from utils import biweight_location, biweight_filter, biweight_bin
+from utils import biweight_filter_rows
+from utils import LRUCache
 from astropy.io import fits
 import os.path as op
 import numpy as np
@@ -23,10 +25,69 @@ import glob
 import time
 import cPickle as pickle
 from fiber_utils import get_trace_from_image, fit_fibermodel_nonparametric
-from fiber_utils import get_norm_nonparametric_fast, check_fiber_trace
+from fiber_utils import check_fiber_trace, ProfileOperator
 from fiber_utils import calculate_wavelength_chi2, get_model_image
 from fiber_utils import check_fiber_profile, check_wavelength_fit
-from fiber import Fiber
+from fiber import Fiber, FiberSet
+from cal_store import CAL_PROPS, get_cal_store_name, write_cal_store
+from cal_store import read_cal_store, get_factor_store_name
+from cal_store import write_factor_store, read_factor_store
+from master_frames import read_master_frame
+from stage_cache import StageCache, STAGE_CACHE_SIZE, get_file_digest
+from stage_cache import get_value_digest
+
+# Calibration properties already loaded in this process, shared by all
+# amplifiers.  See Amplifier.get_cal_values.
+cal_cache = LRUCache()
+
+# Master bias, dark and pixel flat frames already mapped in this process,
+# shared by all amplifiers.  See Amplifier.get_master_image.
+master_cache = LRUCache()
+
+# Marks a calibration property that could not be converted for a fiber
+CAL_MISSING = object()
+
+# Outputs of the reduction stages kept in the stage cache: the amplifier
+# attributes and the fiber properties each stage sets for later stages.
+STAGE_OUTPUTS = {'prepare': (['image', 'error', 'overscan_value'], []),
+                 'trace': (['shift', 'net_trace_shift'], ['trace']),
+                 'extract': ([], ['spectrum']),
+                 'fiber_to_fiber': (['averagespec'], ['fiber_to_fiber']),
+                 'sky': (['skypath', 'masterwave', 'mastersky', 
+                          'mastersmooth', 'skyframe', 'cont_frame', 
+                          'model'], ['sky_spectrum', 'continuum']),
+                 'cosmics': (['mask'], []),
+                 'reextract': ([], ['spectrum'])}
+
+# Frames a stage sets that are not kept in the stage cache but computed 
+# again on loading, as the stage computes them: the first attribute minus
+# the others, or None if any of them is None.
+STAGE_DERIVED = {'sky': [('clean_image', ['image', 'skyframe']),
+                         ('continuum_sub', ['image', 'skyframe', 
+                                            'cont_frame']),
+                         ('residual', ['image', 'model'])]}
+
+# Amplifier parameters that are inputs of each stage.  The files a stage
+# reads are added in Amplifier.get_stage_inputs.
+STAGE_PARAMS = {'prepare': ['bias_mult', 'dark_mult', 'use_pixelflat', 
+                            'dtype'],
+                'calibration': ['use_factors'],
+                'trace': ['calculate_shift', 'use_trace_ref', 'fiber_date', 
+                          'col_frac', 'trace_poly_order', 'fdist', 
+                          'fdist_ref', 'check_trace', 'virusconfig'],
+                'extract': ['mask_source'],
+                'fiber_to_fiber': ['filt_size_ind', 'filt_size_agg', 
+                                   'filt_size_final', 'binned_master'],
+                'sky': ['filt_size_ind', 'filt_size_sky', 'binned_master', 
+                        'make_skyframe', 'do_cont_sub', 'cont_smooth', 
+                        'make_residual'],
+                'cosmics': [],
+                'reextract': []}
+
+# Source files of the code the stages run.  Their digest is part of the key
+# of the raw frame, so any change to the code makes new keys for all stages.
+STAGE_SOURCES = ['amplifier.py', 'fiber.py', 'fiber_utils.py', 'utils.py', 
+                 'cosmics.py', 'cal_store.py', 'master_frames.py']
 import cosmics
 from datetime import datetime
 
@@ -48,7 +109,9 @@ class Amplifier:
                  filt_size_agg=51, filt_size_final=51, filt_size_sky=51,
                  col_frac = 0.47, use_trace_ref=False, fiber_date=None,
                  cont_smooth=25, make_residual=True, do_cont_sub=True,
-                 make_skyframe=True, wave_res=1.9):
+                 make_skyframe=True, wave_res=1.9, fibmodel_nproc=1,
+                 use_factors=False, binned_master=False, float32=False,
+                 stage_cache=None, stage_cache_size=STAGE_CACHE_SIZE):
         ''' 
         Initialize class
         ----------------
@@ -141,6 +204,30 @@ class Amplifier:
             Total number of fibers used to constrain the profile at one time.
         :param col_group:
             Total number of columns used to constrain the profile at one time.
+        :param fibmodel_nproc:
+            Number of processes used to fit the fibermodel.  If larger than
+            1, the fibers are fit in parallel in a process pool; each
+            fiber then starts from the initial profile instead of the
+            previous fiber's solution, so the profiles differ slightly
+            from the serial fit.  Keep 1 for reproducible results.
+        :param use_factors:
+            If True, twighlight frames save the Cholesky factors of the 
+            extraction in each column along with the fibers, and other 
+            frames use the factors in calpath when they match the current 
+            trace and fibermodel.
+        :param binned_master:
+            If True, the master spectra for the fiber to fiber and the sky 
+            are biweight averages in wavelength bins (see 
+            get_master_spectrum) instead of a running biweight over all
+            samples sorted in wavelength.
+        :param float32:
+            If True, the image and error frames are kept in single precision
+            instead of double precision, which halves their memory.
+        :param stage_cache:
+            Directory of the stage cache (see stage_cache.py), or None to
+            run every stage.  See load_stage and save_stage.
+        :param stage_cache_size:
+            Size limit of the stage cache in bytes, None for no limit
         :param mask:
             Used for masking pixels and avoids them in the spectral extraction.
         :param wave_nbins:
@@ -261,9 +348,25 @@ class Amplifier:
         self.power = power
         self.fiber_group = fiber_group
         self.col_group = col_group
+        self.fibmodel_nproc = fibmodel_nproc
+        self.use_factors = use_factors
+        self.binned_master = binned_master
+        self.dtype = np.float32 if float32 else float
+        if stage_cache is None:
+            self.stage_cache = None
+        else:
+            self.stage_cache = StageCache(stage_cache, stage_cache_size)
+        self.stage_key = None
+        self.pending_stage = None
         
         # Masking options (Fiberextract related)
         self.mask = mask
+        # What the mask was made from, for the stage cache: a digest of the
+        # mask given here, or the stage that made it (see clean_cosmics)
+        if self.stage_cache is not None and mask is not None:
+            self.mask_source = get_value_digest(np.asarray(mask))
+        else:
+            self.mask_source = None
         
         # Wavelength Solution options
         self.wave_nbins = wave_nbins
@@ -289,7 +392,7 @@ class Amplifier:
         self.make_skyframe = make_skyframe
         
         # Initialized variables
-        self.N, self.D = F[0].data.shape
+        self.N, self.D = F[0].header['NAXIS2'], F[0].header['NAXIS1']
         if self.D == 1064:
             self.D -= 32
         if self.D == 2128:
@@ -298,6 +401,7 @@ class Amplifier:
             self.N -= 50
             self.D -= 45
         self.trimmed = False
+        self.oriented = False
         self.overscan_value = None
         self.gain = F[0].header['GAIN']
         self.rdnoise = F[0].header['RDNOISE']
@@ -308,6 +412,9 @@ class Amplifier:
         bias = re.split('[\[ \] \: \,]', F[0].header['BIASSEC'])[1:-1]
         self.biassec = [int(t)-((i+1)%2) for i,t in enumerate(bias)]        
         self.fibers = []
+        self.profile_operator = None
+        self.fiberset = None
+        self.extraction_state = None
         self.type = F[0].header['IMAGETYP'].replace(' ', '')
         self.specid = '%03d' %F[0].header['SPECID']
         self.ifuid = F[0].header['IFUID'].replace(' ', '')
@@ -315,14 +422,29 @@ class Amplifier:
         datetemp = re.split('-',F[0].header['DATE-OBS'])
         self.date = datetime(int(datetemp[0]), int(datetemp[1]), 
                              int(datetemp[2]))
-        self.image = np.array(F[0].data, dtype=float)
         self.image_prepped = False
+        self.exptime = F[0].header['EXPTIME']
+        if self.stage_cache is None:
+            self.load_image(F[0].data)
+        else:
+            # Not read unless the prepared image is missing from the cache
+            self.image = None
+            self.error = None
+            
+            
+    def load_image(self, data=None):
+        '''
+        Set the image to the raw frame, read from self.filename unless
+        "data" is given, and the error to the read noise in ADU.
+        '''
+        if data is None:
+            data = fits.getdata(self.filename)
+        self.image = np.array(data, dtype=self.dtype)
+        self.error = np.empty((self.N, self.D), dtype=self.dtype)
         if self.gain>0:
-            self.error = self.rdnoise / self.gain * np.ones((self.N,self.D), 
-                                                            dtype=float)
+            self.error.fill(self.rdnoise / self.gain)
         else:
-            self.error = np.zeros((self.N, self.D), dtype=float)
-        self.exptime = F[0].header['EXPTIME']
+            self.error.fill(0.)
    
     def save(self):
         '''
@@ -337,27 +459,55 @@ class Amplifier:
         with open(fn, 'wb') as f:
            pickle.dump(self, f)
            
+           
+    def __getstate__(self):
+        '''
+        Pickle the amplifier without the caches derived from the fibers and
+        the stage cache: the ProfileOperator (and the extraction state that
+        refers to it) and the FiberSet are rebuilt when they are next asked
+        for, see get_profile_operator and get_fiberset.
+        '''
+        state = self.__dict__.copy()
+        for name in ['profile_operator', 'extraction_state', 'fiberset', 
+                     'stage_cache', 'stage_key', 'pending_stage']:
+            state[name] = None
+        return state
+        
 
     def load_fibers(self):
         '''
         Load fibers in self.path. Redefine the path for the fiber to self.path
         in case it was copied over. After loaded, evaluate the fibermodel as 
-        well as the wavelength solution if available.  
+        well as the wavelength solution if available.  The calibration store
+        in self.path is used if it exists; then only the properties in 
+        CAL_PROPS are loaded.  Otherwise the fiber pickles are loaded.
         '''
         if not self.fibers:
-            fn = op.join(self.path, 'fiber_*_%s_%s_%s_%s.pkl' %(self.specid, 
-                                                                self.ifuslot,
-                                                                self.ifuid,
-                                                                self.amp))
-            files = sorted(glob.glob(fn))
-            for fiber_fn in files:
-                if op.exists(fiber_fn):
-                    with open(fiber_fn, 'r') as f:
-                        self.fibers.append(pickle.load(f))
-                        self.fibers[-1].eval_fibmodel_poly()
-                        self.fibers[-1].path = self.path
-                        if self.fibers[-1].wave_polyvals is not None:
-                            self.fibers[-1].eval_wave_poly()
+            self.profile_operator = None
+            cal_fibers = read_cal_store(self.get_cal_store_name(self.path), 
+                                        CAL_PROPS)
+            if cal_fibers is not None:
+                for F1 in cal_fibers:
+                    F = Fiber(F1.D, F1.fibnum, self.path, F1.filename)
+                    for pro in CAL_PROPS:
+                        setattr(F, pro, getattr(F1, pro))
+                    self.fibers.append(F)
+            else:
+                fn = op.join(self.path, 'fiber_*_%s_%s_%s_%s.pkl' 
+                                                            %(self.specid, 
+                                                              self.ifuslot,
+                                                              self.ifuid,
+                                                              self.amp))
+                files = sorted(glob.glob(fn))
+                for fiber_fn in files:
+                    if op.exists(fiber_fn):
+                        with open(fiber_fn, 'r') as f:
+                            self.fibers.append(pickle.load(f))
+            for fiber in self.fibers:
+                fiber.eval_fibmodel_poly()
+                fiber.path = self.path
+                if fiber.wave_polyvals is not None:
+                    fiber.eval_wave_poly()
             
             self.good_fibers = [fiber for fiber in self.fibers 
                                       if not fiber.dead]
@@ -392,25 +542,41 @@ class Amplifier:
                 sys.exit()
                              
                              
-    def load_cal_property(self, prop, pathkind='calpath'):
+    def get_cal_store_name(self, path):
         '''
-        Load a specific property from a calibration object.  This can be
-        "trace" from a twighlight frame or "sky_spectrum" from another
-        science frame.  
+        Name of the calibration store for this amplifier in "path".
+        '''
+        return get_cal_store_name(path, self.specid, self.ifuslot, 
+                                  self.ifuid, self.amp)
+                                  
+                                  
+    def get_factor_store_name(self, path):
+        '''
+        Name of the extraction factors for this amplifier in "path".
+        '''
+        return get_factor_store_name(path, self.specid, self.ifuslot, 
+                                     self.ifuid, self.amp)
+                                  
+                                  
+    def get_cal_fibers(self, path, prop):
+        '''
+        Load the fibers with the properties in "prop" from "path".  The 
+        calibration store is used if it has all of "prop", otherwise the 
+        fiber pickles are loaded.
+        :param path:
+            Directory of the calibration, e.g., self.calpath
         :param prop:
-            A property to load from a set of fibers.
-        :param pathkind:
-            Used to defined the path from the larger class.  E.g., "calpath"
-            or "skypath".
+            List of properties that are needed
         '''
-        path = getattr(self, pathkind)
+        fibers = read_cal_store(self.get_cal_store_name(path), prop)
+        if fibers is not None:
+            return fibers
         fn = op.join(path,'fiber_*_%s_%s_%s_%s.pkl' %(self.specid, 
-                                                                  self.ifuslot,
-                                                                  self.ifuid,
-                                                                  self.amp))
-        if isinstance(prop, basestring):
-            prop = [prop]
+                                                      self.ifuslot,
+                                                      self.ifuid,
+                                                      self.amp))
         files = sorted(glob.glob(fn))
+        fibers = []
         for i, fiber_fn in enumerate(files):
             fcheck = op.join(path,'fiber_%03d_%s_%s_%s_%s.pkl' %(i+1, 
                                                                   self.specid, 
@@ -421,24 +587,105 @@ class Amplifier:
                 print("Mismatch in loading fiber files from cal directory.")
                 print("The %i fiber did not match %s" %(i,fiber_fn))
                 sys.exit(1)
+            with open(fiber_fn, 'r') as f:
+                fibers.append(pickle.load(f))
+        return fibers
+        
+        
+    def get_cal_mtimes(self, path):
+        '''
+        Names and modification times of the calibration files in "path",
+        used to tell if a cached calibration is out of date.
+        '''
+        fn = self.get_cal_store_name(path)
+        if op.exists(fn):
+            files = [fn]
+        else:
+            files = sorted(glob.glob(op.join(path,'fiber_*_%s_%s_%s_%s.pkl' 
+                                                            %(self.specid, 
+                                                              self.ifuslot,
+                                                              self.ifuid,
+                                                              self.amp))))
+        return tuple([(f, op.getmtime(f)) for f in files])
+        
+        
+    def get_cal_values(self, path, prop):
+        '''
+        Get the calibration properties in "prop" from "path", converted to
+        the binning of this amplifier.  Properties are kept in cal_cache, 
+        keyed on the path, amplifier, binning and calibration file times,
+        so they are only read once per process.  The returned lists are 
+        shared with the cache and should not be modified.
+        :param path:
+            Directory of the calibration, e.g., self.calpath
+        :param prop:
+            List of properties
+        :returns values:
+            Dictionary with a list of the values over fibers for each 
+            property.  A value is None if the property is None for that 
+            fiber, and CAL_MISSING if it could not be loaded.
+        '''
+        key = (path, self.specid, self.ifuslot, self.ifuid, self.amp, 
+               self.get_cal_mtimes(path), self.D)
+        values = {}
+        for pro in prop:
+            value = cal_cache.get(key + (pro,))
+            if value is not None:
+                values[pro] = value
+        missing = [pro for pro in prop if pro not in values]
+        if not missing:
+            return values
+        fibers = self.get_cal_fibers(path, missing)
+        for pro in missing:
+            values[pro] = []
+            nbytes = 0
+            for F1 in fibers:
+                if getattr(F1,pro) is None:
+                    value = None
+                else:
+                    try:
+                        value = self.convert_binning(F1,pro)
+                    except AttributeError:
+                        value = CAL_MISSING
+                values[pro].append(value)
+                nbytes += getattr(value, 'nbytes', 8)
+            cal_cache.put(key + (pro,), values[pro], nbytes)
+        return values
+        
+        
+    def load_cal_property(self, prop, pathkind='calpath'):
+        '''
+        Load a specific property from a calibration object.  This can be
+        "trace" from a twighlight frame or "sky_spectrum" from another
+        science frame.  
+        :param prop:
+            A property to load from a set of fibers.
+        :param pathkind:
+            Used to defined the path from the larger class.  E.g., "calpath"
+            or "skypath".
+        '''
+        path = getattr(self, pathkind)
+        if isinstance(prop, basestring):
+            prop = [prop]
+        self.profile_operator = None
+        values = self.get_cal_values(path, prop)
+        for i in xrange(len(values[prop[0]])):
             append_flag = False
             try:
                 F = self.fibers[i]
             except IndexError:    
                 F = Fiber(self.D, i+1, self.path, self.filename)
                 append_flag = True
-            with open(fiber_fn, 'r') as f:
-                F1 = pickle.load(f)
             for pro in prop:
-                if getattr(F1,pro) is None:
-                    setattr(F, pro, getattr(F1,pro))
+                value = values[pro][i]
+                if value is CAL_MISSING:
+                    if self.debug:
+                        print("Cannot load attribute %s for fiber %i "
+                              "from %s" %(pro, i+1, path))
+                elif isinstance(value, np.ndarray):
+                    setattr(F, pro, value.copy())
                 else:
-                    try:
-                        setattr(F, pro, self.convert_binning(F1,pro))
-                    except AttributeError:
-                        if self.debug:
-                            print("Cannot load attribute %s from %s" %(pro, 
-                                                                     fiber_fn))
+                    setattr(F, pro, value)
             if append_flag:
                 self.fibers.append(F)
     
@@ -463,23 +710,166 @@ class Amplifier:
 
     def save_fibers(self):
         '''
-        Save the fibers to self.path using the fiber class "save" function.
+        Save the fibers to self.path using the fiber class "save" function,
+        and the calibration properties of all fibers to the calibration 
+        store (see cal_store.py).  Twighlight frames also save the 
+        extraction factors if self.use_factors is True.
         '''
+        if self.use_factors and self.type == 'twi' and self.fibers:
+            operator = self.get_profile_operator()
+            write_factor_store(self.get_factor_store_name(self.path), 
+                               operator.get_checksum(), 
+                               operator.get_factors())
         for fiber in self.fibers:
             fiber.save(self.specid, self.ifuslot, self.ifuid, self.amp)
+        if self.fibers:
+            write_cal_store(self.get_cal_store_name(self.path), self.fibers)
             
       
+    def get_stage_key(self):
+        '''
+        Key of the last stage run or loaded; before the first stage, the key
+        of the raw frame.
+        '''
+        if self.stage_key is None:
+            path = op.dirname(op.abspath(__file__))
+            self.stage_key = self.stage_cache.get_key(None, 'raw', 
+                                      [('raw', get_file_digest(self.filename))]
+                                      + [(fn, get_file_digest(op.join(path, 
+                                                                      fn)))
+                                         for fn in STAGE_SOURCES])
+        return self.stage_key
+        
+        
+    def get_stage_inputs(self, stage):
+        '''
+        Inputs of "stage" for its key: the parameters in STAGE_PARAMS and 
+        the digests of the files the stage reads.
+        '''
+        inputs = [(name, getattr(self, name, None)) 
+                  for name in STAGE_PARAMS[stage]]
+        files = []
+        if stage == 'prepare':
+            for kind, used in [('bias', self.bias_mult>0.0), 
+                               ('dark', self.dark_mult>0.0),
+                               ('pixelflat', self.use_pixelflat)]:
+                if used:
+                    files.append(self.get_master_filename(kind))
+        if stage == 'calibration' and self.calpath is not None:
+            files.extend([f for f, mtime in self.get_cal_mtimes(self.calpath)])
+            if self.use_factors:
+                files.append(self.get_factor_store_name(self.calpath))
+        if stage == 'sky' and self.skypath is not None:
+            files.extend([f for f, mtime in self.get_cal_mtimes(self.skypath)])
+        inputs.extend([(op.basename(fn), get_file_digest(fn)) 
+                       for fn in files])
+        return inputs
+        
+        
+    def chain_stage(self, stage):
+        '''
+        Add the inputs of a stage that is not cached, such as loading the
+        calibration, to the keys of the stages after it.
+        '''
+        if self.stage_cache is None:
+            return
+        self.stage_key = self.stage_cache.get_key(self.get_stage_key(), stage,
+                                                  self.get_stage_inputs(stage))
+        
+        
+    def load_stage(self, stage):
+        '''
+        Load the outputs (see STAGE_OUTPUTS) of "stage" from the stage cache
+        if the stage was run before with the same inputs after the same 
+        earlier stages.  Returns True if they were loaded; otherwise the 
+        stage has to be run and save_stage(stage) called.
+        '''
+        if self.stage_cache is None:
+            return False
+        key = self.stage_cache.get_key(self.get_stage_key(), stage, 
+                                       self.get_stage_inputs(stage))
+        self.pending_stage = (stage, key)
+        values = self.stage_cache.load(key)
+        if values is None:
+            return False
+        attrs, props = STAGE_OUTPUTS[stage]
+        for name in attrs:
+            value = values.get('amp.' + name)
+            if value is not None and value.ndim == 0:
+                value = value[()]
+            setattr(self, name, value)
+        for prop in props:
+            if 'fib.' + prop in values:
+                self.get_fiberset().set(prop, values['fib.' + prop])
+        for name, terms in STAGE_DERIVED.get(stage, []):
+            frames = [getattr(self, term, None) for term in terms]
+            if any([frame is None for frame in frames]):
+                setattr(self, name, None)
+                continue
+            value = frames[0]
+            for frame in frames[1:]:
+                value = value - frame
+            setattr(self, name, value)
+        if stage == 'prepare':
+            self.trimmed = True
+            self.oriented = True
+            self.image_prepped = True
+        if stage == 'trace':
+            self.profile_operator = None
+        if stage == 'cosmics':
+            self.mask_source = 'cosmics'
+        if stage in ['extract', 'reextract']:
+            self.extraction_state = (self.get_profile_operator(), 
+                                     self.get_mask_pixels())
+        self.stage_key = key
+        return True
+        
+        
+    def save_stage(self, stage):
+        '''
+        Save the outputs of "stage", run after load_stage(stage) did not 
+        find them, to the stage cache.
+        '''
+        if self.stage_cache is None:
+            return
+        pending, key = self.pending_stage
+        if pending != stage:
+            print("Stage %s was saved after loading stage %s" %(stage, 
+                                                                 pending))
+            sys.exit(1)
+        attrs, props = STAGE_OUTPUTS[stage]
+        values = {}
+        for name in attrs:
+            value = getattr(self, name, None)
+            if value is not None:
+                values['amp.' + name] = np.asarray(value)
+        for prop in props:
+            value = self.get_fiberset().get(prop)
+            if value is not None:
+                values['fib.' + prop] = value
+        self.stage_cache.save(key, values)
+        self.stage_key = key
+        self.pending_stage = None
+        
+        
     def orient_image(self):
         '''
         Orient the images from blue to red (left to right)
         Fibers are oriented to match configuration files
         '''
-        if self.amp == "LU":
-            self.image[:] = self.image[::-1,::-1]
-            self.error[:] = self.error[::-1,::-1]
-        if self.amp == "RL":
-            self.image[:] = self.image[::-1,::-1]
-            self.error[:] = self.error[::-1,::-1]
+        if not self.oriented:
+            if self.is_flipped():
+                self.image = self.image[::-1,::-1]
+                self.error = self.error[::-1,::-1]
+            self.oriented = True
+
+
+    def is_flipped(self):
+        '''
+        True if the amplifier is read out red to blue and has to be rotated
+        by 180 degrees in orient_image.
+        '''
+        return self.amp in ["LU", "RL"]
 
             
         
@@ -489,6 +879,8 @@ class Amplifier:
         region.  Only calculate the value if one does not exist or 
         recalculate is set to True.
         '''
+        if self.image is None:
+            self.load_image()
         if self.overscan_value is None:
             self.overscan_value = biweight_location(self.image[
                                               self.biassec[2]:self.biassec[3],
@@ -506,23 +898,56 @@ class Amplifier:
             self.trimmed = True
       
       
+    def get_master_filename(self, kind):
+        '''
+        File name of the master frame of "kind" ("bias", "dark" or 
+        "pixelflat") for this amplifier.
+        '''
+        if kind == 'bias':
+            return op.join(self.biaspath, 'masterbias_%s_%s.fits' 
+                                          %(self.specid, self.amp))
+        if kind == 'dark':
+            return op.join(self.darkpath, 'masterdark_%s_%s.fits' 
+                                          %(self.specid, self.amp))
+        if kind == 'pixelflat':
+            return op.join(self.virusconfig, 'PixelFlats','20161223',
+                           'pixelflat_cam%s_%s.fits' %(self.specid, self.amp))
+        print("Unknown master frame type: %s" %kind)
+        sys.exit(1)
+        
+        
+    def get_master_image(self, kind):
+        '''
+        Master frame of "kind" (see get_master_filename) as a read-only 
+        array.  Frames are kept in master_cache, keyed on the file name and
+        modification time, and are memory mapped from a node-local copy
+        (see master_frames.read_master_frame), so each master is read once 
+        per node and shared by all amplifiers and processes.  Once the image
+        is oriented, the master is returned as a view in the same 
+        orientation.
+        '''
+        fn = self.get_master_filename(kind)
+        key = (fn, op.getmtime(fn))
+        image = master_cache.get(key)
+        if image is None:
+            image = read_master_frame(fn)
+            master_cache.put(key, image, image.nbytes)
+        if self.oriented and self.is_flipped():
+            image = image[::-1,::-1]
+        return image
+        
+        
     def subtract_dark(self):
         if self.dark_mult>0.0:
-            darkimage = np.array(fits.open(op.join(self.darkpath, 
-                                                'masterdark_%s_%s.fits' 
-                                            %(self.specid, self.amp)))[0].data, 
-                              dtype=float)
-            self.image[:] = self.image - self.dark_mult * darkimage
+            self.image -= np.multiply(self.get_master_image('dark'), 
+                                      self.dark_mult, dtype=self.dtype)
             #self.error[:] = np.sqrt(self.error**2 + self.gain*self.dark_mult*darkimage)
             
             
     def subtract_bias(self):
         if self.bias_mult>0.0:
-            biasimage = np.array(fits.open(op.join(self.biaspath, 
-                                                'masterbias_%s_%s.fits' 
-                                            %(self.specid, self.amp)))[0].data, 
-                              dtype=float)
-            self.image[:] = self.image - self.bias_mult * biasimage
+            self.image -= np.multiply(self.get_master_image('bias'), 
+                                      self.bias_mult, dtype=self.dtype)
             #self.error[:] = np.sqrt(self.error**2 + self.gain*self.bias_mult*biasimage)
             
             
@@ -532,20 +957,20 @@ class Amplifier:
         
         
     def calculate_photonnoise(self):
-        self.error[:] = np.sqrt(self.error**2 + self.image)
+        np.multiply(self.error, self.error, out=self.error)
+        self.error += self.image
+        np.sqrt(self.error, out=self.error)
         
         
     def divide_pixelflat(self):
         if self.use_pixelflat:
-            pixelflat = np.array(fits.open(op.join(self.virusconfig, 
-                                                   'PixelFlats','20161223',
-                                                   'pixelflat_cam%s_%s.fits' 
-                                            %(self.specid, self.amp)))[0].data,
-                                  dtype=float)
-            self.image[:] = np.where(pixelflat != 0, self.image / pixelflat, 
-                                     0.0)
-            self.error[:] = np.where(pixelflat != 0, self.error / pixelflat, 
-                                     0.0)
+            pixelflat = self.get_master_image('pixelflat')
+            sel = pixelflat != 0
+            np.divide(self.image, pixelflat, out=self.image, where=sel)
+            np.divide(self.error, pixelflat, out=self.error, where=sel)
+            sel = ~sel
+            self.image[sel] = 0.0
+            self.error[sel] = 0.0
              
                                      
                                      
@@ -553,17 +978,24 @@ class Amplifier:
         '''
         This many purpose function loads the image, finds the overscan value,
         subtracts the dark image and bias image, multplies the gain, 
-        and divides the pixelflat.  It also orients the image using the
+        and divides the pixelflat.  It also orients the image like the
         "orient" function above.
+        
+        The image is trimmed and oriented as views first and copied once 
+        into a contiguous array; the other steps then update the image and
+        error in place, with the master frames read as oriented views.
+        This gives the same result as orienting at the end.
         '''
         self.subtract_overscan()
         self.trim_image()
+        self.orient_image()
+        self.image = np.ascontiguousarray(self.image)
+        self.error = np.ascontiguousarray(self.error)
         self.multiply_gain()
         self.calculate_photonnoise()
         self.subtract_bias()
         self.subtract_dark()
         self.divide_pixelflat()
-        self.orient_image()
         self.image_prepped = True
         
     
@@ -573,35 +1005,20 @@ class Amplifier:
         self.calpath.  If they are the same then the shift will be 0.  
         This has not been tested yet.
         '''
-        fn = op.join(self.calpath,'fiber_*_%s_%s_%s_%s.pkl' %(self.specid, 
-                                                                  self.ifuslot,
-                                                                  self.ifuid,
-                                                                  self.amp))
-        files = sorted(glob.glob(fn))
         shift = []
-        for i, fiber_fn in enumerate(files):
-            fcheck = op.join(self.calpath,'fiber_%03d_%s_%s_%s_%s.pkl' %(i+1, 
-                                                                  self.specid, 
-                                                                  self.ifuslot,
-                                                                  self.ifuid,
-                                                                  self.amp))
-            if fcheck != fiber_fn:
-                print("Mismatch in loading fiber files from cal directory.")
-                print("The %i fiber did not match %s" %(i,fiber_fn))
-                sys.exit(1)
+        traces = self.get_cal_values(self.calpath, ['trace'])['trace']
+        for i, trace in enumerate(traces):
             try:
                 F = self.fibers[i]
             except IndexError:    
                 print("No trace measured yet, so no shift measured")
                 return None
-            with open(fiber_fn, 'r') as f:
-                F1 = pickle.load(f)
             col = 4.*self.D/5.
             width = 20
             low = int(col-width)
             high = int(col+width+1)
             shift.append(biweight_location(F.trace[low:high] 
-                              - F1.trace[low:high]))
+                              - trace[low:high]))
         self.shift = shift
         return biweight_location(np.array(shift))
 
@@ -650,6 +1067,37 @@ class Amplifier:
             
 
 
+    def get_fiberset(self):
+        '''
+        FiberSet of self.fibers for whole-array access to the fiber 
+        properties.  It is rebuilt when self.fibers has changed.
+        '''
+        if self.fiberset is None or self.fiberset.fibers != self.fibers:
+            self.fiberset = FiberSet(self.fibers)
+        return self.fiberset
+        
+        
+    def get_profile_operator(self):
+        '''
+        The ProfileOperator of the current trace and fibermodel of the 
+        fibers.  It is built on the first call and shared by the extraction 
+        and the model images until the trace or fibermodel changes.
+        '''
+        if self.profile_operator is None:
+            self.profile_operator = ProfileOperator(self.fibers, 
+                                                    self.image.shape)
+            if self.use_factors and not (self.type == 'twi' or self.refit):
+                operator = self.profile_operator
+                fn = self.get_factor_store_name(self.calpath)
+                factors = read_factor_store(fn, operator.get_checksum())
+                if factors is not None:
+                    operator.set_factors(factors)
+                elif self.debug:
+                    print("No extraction factors in %s match the trace and "
+                          "fibermodel of %s" %(self.calpath, self.basename))
+        return self.profile_operator
+
+
     def get_trace(self):
         '''
         This function gets the trace for this amplifier.  It checks functional
@@ -660,6 +1108,7 @@ class Amplifier:
           
         if not self.image_prepped:
             self.prepare_image()
+        self.profile_operator = None
         if self.type == 'twi' or self.refit:
             if self.refit:
                 mx_cut=0.1
@@ -719,30 +1168,23 @@ class Amplifier:
                                       if not fiber.dead]
             self.dead_fibers = [fiber for fiber in self.fibers 
                                       if fiber.dead]    
-            for c in cols1:
+            # Match the peaks in each column to the nearest measured trace of
+            # all good fibers at once, working outwards from brcol
+            fiberset = self.get_fiberset()
+            good = np.where(~fiberset.get('dead'))[0]
+            trace_x = fiberset.get('trace_x')
+            trace_y = fiberset.get('trace_y')
+            for c in np.hstack([cols1, cols2]):
                 loc = np.where(xc==c)[0]
-                for i,fiber in enumerate(self.good_fibers):
-                    yvals = allfibers[int(loc)]
-                    if not yvals.size:
-                        continue
-                    xloc = np.argmin(np.abs(fiber.trace_x - c))
-                    floc = np.argmin(np.abs(fiber.trace_y[xloc] 
-                                            - yvals))
-                    if (np.abs(fiber.trace_y[xloc]-yvals[floc]) < self.fdist):
-                        fiber.trace_x[c] = c
-                        fiber.trace_y[c] = yvals[floc]
-            for c in cols2:
-                loc = np.where(xc==c)[0]
-                for i,fiber in enumerate(self.good_fibers):
-                    yvals = allfibers[int(loc)]
-                    if not yvals.size:
-                        continue
-                    xloc = np.argmin(np.abs(fiber.trace_x - c))
-                    floc = np.argmin(np.abs(fiber.trace_y[xloc] 
-                                            - yvals))
-                    if (np.abs(fiber.trace_y[xloc]-yvals[floc]) < self.fdist):
-                        fiber.trace_x[c] = c
-                        fiber.trace_y[c] = yvals[floc]
+                yvals = allfibers[int(loc)]
+                if not yvals.size:
+                    continue
+                xloc = np.argmin(np.abs(trace_x[good] - c), axis=1)
+                ty = trace_y[good, xloc]
+                floc = np.argmin(np.abs(ty[:,np.newaxis] - yvals), axis=1)
+                sel = np.abs(ty - yvals[floc]) < self.fdist
+                trace_x[good[sel], c] = c
+                trace_y[good[sel], c] = yvals[floc[sel]]
             # Evaluate good fibers with trace defined everywhere measured
             for fib, fiber in enumerate(self.good_fibers):
                 if np.sum(fiber.trace_x != fiber.flag)==len(xc):
@@ -797,18 +1239,19 @@ class Amplifier:
             # TODO print trace info
             fn = op.join(self.path, self.basename + '_trace.txt')
             A = np.zeros((len(self.fibers),4))
+            trace = self.get_fiberset().get('trace')
             A[:,0] = [fiber.fibnum for fiber in self.fibers]
-            A[:,1] = [fiber.trace[int(self.D/6.)] for fiber in self.fibers]
-            A[:,2] = [fiber.trace[int(self.D/2.)] for fiber in self.fibers]
-            A[:,3] = [fiber.trace[int(5.*self.D/6.)] for fiber in self.fibers]
+            A[:,1] = trace[:,int(self.D/6.)]
+            A[:,2] = trace[:,int(self.D/2.)]
+            A[:,3] = trace[:,int(5.*self.D/6.)]
             np.savetxt(fn, A)
             if self.calculate_shift:
                 self.net_trace_shift = self.find_shift()
                 smooth_shift = biweight_filter(self.shift, 25)
                 if self.net_trace_shift is not None:
                     self.load_cal_property('trace')
-                    for i, fiber in enumerate(self.fibers):
-                        fiber.trace[:] = fiber.trace + smooth_shift[i]
+                    trace = self.get_fiberset().get('trace')
+                    trace[:] = trace + smooth_shift[:,np.newaxis]
         else:
             self.load_cal_property(['trace','dead'])
             self.good_fibers = [fiber for fiber in self.fibers 
@@ -849,6 +1292,7 @@ class Amplifier:
             self.prepare_image()
         if not self.fibers:
             self.get_trace()
+        self.profile_operator = None
         if self.type == 'twi' or self.refit:
             sol, xcol, binx = fit_fibermodel_nonparametric(self.image, 
                                                               self.good_fibers,
@@ -861,7 +1305,8 @@ class Amplifier:
                                                       bins=self.fibmodel_nbins,
                                                               fsize=self.fsize,
                                                               sigma=self.sigma,
-                                                              power=self.power)
+                                                              power=self.power,
+                                                      nproc=self.fibmodel_nproc)
             nfibs, ncols, nbins = sol.shape
             for i, fiber in enumerate(self.good_fibers):
                 fiber.fibmodel_poly_order = self.fibmodel_poly_order
@@ -880,10 +1325,9 @@ class Amplifier:
                 
         if self.check_fibermodel:
             if self.fibers[0].spectrum is None:
-                norm = get_norm_nonparametric_fast(self.image, self.fibers,
-                                                   mask=self.mask)
-                for i, fiber in enumerate(self.fibers):
-                    fiber.spectrum = norm[i,:]
+                norm = self.get_profile_operator().extract(self.image, 
+                                                           mask=self.mask)
+                self.get_fiberset().set('spectrum', norm)
             outfile = op.join(self.path,'fibmodel_%s.png' %self.basename)
             check_fiber_profile(self.image, self.fibers, outfile)
 
@@ -894,6 +1338,67 @@ class Amplifier:
         functional dependencies first: prepare_image(), get_trace(), and
         get_fibermodel(). 
 
+        '''
+        self.check_fiberextract()
+        norm = self.get_profile_operator().extract(self.image, cols=cols,
+                                                   mask=self.mask)
+        self.get_fiberset().set('spectrum', norm)
+        self.set_extraction_state(cols)
+        
+    def set_extraction_state(self, cols=None):
+        '''
+        Remember the profile operator and mask of the last extraction of 
+        all columns, for refiberextract().
+        '''
+        if cols is None:
+            self.extraction_state = (self.profile_operator, 
+                                     self.get_mask_pixels())
+        else:
+            self.extraction_state = None
+            
+    def get_mask_pixels(self):
+        '''
+        Boolean image of the masked pixels, or None without a mask.
+        '''
+        if self.mask is None:
+            return None
+        return np.asarray(self.mask) != 0
+        
+    def refiberextract(self):
+        '''
+        Extract again after the mask changed, e.g., after clean_cosmics().
+        Only the columns in which the mask differs from the last extraction
+        are solved again; the other columns keep their spectrum.  Without a 
+        previous extraction of all columns with the current trace and 
+        fibermodel, this is fiberextract().
+        '''
+        self.check_fiberextract()
+        operator = self.get_profile_operator()
+        state = self.extraction_state
+        if (state is None or state[0] is not operator 
+                or self.fibers[0].spectrum is None):
+            self.fiberextract()
+            return
+        old, new = state[1], self.get_mask_pixels()
+        if old is None and new is None:
+            return
+        if old is None:
+            changed = new.any(axis=0)
+        elif new is None:
+            changed = old.any(axis=0)
+        else:
+            changed = (old != new).any(axis=0)
+        cols = np.where(changed)[0]
+        if len(cols):
+            norm = operator.extract(self.image, mask=self.mask, cols=cols)
+            spectrum = self.get_fiberset().get('spectrum')
+            spectrum[:,cols] = norm[:,cols]
+        self.extraction_state = (operator, new)
+        
+    def check_fiberextract(self):
+        '''
+        Functional dependencies of fiberextract(): prepare_image(), 
+        get_trace(), and get_fibermodel().
         '''
         if not self.image_prepped:
             self.prepare_image()
@@ -904,12 +1409,23 @@ class Amplifier:
         else:
             for fiber in self.fibers:
                 fiber.eval_fibmodel_poly()
-        
-        norm = get_norm_nonparametric_fast(self.image, self.fibers, 
-                                           cols=cols, mask=self.mask)
-                                           
-        for i, fiber in enumerate(self.fibers):
-            fiber.spectrum = norm[i,:]    
+                
+    def has_same_profiles(self, other):
+        '''
+        True if "other" has the same image shape, trace and fibermodel, so 
+        both amplifiers can share one ProfileOperator.
+        '''
+        if (self.image.shape != other.image.shape 
+                or len(self.fibers) != len(other.fibers)):
+            return False
+        for prop in ['trace', 'binx', 'fibmodel']:
+            values = self.get_fiberset().get(prop)
+            other_values = other.get_fiberset().get(prop)
+            if values is None or other_values is None:
+                return False
+            if not np.array_equal(values, other_values):
+                return False
+        return True
     
     def get_wavelength_solution(self):
         '''
@@ -940,10 +1456,9 @@ class Amplifier:
                 fiber.eval_fibmodel_poly() 
         if self.type == 'twi' or self.refit:
             if self.fibers[0].spectrum is None:
-                norm = get_norm_nonparametric_fast(self.image, self.fibers, 
-                                                   mask=self.mask)
-                for i, fiber in enumerate(self.fibers):
-                    fiber.spectrum = norm[i,:]
+                norm = self.get_profile_operator().extract(self.image, 
+                                                           mask=self.mask)
+                self.get_fiberset().set('spectrum', norm)
             if self.init_lims is None:
                 print("Please provide initial wavelength endpoint guess")
                 sys.exit(1)
@@ -1026,10 +1541,9 @@ class Amplifier:
                 fiber.eval_wave_poly()
         if self.check_wave:
             if self.fibers[0].spectrum is None:
-                norm = get_norm_nonparametric_fast(self.image, self.fibers, 
-                                                   mask=self.mask)
-                for i, fiber in enumerate(self.fibers):
-                    fiber.spectrum = norm[i,:]
+                norm = self.get_profile_operator().extract(self.image, 
+                                                           mask=self.mask)
+                self.get_fiberset().set('spectrum', norm)
             outfile = op.join(self.path,'wavesolution_%s.png' %self.basename)
             check_wavelength_fit(self.fibers, solar_spec, outfile)
                 
@@ -1069,22 +1583,19 @@ class Amplifier:
                     fiber.eval_wave_poly()
             if self.debug:
                 print("Getting Fiber to Fiber for %s" %self.basename)
-            masterwave = []
-            masterspec = []
-            for fib, fiber in enumerate(self.good_fibers):
-                masterwave.append(fiber.wavelength)
-                masterspec.append(fiber.spectrum)
-            masterwave = np.hstack(masterwave)
-            smoothspec = np.hstack(masterspec)
-            ind = np.argsort(masterwave)
-            masterwave[:] = masterwave[ind]
-            smoothspec[:] = smoothspec[ind]
-            self.averagespec = biweight_filter(smoothspec, self.filt_size_agg)
-            for fib, fiber in enumerate(self.fibers):
-                fiber.fiber_to_fiber = biweight_filter(fiber.spectrum 
-                                      / np.interp(fiber.wavelength, masterwave, 
-                                                  self.averagespec), 
-                                                       self.filt_size_final)
+            fiberset = self.get_fiberset()
+            good = ~fiberset.get('dead')
+            wavelength = fiberset.get('wavelength')
+            spectrum = fiberset.get('spectrum')
+            masterwave, self.averagespec = self.get_master_spectrum(
+                                                         wavelength[good], 
+                                                         spectrum[good], 
+                                                         self.filt_size_agg)
+            ratio = spectrum / np.interp(wavelength, masterwave, 
+                                         self.averagespec)
+            fiberset.set('fiber_to_fiber', 
+                         [biweight_filter(r, self.filt_size_final) 
+                          for r in ratio])
 
         else:
             self.load_cal_property(['fiber_to_fiber'])   
@@ -1127,26 +1638,30 @@ class Amplifier:
                 self.skypath = None
         if self.skypath is None:
             self.get_master_sky(sky=True)
-            for fib, fiber in enumerate(self.fibers):
-                fiber.sky_spectrum = (fiber.fiber_to_fiber 
-                                 * np.interp(fiber.wavelength, self.masterwave, 
-                                             self.mastersky))
+            fiberset = self.get_fiberset()
+            fiberset.set('sky_spectrum', fiberset.get('fiber_to_fiber') 
+                         * np.interp(fiberset.get('wavelength'), 
+                                     self.masterwave, self.mastersky))
         if self.make_skyframe: 
             self.skyframe = get_model_image(self.image, self.fibers, 
-                                            'sky_spectrum', debug=False)
+                                            'sky_spectrum', debug=False,
+                                      operator=self.get_profile_operator())
             self.clean_image = self.image - self.skyframe
         if self.do_cont_sub:
-            for fib, fiber in enumerate(self.fibers):
-                fiber.continuum = biweight_filter(fiber.spectrum 
-                                                  -fiber.sky_spectrum, 
-                                                  self.cont_smooth, 
-                                                  ignore_central=7)
+            fiberset = self.get_fiberset()
+            fiberset.set('continuum', biweight_filter_rows(
+                                           fiberset.get('spectrum')
+                                           - fiberset.get('sky_spectrum'),
+                                           self.cont_smooth, 
+                                           ignore_central=7))
             self.cont_frame = get_model_image(self.image, self.fibers, 
-                                            'continuum', debug=False)
+                                            'continuum', debug=False,
+                                      operator=self.get_profile_operator())
             self.continuum_sub = self.image - self.skyframe - self.cont_frame
         if self.make_residual:
             self.model = get_model_image(self.image, self.fibers, 'spectrum', 
-                                         debug=False)
+                                         debug=False,
+                                         operator=self.get_profile_operator())
             self.residual = self.image - self.model
         
         
@@ -1162,10 +1677,9 @@ class Amplifier:
                                   sigclip=25.0, sigfrac=0.001, objlim=0.001,
                                   satlevel=-1.0)
         cc.run(maxiter=1)
-        c = np.where(cc.mask == True)
+        self.mask_source = 'cosmics'
         self.mask = np.zeros(self.image.shape)
-        for x, y in zip(c[0], c[1]):
-            self.mask[x][y] = -1.0 
+        self.mask[cc.mask == True] = -1.0 
              
              
     def get_master_sky(self, sky=False, norm=False):
@@ -1174,28 +1688,89 @@ class Amplifier:
         using a biweight average of a wavelength ordered master array.
         
         '''
-        masterwave = []
-        if sky:
-            masterspec = []
-        if norm:
-            mastersmooth=[]
-        for fib, fiber in enumerate(self.good_fibers):
-            if norm:
-                y = biweight_filter(fiber.spectrum, self.filt_size_ind)
-                mastersmooth.append(y/fiber.spectrum)
-            masterwave.append(fiber.wavelength)
-            if sky:            
-                masterspec.append(fiber.spectrum/fiber.fiber_to_fiber)
-        masterwave = np.hstack(masterwave)
-        ind = np.argsort(masterwave)
-        masterwave[:] = masterwave[ind]
-        self.masterwave = masterwave
+        fiberset = self.get_fiberset()
+        good = ~fiberset.get('dead')
+        spectrum = fiberset.get('spectrum')[good]
+        wavelength = fiberset.get('wavelength')[good]
+        if not (sky or norm):
+            self.masterwave = np.sort(wavelength.ravel())
         if sky:
-            masterspec = np.hstack(masterspec)
-            masterspec[:] = masterspec[ind]
-            self.mastersky = biweight_filter(masterspec, self.filt_size_sky)
+            masterspec = spectrum / fiberset.get('fiber_to_fiber')[good]
+            self.masterwave, self.mastersky = self.get_master_spectrum(
+                                                            wavelength, 
+                                                            masterspec, 
+                                                            self.filt_size_sky)
         if norm:
-            mastersmooth = np.hstack(mastersmooth)
-            mastersmooth[:] = mastersmooth[ind]
-            self.mastersmooth = biweight_filter(mastersmooth, 
-                                                self.filt_size_sky)     
\ No newline at end of file
+            mastersmooth = np.vstack([biweight_filter(y, self.filt_size_ind)
+                                      for y in spectrum]) / spectrum
+            self.masterwave, self.mastersmooth = self.get_master_spectrum(
+                                                            wavelength, 
+                                                            mastersmooth, 
+                                                            self.filt_size_sky)
+                                                            
+    def get_master_spectrum(self, wave, spec, filt_size):
+        '''
+        Biweight average of "spec" along wavelength from the samples of all 
+        fibers.  By default the samples are sorted in wavelength and 
+        smoothed with biweight_filter over "filt_size" samples.  With 
+        self.binned_master, the biweight is taken in uniform wavelength bins
+        of on average "filt_size" samples (see utils.biweight_bin), which 
+        is linear in the number of samples and only keeps the binned curve.
+        In both cases the master spectrum is NaN where the biweight is 
+        undefined, and so is anything interpolated from it there.
+        
+        :param wave:
+            Wavelength of each sample (e.g., nfibers x D)
+        :param spec:
+            Value of each sample, same shape as "wave"
+        :param filt_size:
+            Number of samples in the running or binned biweight
+        :returns masterwave:
+            Increasing wavelength of the master spectrum
+        :returns masterspec:
+            Master spectrum at masterwave
+        '''
+        wave = np.asarray(wave).ravel()
+        spec = np.asarray(spec).ravel()
+        if self.binned_master:
+            return biweight_bin(wave, spec, filt_size)
+        ind = np.argsort(wave)
+        return wave[ind], biweight_filter(spec[ind], filt_size)
+
+
+def fiberextract_exposures(amps, cols=None):
+    '''
+    Fiberextract several exposures of an amplifier at once, e.g., the dither
+    exposures of one IFU which share their calibration.  Amplifiers with the
+    same profiles (see Amplifier.has_same_profiles) share one 
+    ProfileOperator and are solved together with 
+    ProfileOperator.extract_many; other amplifiers are extracted on their
+    own.  Differing masks are handled column by column in extract_many.
+    
+    :param amps:
+        List of Amplifier objects
+    :param cols:
+        Columns to extract, see Amplifier.fiberextract
+    '''
+    groups = []
+    for amp in amps:
+        amp.check_fiberextract()
+        for group in groups:
+            if group[0].has_same_profiles(amp):
+                group.append(amp)
+                break
+        else:
+            groups.append([amp])
+    for group in groups:
+        if len(group) == 1:
+            group[0].fiberextract(cols=cols)
+            continue
+        operator = group[0].get_profile_operator()
+        for amp in group[1:]:
+            amp.profile_operator = operator
+        norms = operator.extract_many([amp.image for amp in group], 
+                                      masks=[amp.mask for amp in group], 
+                                      cols=cols)
+        for amp, norm in zip(group, norms):
+            amp.get_fiberset().set('spectrum', norm)
+            amp.set_extraction_state(cols)
@@ -14,9 +14,11 @@ import textwrap
 import glob
 import sys
 import os.path as op
-from astropy.io import fits
 
 import config
+from header_index import HeaderIndex, HEADER_INDEX_NAME, HEADER_COLUMNS
+from header_index import SCAN_THREADS
+from stage_cache import STAGE_CACHE_SIZE
 
 def parse_args(argv=None):
     """Parse the command line arguments
@@ -97,6 +99,84 @@ def parse_args(argv=None):
                         help='''Re-fiberextract, sky-subtract, cosmic ray reject.''',
                         action="count", default=0)
                         
+    parser.add_argument("--fibmodel_nproc", nargs='?', type=int, 
+                        help='''Number of processes used to fit the
+                        fibermodel of twighlight frames.  The serial fit
+                        starts each fiber from the last solution of the
+                        fiber before it; with more than 1 process every
+                        fiber starts from the initial profile instead, so
+                        the profiles differ from the serial fit, by up to a
+                        few percent of the profile peak.  Use 1 for
+                        reproducible science products.
+                        Default: 1''', default=1)
+
+    parser.add_argument("--extraction_factors", 
+                        help='''Save the Cholesky factors of the 
+                        extraction with the twighlight calibration and use
+                        them to extract science frames.''',
+                        action="count", default=0)
+
+    parser.add_argument("--binned_master", 
+                        help='''Build the master sky and fiber to fiber
+                        spectra in wavelength bins instead of a running
+                        biweight over all samples.''',
+                        action="count", default=0)
+
+    parser.add_argument("--float32", 
+                        help='''Keep the prepared image and error frames in
+                        single precision to halve their memory.''',
+                        action="count", default=0)
+
+    parser.add_argument("--single_product", 
+                        help='''Write the science products of an exposure
+                        and side as the extensions of one FITS file.''',
+                        action="count", default=0)
+
+    parser.add_argument("--compress_products", 
+                        help='''Rice tile compress the extensions of the
+                        single product file (floats are quantized).
+                        Requires --single_product.''',
+                        action="count", default=0)
+
+    parser.add_argument("--stage_cache", 
+                        help='''Keep the outputs of each reduction stage of
+                        the science frames in <output>/stage_cache and load
+                        them when the stage is run again with the same 
+                        inputs.''',
+                        action="count", default=0)
+
+    parser.add_argument("--stage_cache_size", nargs='?', type=float, 
+                        help='''Size limit of the stage cache in GB; the
+                        least recently used stages are removed beyond it.
+                        Default: %0.0f''' % (STAGE_CACHE_SIZE / 1024.**3), 
+                        default=STAGE_CACHE_SIZE / 1024.**3)
+
+    parser.add_argument("--write_threads", nargs='?', type=int, 
+                        help='''Number of background threads writing the
+                        FITS products; 0 writes them in turn.
+                        Default: 1''', default=1)
+
+    parser.add_argument("--write_queue", nargs='?', type=int, 
+                        help='''Number of products that may wait to be 
+                        written before the reduction blocks.
+                        Default: 8''', default=8)
+
+    parser.add_argument("--scan_threads", nargs='?', type=int, 
+                        help='''Number of threads reading the headers of 
+                        new raw frames.
+                        Default: %i''' % SCAN_THREADS, default=SCAN_THREADS)
+
+    parser.add_argument("--batch_exposures", 
+                        help='''Reduce the exposures of an IFU together 
+                        and fiberextract them as one problem.''',
+                        action="count", default=0)
+
+    parser.add_argument("--jobs", nargs='?', type=int, 
+                        help='''Number of processes used to reduce the
+                        science frames, both spectrograph sides of one 
+                        exposure per task.
+                        Default: 1''', default=1)
+
     parser.add_argument("--specid", nargs='?', type=str, 
                         help='''List of SPECID's for processing. [REQUIRED]
                         Ex: "020,008".''', default = None)
@@ -220,6 +300,10 @@ def parse_args(argv=None):
         msg = 'No SPECID was provided.'
         parser.error(msg)              
     
+    if args.compress_products and not args.single_product:
+        msg = '--compress_products requires --single_product.'
+        parser.error(msg)
+    
 
     
     if args.instr.lower() == 'virus':
@@ -252,6 +336,10 @@ def parse_args(argv=None):
         observations.append('bia')
     if args.make_masterdark:
         observations.append('drk')
+    if observations:
+        # Header values of the raw frames seen in earlier runs
+        mkpath(args.output)
+        index = HeaderIndex(op.join(args.output, HEADER_INDEX_NAME))
     for obs in observations:
         for label in labels[:2]:
             getattr(args, obs+label)
@@ -264,9 +352,8 @@ def parse_args(argv=None):
         if getattr(args, obs+labels[2]) is not None:
             setattr(args, obs+labels[2], 
                     getattr(args, obs+labels[2]).replace(" ", "").split(','))
-        DF =  pd.DataFrame(columns=['Files', 'Output', 'Amp', 'Specid', 
-                                    'Ifuslot', 'Ifuid'])     
-        cnt=0
+        allfiles = []
+        outfolders = []
         for date in getattr(args, obs+labels[0]):
             for obsid in getattr(args, obs+labels[1]):
                 if getattr(args, obs+labels[2]) is not None:   
@@ -279,21 +366,9 @@ def parse_args(argv=None):
                         files = sorted(glob.glob(op.join(args.rootdir, folder, '*')))
                         if files:
                             mkpath(op.join(args.output,folder))   
-                        for fn in files:
-                            F = fits.open(fn)
-                            outfolder = op.join(args.output,folder)    
-                            amp = (F[0].header['CCDPOS'].replace(' ', '') 
-                                         + F[0].header['CCDHALF'].replace(' ', ''))
-                            sp = '%03d' %F[0].header['SPECID']
-                            ifuid = F[0].header['IFUID'].replace(' ', '')
-                            ifuslot = '%03d' %F[0].header['IFUSLOT']
-                            DF.loc[cnt] = pd.Series({'Files':fn, 
-                                                     'Output':outfolder, 
-                                                     'Specid':sp,
-                                                     'Ifuslot': ifuslot,
-                                                     'Ifuid': ifuid, 
-                                                     'Amp': amp})
-                            cnt+=1
+                        allfiles.extend(files)
+                        outfolders.extend([op.join(args.output,folder)] 
+                                          * len(files))
                 else:
                     folder = op.join(date, args.instr,
                                      "{:s}{:07d}".format(args.instr,int(obsid)))
@@ -304,19 +379,17 @@ def parse_args(argv=None):
                         for nfile in nfiles:
                             mkpath(op.join(nfile, args.instr))
                     for fn in files:
-                        F = fits.open(fn)
                         exp = op.basename(op.dirname(op.dirname(fn)))
-                        outfolder = op.join(args.output,folder, exp, args.instr)
-                        amp = (F[0].header['CCDPOS'].replace(' ', '') 
-                                         + F[0].header['CCDHALF'].replace(' ', ''))
-                        sp = '%03d' %F[0].header['SPECID']
-                        ifuid = F[0].header['IFUID'].replace(' ', '')
-                        ifuslot = '%03d' %F[0].header['IFUSLOT']
-                        DF.loc[cnt] = pd.Series({'Files':fn, 'Output':outfolder, 
-                                                 'Specid':sp, 'Ifuslot': ifuslot,
-                                                 'Ifuid': ifuid, 'Amp': amp})
-                        cnt+=1
+                        outfolders.append(op.join(args.output,folder, exp, 
+                                                  args.instr))
+                    allfiles.extend(files)
+        values = index.get_values(allfiles, args.scan_threads)
+        values['Files'] = allfiles
+        values['Output'] = outfolders
+        DF = pd.DataFrame(values, columns=['Files', 'Output'] + HEADER_COLUMNS)
         setattr(args, obs+'_df', DF)
+    if observations:
+        index.close()
         
     if args.reduce_sci:
         cals=['twi']
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of utils.biweight_filter
+
+Compares the strided-window biweight_filter (and its float32 mode) with
+the original implementation that first copied the full
+(len(a)-order+1, order) window matrix, and checks that the default dtype
+gives the same result.  The reference calls the current
+biweight_location/biweight_midvariance, so the timings isolate the
+windowing change and not the median_absolute_deviation speedup.
+
+Run from the repository root:
+
+    python benchmarks/biweight_filter_bench.py
+
+"""
+
+from __future__ import print_function
+
+import os.path as op
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+from utils import biweight_filter, biweight_location, biweight_midvariance
+
+
+def biweight_filter_reference(a, order, ignore_central=3, func=None):
+    '''
+    The biweight_filter that materializes the window matrix, kept here
+    for comparison.
+    '''
+    if order%2==0:
+        order+=1
+    if ignore_central%2==0:
+        ignore_central+=1
+    if func is None:
+        func = biweight_location
+    a = np.array(a, copy=False)
+    ignore = [order/2]
+    for i in xrange(ignore_central/2):
+        ignore.append(order/2 - i - 1)
+        ignore.append(order/2 + i + 1)
+    half_order = order / 2
+    order_array = np.delete(np.arange(order), ignore)
+    A = np.zeros((len(a)-order+1, len(order_array)))
+    k=0
+    for i in order_array:
+        if (order-i-1) == 0:
+            A[:,k] = a[i:]
+        else:
+            A[:,k] = a[i:-(order-i-1)]
+        k+=1
+    Ab = func(A, axis=(1,))
+    A1 = np.zeros((half_order,))
+    A2 = np.zeros((half_order,))
+    for i in xrange(half_order):
+        ignore_l = [i]
+        ignore_h = [half_order]
+        for j in xrange(ignore_central/2):
+            if (i - j - 1) >=0:
+                ignore_l.append(i - j - 1)
+            ignore_l.append(i + j + 1)
+            if i > j:
+                ignore_h.append(half_order+j+1)
+            ignore_h.append(half_order-j-1)
+        A1[i] = func(np.delete(a[:(half_order+i+1)], ignore_l))
+        A2[-(i+1)] = func(np.delete(a[-(half_order+i+1):], ignore_h))
+    return np.hstack([A1,Ab,A2])
+
+
+def make_signal(n, seed=0):
+    '''
+    Random walk with a few percent of strong positive outliers.
+    '''
+    rs = np.random.RandomState(seed)
+    a = np.cumsum(rs.normal(size=n))
+    sel = rs.rand(n) < 0.03
+    a[sel] += rs.uniform(20., 200., size=sel.sum())
+    return a
+
+
+def best_time(f, repeat=3):
+    t = []
+    for i in xrange(repeat):
+        t1 = time.time()
+        f()
+        t.append(time.time() - t1)
+    return min(t)
+
+
+def main():
+    cases = [(2064, 21, biweight_location),
+             (2064, 21, biweight_midvariance),
+             (2064, 25, biweight_location),
+             (2064, 51, biweight_location),
+             (115000, 21, biweight_location),
+             (115000, 25, biweight_location),
+             (115000, 25, biweight_midvariance),
+             (115000, 51, biweight_location)]
+    print('%-8s %-6s %-21s %8s %8s %8s  %s' % ('n', 'order', 'func', 'old',
+                                               'new', 'f32', 'identical'))
+    for n, order, func in cases:
+        a = make_signal(n)
+        old = biweight_filter_reference(a, order, func=func)
+        new = biweight_filter(a, order, func=func)
+        same = np.array_equal(old, new)
+        t_old = best_time(lambda: biweight_filter_reference(a, order,
+                                                            func=func))
+        t_new = best_time(lambda: biweight_filter(a, order, func=func))
+        t_f32 = best_time(lambda: biweight_filter(a, order, func=func,
+                                                  dtype=np.float32))
+        print('%-8i %-6i %-21s %7.3fs %7.3fs %7.3fs  %s'
+              % (n, order, func.__name__, t_old, t_new, t_f32, same))
+
+
+if __name__ == '__main__':
+    main()
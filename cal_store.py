@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Calibration Store
+-----------------
+Columnar storage of the fiber calibration of one amplifier, to be used in
+conjuction with IFU reduction code, Panacea
+
+Instead of one pickle per fiber, the calibration properties of all fibers
+of an amplifier are stacked into one array per property and saved as the
+image extensions of a single FITS file.  The file is opened with memmap so
+only the properties that are asked for are read from disk.
+
+"""
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import numpy as np
+import os.path as op
+import os
+from astropy.io import fits
+
+__all__ = ["CAL_STORE_VERSION", "CAL_PROPS", "get_cal_store_name",
+           "write_cal_store", "read_cal_store", "get_factor_store_name",
+           "write_factor_store", "read_factor_store"]
+
+# Bump when the layout changes; files with another version are ignored
+CAL_STORE_VERSION = 1
+
+# Fiber properties saved in the store
+CAL_PROPS = ['trace', 'fibmodel_x', 'fibmodel_y', 'binx',
+             'fibmodel_polyvals', 'wave_polyvals', 'fiber_to_fiber', 'dead',
+             'spectrum', 'sky_spectrum']
+
+
+class CalFiber:
+    '''
+    Light-weight stand-in for a Fiber read back from the store.  It has the
+    binning "D", the fiber number and the requested properties.
+    '''
+    def __init__(self, D, fibnum):
+        self.D = D
+        self.fibnum = fibnum
+
+
+def get_cal_store_name(path, specid, ifuslot, ifuid, amp):
+    '''
+    File name of the calibration store for an amplifier in "path".
+    '''
+    return op.join(path, 'cal_%s_%s_%s_%s.fits' % (specid, ifuslot, ifuid,
+                                                   amp))
+
+
+def write_cal_store(fn, fibers):
+    '''
+    Write the calibration properties of "fibers" to "fn".
+
+    A property is saved if it has the same shape for all fibers where it
+    is defined; for fibers where it is None the row is NaN and marked as
+    undefined (0) in the "DEFINED" extension.  Properties that are None 
+    for all fibers are not saved.  Properties whose shape varies between
+    fibers are not saved either but marked with 2 in "DEFINED", and 
+    readers fall back to the fiber pickles for those.
+
+    :param fn:
+        Output file name, typically from get_cal_store_name()
+    :param fibers:
+        List of Fiber objects ordered by fiber number
+    '''
+    hdr = fits.Header()
+    hdr['CALVER'] = (CAL_STORE_VERSION, 'Calibration store version')
+    hdr['NFIBERS'] = (len(fibers), 'Number of fibers')
+    hdr['D'] = (fibers[0].D, 'Number of columns of the fiber properties')
+    hdr['FIBPATH'] = fibers[0].path
+    hdr['FIBFILE'] = fibers[0].filename
+    hdulist = [fits.PrimaryHDU(header=hdr)]
+    defined = np.zeros((len(CAL_PROPS), len(fibers)), dtype=np.uint8)
+    for j, prop in enumerate(CAL_PROPS):
+        values = [getattr(fiber, prop, None) for fiber in fibers]
+        shapes = set([np.shape(value) for value in values
+                      if value is not None])
+        if len(shapes) > 1:
+            defined[j] = 2
+        if len(shapes) != 1:
+            continue
+        shape = shapes.pop()
+        if prop == 'dead':
+            data = np.zeros((len(fibers),) + shape, dtype=np.uint8)
+        else:
+            data = np.nan * np.ones((len(fibers),) + shape)
+        for i, value in enumerate(values):
+            if value is not None:
+                data[i] = value
+                defined[j, i] = 1
+        hdulist.append(fits.ImageHDU(data, name=prop.upper()))
+    hdu = fits.ImageHDU(defined, name='DEFINED')
+    for j, prop in enumerate(CAL_PROPS):
+        hdu.header['PROP%i' % (j+1)] = prop
+    hdulist.append(hdu)
+    path = op.dirname(fn)
+    if path and not op.exists(path):
+        os.mkdir(path)
+    # Write to a temporary file first so readers never see a partial file
+    tmp = fn + '.tmp'
+    fits.HDUList(hdulist).writeto(tmp, overwrite=True)
+    os.rename(tmp, fn)
+
+
+def read_cal_store(fn, props):
+    '''
+    Read calibration properties from a store written by write_cal_store.
+
+    :param fn:
+        File name of the store
+    :param props:
+        List of properties to read
+    :returns fibers:
+        List of CalFiber objects with the properties in "props" set (None
+        where undefined), or None if the file does not exist, has another
+        version, or does not have all of "props".
+    '''
+    if not op.exists(fn):
+        return None
+    with fits.open(fn, memmap=True) as hdulist:
+        hdr = hdulist[0].header
+        if hdr.get('CALVER') != CAL_STORE_VERSION:
+            return None
+        dhdr = hdulist['DEFINED'].header
+        names = [dhdr['PROP%i' % (j+1)]
+                 for j in xrange(hdulist['DEFINED'].data.shape[0])]
+        defined = np.array(hdulist['DEFINED'].data)
+        extnames = [hdu.name for hdu in hdulist[1:]]
+        nfibers = hdr['NFIBERS']
+        fibers = [CalFiber(hdr['D'], i+1) for i in xrange(nfibers)]
+        fibers_path = hdr['FIBPATH']
+        fibers_file = hdr['FIBFILE']
+        for prop in props:
+            if prop not in names:
+                return None
+            j = names.index(prop)
+            if (defined[j] == 2).any():
+                return None
+            if prop.upper() in extnames:
+                data = np.array(hdulist[prop.upper()].data)
+            else:
+                data = None
+            for i, fiber in enumerate(fibers):
+                if data is None or defined[j, i] == 0:
+                    value = None
+                elif prop == 'dead':
+                    value = bool(data[i])
+                else:
+                    value = data[i]
+                setattr(fiber, prop, value)
+    for fiber in fibers:
+        fiber.path = fibers_path
+        fiber.filename = fibers_file
+    return fibers
+
+
+def get_factor_store_name(path, specid, ifuslot, ifuid, amp):
+    '''
+    File name of the extraction factors for an amplifier in "path".
+    '''
+    return op.join(path, 'factors_%s_%s_%s_%s.fits' % (specid, ifuslot, 
+                                                       ifuid, amp))
+
+
+def write_factor_store(fn, checksum, factors):
+    '''
+    Write the Cholesky factors of the extraction of each column (see
+    fiber_utils.ProfileOperator.get_factors) to "fn".
+
+    :param fn:
+        Output file name, typically from get_factor_store_name()
+    :param checksum:
+        Checksum of the profile windows the factors belong to
+    :param factors:
+        Tuple of the banded factors, the empty fibers and the factored 
+        columns
+    '''
+    cb, empty, ok = factors
+    hdr = fits.Header()
+    hdr['CALVER'] = (CAL_STORE_VERSION, 'Calibration store version')
+    hdr['PROFHASH'] = (checksum, 'MD5 of the profile windows')
+    hdulist = [fits.PrimaryHDU(header=hdr), 
+               fits.ImageHDU(cb, name='CHOLESKY'),
+               fits.ImageHDU(empty.astype(np.uint8), name='EMPTY'),
+               fits.ImageHDU(ok.astype(np.uint8), name='FACTORED')]
+    path = op.dirname(fn)
+    if path and not op.exists(path):
+        os.mkdir(path)
+    tmp = fn + '.tmp'
+    fits.HDUList(hdulist).writeto(tmp, overwrite=True)
+    os.rename(tmp, fn)
+
+
+def read_factor_store(fn, checksum):
+    '''
+    Read the extraction factors written by write_factor_store.
+
+    :param fn:
+        File name of the factors
+    :param checksum:
+        Checksum of the profile windows of the current trace and fibermodel
+    :returns factors:
+        Tuple of the banded factors, the empty fibers and the factored 
+        columns, or None if the file does not exist, has another version or
+        was made for other profiles (e.g., the trace was adjusted since).
+    '''
+    if not op.exists(fn):
+        return None
+    with fits.open(fn) as hdulist:
+        hdr = hdulist[0].header
+        if (hdr.get('CALVER') != CAL_STORE_VERSION 
+                or hdr.get('PROFHASH') != checksum):
+            return None
+        return (np.array(hdulist['CHOLESKY'].data, dtype=float),
+                np.array(hdulist['EMPTY'].data, dtype=bool),
+                np.array(hdulist['FACTORED'].data, dtype=bool))
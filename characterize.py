@@ -16,6 +16,8 @@ import textwrap
 import glob
 import os.path as op
 from amplifier import Amplifier
+from header_index import HeaderIndex, HEADER_INDEX_NAME, SCAN_THREADS
+from header_index import scan_headers
 from utils import biweight_location, biweight_midvariance, biweight_filter2d
 from progressbar import ProgressBar
 from CreateTexWriteup import CreateTex
@@ -184,12 +186,25 @@ def parse_args(argv=None):
                         help='''Don't make masterbias.''',
                         action="count", default=0)
 
+    parser.add_argument("--scan_threads", nargs='?', type=int, 
+                        help='''Number of threads reading the raw frames.
+                        Default: %i''' % SCAN_THREADS, default=SCAN_THREADS)
                           
     args = parser.parse_args(args=argv)
     
     return args
 
 
+def read_raw_amplifier(fn, obs):
+    '''
+    Amplifier of the raw frame "fn" with the overscan subtracted and trimmed.
+    '''
+    amp = Amplifier(fn, '', name=obs)
+    amp.subtract_overscan()
+    amp.trim_image()
+    return amp
+    
+    
 def read_in_raw(args):
     log = logging.getLogger('characterize')
     # Check that the arguments are filled
@@ -201,8 +216,11 @@ def read_in_raw(args):
 
     labels = ['dir_date', 'dir_obsid', 'dir_expnum']
     observations=['bia', 'drk', 'pxf', 'ptc', 'flt']
+    # Header values of the raw frames seen in earlier runs
+    mkpath(args.output)
+    index = HeaderIndex(op.join(args.output, HEADER_INDEX_NAME))
     for obs in observations:
-        amp_list = []
+        allfiles = []
         for label in labels[:2]:
             getattr(args, obs+label)
             if getattr(args, obs+label) is None:
@@ -226,21 +244,24 @@ def read_in_raw(args):
                                          args.instr)
                         files = sorted(glob.glob(op.join(args.rootdir, folder, 
                                                          '*')))
-                        for fn in files:
-                            amp_list.append(Amplifier(fn, '', name=obs))
-                            amp_list[-1].subtract_overscan()
-                            amp_list[-1].trim_image()
+                        allfiles.extend(files)
                 else:
                     folder = op.join(date, args.instr,
                                      "{:s}{:07d}".format(args.instr, 
                                                          int(obsid)))
                     files = sorted(glob.glob(op.join(args.rootdir, folder, '*', 
                                                      args.instr, '*')))
-                    for fn in files:
-                        amp_list.append(Amplifier(fn, '', name=obs))
-                        amp_list[-1].subtract_overscan()
-                        amp_list[-1].trim_image()
+                    allfiles.extend(files)
+        # The headers of new frames are read without their data, over 
+        # args.scan_threads threads, and added to the index
+        values = index.get_values(allfiles, args.scan_threads)
+        for amp in AMPS:
+            log.info('Found %i %s frames for %s' 
+                     %(values['Amp'].count(amp), obs, amp))
+        amp_list = scan_headers(allfiles, args.scan_threads, 
+                                lambda fn: read_raw_amplifier(fn, obs))
         setattr(args,obs+'_list', amp_list)
+    index.close()
 
     return args       
 
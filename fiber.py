@@ -12,12 +12,19 @@ from __future__ import (division, print_function, absolute_import,
                         unicode_literals)
 
 import numpy as np
+import sys
 import cPickle as pickle
 import os.path as op
 import os
 from utils import biweight_filter
 
-__all__ = ["Fiber"]
+__all__ = ["Fiber", "FiberSet"]
+
+# Attributes that eval_fibmodel_poly and eval_wave_poly depend on.  Assigning
+# any of them (or the evaluated attribute itself) marks the evaluation stale.
+FIBMODEL_INPUTS = ['D', 'binx', 'fibmodel_x', 'fibmodel_y', 
+                   'fibmodel_polyvals', 'fibmodel']
+WAVE_INPUTS = ['D', 'wave_polyvals', 'wavelength']
 
 class Fiber:
     def __init__(self, D, fibnum, path, filename, trace_poly_order=3, 
@@ -105,6 +112,51 @@ class Fiber:
         self.default_trace_y = None
         self.dead = False
         
+    def __setattr__(self, name, value):
+        '''
+        Keep track of the inputs of the fibermodel and wavelength evaluation.
+        An input only marks the evaluation stale if its new value differs 
+        from the old one, so reloading the same calibration is free.  Note 
+        that changing an input in place is not tracked; assign it instead.
+        '''
+        if name in FIBMODEL_INPUTS or name in WAVE_INPUTS:
+            old = self.__dict__.get(name)
+            if (old is not value and not (isinstance(value, np.ndarray) 
+                                          and isinstance(old, np.ndarray) 
+                                          and np.array_equal(old, value))):
+                self.mark_stale(name)
+        self.store(name, value)
+        
+    def __getstate__(self):
+        '''
+        Pickle the fiber on its own, without the FiberSet it may be part of.
+        '''
+        state = self.__dict__.copy()
+        state.pop('fiberset', None)
+        state.pop('fiberset_index', None)
+        return state
+        
+    def mark_stale(self, name):
+        '''
+        Mark the evaluations that depend on attribute "name" as stale.
+        '''
+        if name in FIBMODEL_INPUTS:
+            self.__dict__['fibmodel_eval'] = None
+        if name in WAVE_INPUTS:
+            self.__dict__['wave_eval'] = False
+        
+    def store(self, name, value):
+        '''
+        Set attribute "name" without the stale tracking.  If the fiber is
+        part of a FiberSet holding "name", the value is written into the 
+        fiber's row of the FiberSet array.
+        '''
+        fiberset = self.__dict__.get('fiberset')
+        if fiberset is not None and fiberset.store(
+                                  self.__dict__['fiberset_index'], name, value):
+            return
+        self.__dict__[name] = value
+        
     def init_trace_info(self):
         self.trace_x = self.flag * np.ones((self.D,),dtype = np.int)
         self.trace_y = np.zeros((self.D,))
@@ -147,18 +199,35 @@ class Fiber:
             
     
     def eval_fibmodel_poly(self, use_poly=False):
-        self.fibmodel = np.zeros((self.D, len(self.binx)))
+        '''
+        Evaluate the fibermodel in each column.  The result is kept until one
+        of FIBMODEL_INPUTS is reassigned, so repeated calls are free.
+        '''
+        if (self.fibmodel is not None 
+                and self.__dict__.get('fibmodel_eval') == use_poly):
+            return
+        fibmodel = np.zeros((self.D, len(self.binx)))
         for i in xrange(len(self.binx)):
             if use_poly:
-                self.fibmodel[:,i] = np.polyval(self.fibmodel_polyvals[:,i],
-                                                1.* np.arange(self.D) / self.D)
+                fibmodel[:,i] = np.polyval(self.fibmodel_polyvals[:,i],
+                                           1.* np.arange(self.D) / self.D)
             else:
-                self.fibmodel[:,i] = np.interp(np.arange(self.D), 
-                                               self.fibmodel_x, 
-                                               self.fibmodel_y[:,i])
+                fibmodel[:,i] = np.interp(np.arange(self.D), 
+                                          self.fibmodel_x, 
+                                          self.fibmodel_y[:,i])
+        self.store('fibmodel', fibmodel)
+        self.__dict__['fibmodel_eval'] = use_poly
+                                               
     def eval_wave_poly(self):
-        self.wavelength = np.polyval(self.wave_polyvals, 
-                                     1.* np.arange(self.D) / self.D)        
+        '''
+        Evaluate the wavelength in each column.  The result is kept until one
+        of WAVE_INPUTS is reassigned.
+        '''
+        if self.wavelength is not None and self.__dict__.get('wave_eval'):
+            return
+        self.store('wavelength', np.polyval(self.wave_polyvals, 
+                                            1.* np.arange(self.D) / self.D))
+        self.__dict__['wave_eval'] = True
         
     def save(self, specid, ifuslot, ifuid, amp):
         self.fibmodel = None
@@ -171,4 +240,95 @@ class Fiber:
         if not op.exists(self.path):
             os.mkdir(self.path)
         with open(self.fn, 'wb') as f:
-           pickle.dump(self, f)
\ No newline at end of file
+           pickle.dump(self, f)
+
+
+class FiberSet:
+    '''
+    Struct-of-arrays view of the fibers of an amplifier.  A property such as
+    "trace", "wavelength", "spectrum", "sky_spectrum", "fiber_to_fiber" or
+    "fibmodel" is stacked into one contiguous (nfibers, D[, bins]) array on
+    the first get() and each fiber's attribute becomes a view of its row.
+    Whole-array operations on the FiberSet array are therefore seen by the 
+    fibers, and assigning a fiber attribute of the same shape writes into 
+    the array.  Assigning a value of another shape (e.g., None) releases
+    the property: the fibers get copies of their rows and the next get() 
+    stacks it again.
+    '''
+    def __init__(self, fibers):
+        '''
+        :param fibers:
+            List of Fiber objects ordered by fiber number
+        '''
+        self.fibers = list(fibers)
+        self.arrays = {}
+        for i, fiber in enumerate(self.fibers):
+            fiber.__dict__['fiberset'] = self
+            fiber.__dict__['fiberset_index'] = i
+            
+    def __len__(self):
+        return len(self.fibers)
+        
+    def get(self, prop):
+        '''
+        Array of "prop" for all fibers, (nfibers,) + shape of the property.
+        Returns None if "prop" is None for any fiber or has different shapes.
+        "dead" is returned as a boolean array that is not shared with the 
+        fibers.
+        '''
+        if prop == 'dead':
+            return np.array([fiber.dead for fiber in self.fibers], dtype=bool)
+        if prop not in self.arrays:
+            values = [getattr(fiber, prop, None) for fiber in self.fibers]
+            if any([value is None for value in values]):
+                return None
+            if len(set([np.shape(value) for value in values])) != 1:
+                return None
+            self.bind(prop, np.array(values))
+        return self.arrays[prop]
+        
+    def set(self, prop, values):
+        '''
+        Set "prop" of all fibers from an array of shape (nfibers, ...).
+        '''
+        values = np.array(values)
+        if len(values) != len(self.fibers):
+            print("Cannot set %s for %i fibers from %i values" 
+                  %(prop, len(self.fibers), len(values)))
+            sys.exit(1)
+        if prop in self.arrays:
+            self.release(prop)
+        for fiber in self.fibers:
+            fiber.mark_stale(prop)
+        self.bind(prop, values)
+        
+    def bind(self, prop, array):
+        '''
+        Make the attribute "prop" of each fiber a view of its row of "array".
+        '''
+        self.arrays[prop] = array
+        for i, fiber in enumerate(self.fibers):
+            fiber.__dict__[prop] = array[i]
+            
+    def release(self, prop):
+        '''
+        Give each fiber a copy of its row of "prop" and drop the array.
+        '''
+        array = self.arrays.pop(prop)
+        for i, fiber in enumerate(self.fibers):
+            fiber.__dict__[prop] = array[i].copy()
+            
+    def store(self, i, prop, value):
+        '''
+        Write the value of "prop" for fiber "i" into the array if "prop" is
+        held and the shape matches.  Returns True if it was written.
+        '''
+        if prop not in self.arrays:
+            return False
+        row = self.fibers[i].__dict__[prop]
+        if value is not None and np.shape(value) == row.shape:
+            if value is not row:
+                row[...] = value
+            return True
+        self.release(prop)
+        return False
@@ -11,13 +11,18 @@ from utils import biweight_location, biweight_midvariance, is_outlier
 from utils import biweight_filter
 from scipy.optimize import nnls
 import scipy
-from scipy.linalg import lstsq
+from scipy.linalg import lstsq, solveh_banded, LinAlgError
+from scipy.linalg import cholesky_banded
+from scipy.sparse import csr_matrix
 import matplotlib.pyplot as plt
 import matplotlib
 import os.path as op
 import numpy as np
 import time
 import sys
+import hashlib
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 
 plaw_coeff = np.array([0.0000,0.5,0.15,1.0])
 
@@ -520,89 +525,311 @@ def get_trace_from_image(image, y_window=3, x_window=5, repeat_length=2,
         The number of iterations to re-calculate the first order moment
         over the interpreted grid        
     '''
-    allfibers=[]
     a, b = image.shape
-    x = np.arange(a)
     xc = np.arange(b)[x_window:(b-1-x_window)]
     if debug:
         t1 = time.time()
-    for i in xc:
-        # Average 2*x_windwow columns at a time
-        y = biweight_location(image[:,(i-x_window):(i+x_window+1)], axis=(1,))
-        
-        # Set empty arrays for maxima and minima found in 2*y_window searches
-        mxval = np.zeros((a-2-y_window*2+1,))
-        mnval = np.zeros((a-2-y_window*2+1,))
-        k=0
-        for j in xrange(y_window,a - 1 - y_window):
-            mxval[k] = np.argmax(y[(j-y_window):(j+y_window+1)])+j-y_window
-            mnval[k] = np.argmin(y[(j-y_window):(j+y_window+1)])+j-y_window
-            k+=1
-        # Get unique values
-        umnval = np.unique(mnval)
-        umxval = np.unique(mxval)
-        mnkeep = []
-        mxkeep = []
-        # Only keep those which are max/min for at least repeat_length
-        for j in umnval:
-            if (j==mnval).sum() > repeat_length:
-               mnkeep.append(j)
-        for j in umxval:
-            if (j==mxval).sum() > repeat_length:
-               mxkeep.append(j) 
-               
-        # Make lists arrays
-        mnkeep = np.array(mnkeep,dtype=int)
-        mxkeep = np.array(mxkeep,dtype=int)
-        
-        #refined peak values and heights
-        peaks_refined = np.zeros(mxkeep.shape)
-        peaks_height = np.zeros(mxkeep.shape)
-
-        # Loop through maxima and find the light-weighted average iteratively
-        # Each iteration defines the new centroid and we interpolate the data
-        # to a finer grid for the light-weighted average in a 2*y_window region
-        for j, val in enumerate(mxkeep):
-            ind = np.searchsorted(mnkeep,val)
-            if ind==len(mnkeep):
-                ind-=1
-                mn1 = int(mnkeep[ind])
-                mn2 = int(len(y))
-            elif ind==0:
-                mn1 = int(0)
-                mn2 = int(mnkeep[ind]+1)
-            else:
-                mn1 = int(mnkeep[ind-1])
-                mn2 = int(mnkeep[ind]+1)
-            if val - mn1 > max_to_min_dist:
-                mn1 = int(val - max_to_min_dist)
-            if mn2 - val > (max_to_min_dist + 1):
-                mn2 = int(val + max_to_min_dist + 1)
-            lwa = ((y[mn1:mn2]*x[mn1:mn2]).sum()/(y[mn1:mn2]).sum())
-            # Iterating and interpolating to refine the centroid
-            for k in xrange(first_order_iter):
-                xp = np.linspace(lwa-interp_window, lwa+interp_window, num=50)
-                yp = np.interp(xp, x[mn1:mn2], y[mn1:mn2],left=0,right=0)
-                lwa = (yp*xp).sum()/yp.sum()
-            peaks_refined[j] = lwa
-            peaks_height[j] = y[val]
-        mh = biweight_location(peaks_height)
-        peaks_final = peaks_refined[peaks_height > (mx_cut * mh)]
-        allfibers.append(peaks_final[np.isfinite(peaks_final)]) 
+    # Average 2*x_windwow columns at a time
+    y = get_trace_column_profiles(image, xc, x_window)
+    
+    # Maxima and minima that are found in at least repeat_length 2*y_window
+    # searches, as (column, row) pairs sorted by column then row
+    mxcol, mxkeep = get_trace_extrema(y, y_window, repeat_length, np.argmax)
+    mncol, mnkeep = get_trace_extrema(y, y_window, repeat_length, np.argmin)
+    
+    # For each maximum, the range [mn1, mn2) between the surrounding minima
+    ncols = len(xc)
+    mnstart = np.searchsorted(mncol, np.arange(ncols))
+    mnlen = np.bincount(mncol, minlength=ncols)
+    # A maximum in a column without minima has no range to centroid over
+    sel = mnlen[mxcol] > 0
+    if debug and not sel.all():
+        print("Skipping %i maxima in columns without minima" 
+              %(~sel).sum())
+    mxcol, mxkeep = mxcol[sel], mxkeep[sel]
+    ind = (np.searchsorted(mncol * a + mnkeep, mxcol * a + mxkeep) 
+           - mnstart[mxcol])
+    # Without a minimum below (above) the range starts (ends) at the edge;
+    # the minima of other columns are never used
+    has_low = ind > 0
+    has_high = ind < mnlen[mxcol]
+    mnlow = mnkeep[np.where(has_low, mnstart[mxcol] + ind - 1, 0)]
+    mnhigh = mnkeep[np.where(has_high, mnstart[mxcol] + ind, 0)]
+    mn1 = np.where(has_low, mnlow, 0)
+    mn2 = np.where(has_high, mnhigh + 1, a)
+    mn1 = np.where(mxkeep - mn1 > max_to_min_dist, 
+                   (mxkeep - max_to_min_dist).astype(int), mn1)
+    mn2 = np.where(mn2 - mxkeep > (max_to_min_dist + 1), 
+                   (mxkeep + max_to_min_dist + 1).astype(int), mn2)
+    
+    # Find the light-weighted average iteratively for all maxima at once.
+    # Each iteration defines the new centroid and we interpolate the data
+    # to a finer grid for the light-weighted average in a 2*y_window region
+    lwa = get_trace_segment_centroids(y, mxcol, mn1, mn2)
+    for k in xrange(first_order_iter):
+        xp = np.ascontiguousarray(np.linspace(lwa-interp_window, 
+                                              lwa+interp_window, num=50, 
+                                              axis=1))
+        yp = interp_trace_segments(xp, y, mxcol, mn1, mn2)
+        lwa = (yp*xp).sum(axis=1)/yp.sum(axis=1)
+    peaks_refined = lwa
+    peaks_height = y[mxcol, mxkeep]
+    
+    # Height cut relative to the typical height of the peaks in a column
+    mxstart = np.searchsorted(mxcol, np.arange(ncols+1))
+    counts = np.diff(mxstart)
+    mh = np.zeros((ncols,))
+    for n in np.unique(counts):
+        cols = np.where(counts == n)[0]
+        if n == 0:
+            mh[cols] = np.nan
+            continue
+        H = peaks_height[mxstart[cols][:,np.newaxis] + np.arange(n)]
+        mh[cols] = biweight_location(H, axis=(1,))
+    keep = (peaks_height > (mx_cut * mh[mxcol])) * np.isfinite(peaks_refined)
+    allfibers = np.split(peaks_refined * 1., mxstart[1:-1])
+    keeps = np.split(keep, mxstart[1:-1])
+    allfibers = [peaks[sel] for peaks, sel in zip(allfibers, keeps)]
     if debug:
         t2 = time.time()
         print("Time Taken for Trace: %0.2f" %(t2-t1))
     return allfibers, xc
 
 
+def get_trace_column_profiles(image, xc, x_window, chunk=64):
+    '''
+    Biweight average of image[:, i-x_window:i+x_window+1] for each column i 
+    in xc.  The windows are read from a strided view of the image and 
+    evaluated for "chunk" columns at a time.
+    
+    :returns y:
+        Array of shape (len(xc), number of rows)
+    '''
+    a, b = image.shape
+    image = np.asarray(image)
+    w = 2*x_window+1
+    start = image[:, (xc[0]-x_window):]
+    windows = np.lib.stride_tricks.as_strided(start, 
+                                              shape=(len(xc), a, w),
+                                              strides=(start.strides[1],
+                                                       start.strides[0],
+                                                       start.strides[1]))
+    y = np.zeros((len(xc), a), dtype=np.result_type(image, float))
+    for i in xrange(0, len(xc), chunk):
+        y[i:i+chunk] = biweight_location(
+                                    np.ascontiguousarray(windows[i:i+chunk]),
+                                    axis=(2,))
+    return y
+    
+    
+def get_trace_extrema(y, y_window, repeat_length, func):
+    '''
+    Find the rows that are the extremum of at least repeat_length+1 of the 
+    [j-y_window, j+y_window] windows of each column profile.
+    
+    :param y:
+        Column profiles of shape (number of columns, number of rows)
+    :param func:
+        np.argmax or np.argmin
+    :returns col, row:
+        Column index and row of each extremum, sorted by column then row
+    '''
+    ncols, a = y.shape
+    w = 2*y_window+1
+    # Windows start at rows 0 to a-2-2*y_window
+    nwin = a - 1 - 2*y_window
+    windows = np.lib.stride_tricks.as_strided(y, shape=(ncols, nwin, w),
+                                              strides=(y.strides[0], 
+                                                       y.strides[1],
+                                                       y.strides[1]))
+    val = func(windows, axis=2) + np.arange(nwin)
+    counts = np.bincount((val + a*np.arange(ncols)[:,np.newaxis]).ravel(),
+                         minlength=ncols*a).reshape((ncols, a))
+    col, row = np.where(counts > repeat_length)
+    return col, row
+    
+
+def get_trace_segment_centroids(y, col, mn1, mn2):
+    '''
+    First moment of y[col, mn1:mn2] over the row for each segment.  
+    Segments are grouped by length so each sum is accumulated in the same 
+    order as for a single segment.
+    '''
+    x = np.arange(y.shape[1])
+    lwa = np.zeros(col.shape)
+    length = mn2 - mn1
+    for n in np.unique(length):
+        sel = np.where(length == n)[0]
+        rows = mn1[sel][:,np.newaxis] + np.arange(n)
+        Y = y[col[sel][:,np.newaxis], rows]
+        lwa[sel] = (Y*x[rows]).sum(axis=1) / Y.sum(axis=1)
+    return lwa
+    
+    
+def interp_trace_segments(xp, y, col, mn1, mn2):
+    '''
+    Same as np.interp(xp[i], x[mn1[i]:mn2[i]], y[col[i], mn1[i]:mn2[i]],
+    left=0, right=0) for each segment i, where x is the row number.
+    '''
+    a = y.shape[1]
+    lo = mn1[:,np.newaxis]
+    hi = (mn2 - 1)[:,np.newaxis]
+    with np.errstate(invalid='ignore'):
+        inside = (xp >= lo) * (xp <= hi)
+    # Lower node of the interval containing xp, as in np.interp
+    j = np.minimum(np.floor(np.where(inside, xp, lo)).astype(int), hi)
+    flat = col[:,np.newaxis] * a + j
+    yflat = y.ravel()
+    y0 = yflat.take(flat)
+    y1 = yflat.take(flat + 1, mode='clip')
+    with np.errstate(invalid='ignore'):
+        yp = (y1 - y0) / 1. * (xp - j) + y0
+    yp = np.where(inside * (xp != j) * (j != hi), yp, 
+                  np.where(inside, y0, 0.))
+    yp[np.isnan(xp)] = np.nan
+    return yp
+
+
+def get_hat_basis(ix, binx):
+    '''
+    Evaluate the non-parametric fibermodel basis at distances "ix" from the 
+    trace.  Basis function j is the linear interpolation of one at binx[j] 
+    and zero at all other bins, so only the two functions of the bins 
+    bracketing an offset are non-zero there.  These are found in a single 
+    searchsorted pass and the values are the same as 
+    np.interp(ix, binx, fun, left=0., right=0.) with fun[j] = 1.
+    
+    :param ix:
+        Array of distances from the trace
+    :param binx:
+        Increasing locations of the fibermodel bins
+    :returns ind:
+        Indices of the bracketing bins, shape ix.shape + (2,)
+    :returns weight:
+        Values of the two basis functions, shape ix.shape + (2,). They are 
+        zero outside of [binx[0], binx[-1]].
+    '''
+    ix = np.asarray(ix, dtype=float)
+    binx = np.asarray(binx, dtype=float)
+    j = np.clip(np.searchsorted(binx, ix, side='right') - 1, 0, 
+                len(binx) - 2)
+    slope = 1. / (binx[j+1] - binx[j])
+    dx = ix - binx[j]
+    ind = np.empty(ix.shape + (2,), dtype=int)
+    ind[...,0] = j
+    ind[...,1] = j + 1
+    weight = np.empty(ix.shape + (2,))
+    weight[...,0] = -slope * dx + 1.
+    weight[...,1] = slope * dx
+    weight[ix == binx[-1]] = [0., 1.]
+    weight[(ix < binx[0]) + (ix > binx[-1])] = 0.
+    return ind, weight
+
+
 def plaw(xp, plaw_coeff):
     return plaw_coeff[0] / (plaw_coeff[1] + plaw_coeff[2]
               * np.power(abs(xp / 2.5), plaw_coeff[3]))    
+
+
+def get_plaw_slab(Fibers, ylow, yhigh, xlow, xhigh, lowfib, highfib):
+    '''
+    Evaluate the power-law wing of each fiber only over the image stamp
+    that is needed, instead of over the full amplifier.
+    
+    :param Fibers:
+        List of fiber class object for each fiber
+    :param ylow:
+        The low row value of the stamp
+    :param yhigh:
+        The high row value of the stamp (exclusive)
+    :param xlow:
+        The low column value of the stamp
+    :param xhigh:
+        The high column value of the stamp (exclusive)
+    :param lowfib:
+        The first fiber in the group
+    :param highfib:
+        The last fiber in the group (inclusive)
+        
+    :returns:
+        Array of shape (yhigh-ylow, xhigh-xlow, highfib+1-lowfib)
+    '''
+    y = np.arange(ylow, yhigh)[:,np.newaxis,np.newaxis]
+    trace = np.array([fiber.trace[xlow:xhigh] 
+                      for fiber in Fibers[lowfib:highfib+1]]).T
+    return plaw(y - trace[np.newaxis,:,:], plaw_coeff)
+    
     
+class SharedFiber:
+    '''
+    Minimal stand-in for the Fiber class in worker processes.  It carries
+    only what fit_fibermodel_nonparametric_bins needs, with the trace being a
+    view into shared memory.
+    '''
+    def __init__(self, trace, basename):
+        self.trace = trace
+        self.basename = basename
+
+
+# Per-process state for the parallel fibermodel workers
+_fibermodel_worker = {}
+
+
+def init_fibermodel_worker(shared_image, shared_traces, shape, basenames, 
+                           kwargs):
+    '''
+    Pool initializer for fit_fibermodel_nonparametric with nproc>1.  The image
+    and traces are handed over as shared memory so they are not pickled
+    for every task.
+    '''
+    a, b = shape
+    image = np.frombuffer(shared_image).reshape((a, b))
+    traces = np.frombuffer(shared_traces).reshape((len(basenames), b))
+    ygrid, xgrid = np.indices((a, b))
+    _fibermodel_worker['image'] = image
+    _fibermodel_worker['xgrid'] = xgrid
+    _fibermodel_worker['ygrid'] = ygrid
+    _fibermodel_worker['Fibers'] = [SharedFiber(trace, basename) 
+                                    for trace, basename 
+                                    in zip(traces, basenames)]
+    _fibermodel_worker['kwargs'] = kwargs
+
+
+def fit_fibermodel_nonparametric_fiber(fib):
+    '''
+    Worker function for fit_fibermodel_nonparametric with nproc>1.  Fits all
+    column blocks of a single fiber, using the solution of the previous 
+    column block as the starting point for the next one.  The first block
+    starts from the initial profile, not from the previous fiber as in the
+    serial fit, so the solutions differ slightly from it.
+    '''
+    W = _fibermodel_worker
+    kwargs = W['kwargs']
+    col_group = kwargs['col_group']
+    sol = kwargs['sol'] * 1.
+    so = np.zeros((kwargs['ncols'], len(sol)))
+    for i in xrange(kwargs['ncols']):
+        sol = fit_fibermodel_nonparametric_bins(W['image'], W['xgrid'], 
+                                                W['ygrid'], W['Fibers'], 
+                                                fib=fib, 
+                                                debug=kwargs['debug'], 
+                                                group=kwargs['fiber_group'], 
+                                                bins=kwargs['bins'],
+                                                xlow=i*col_group, 
+                                                xhigh=(i+1)*col_group, 
+                                                plot=kwargs['plot'],
+                                                outfolder=kwargs['outfolder'],
+                                                sol=sol, 
+                                                binx=kwargs['binx'])
+        so[i,:] = sol
+    return so
+
+
 def fit_fibermodel_nonparametric(image, Fibers, plot=False, fsize=8., 
                                  fiber_group=4, bins=15, col_group=48,
                                  debug=False, use_default=False,
-                                 outfolder=None, sigma=2.5, power=2.5):
+                                 outfolder=None, sigma=2.5, power=2.5,
+                                 nproc=1):
     '''
     This function orchestrates the calls to the sub-function, 
     fit_fibermodel_nonparametric_bins, and grids the image to fit the fiber 
@@ -646,30 +873,55 @@ def fit_fibermodel_nonparametric(image, Fibers, plot=False, fsize=8.,
         profile = np.exp(-1./2.*((np.abs(x/sigma))**power))
     :param power:
         Parameter for initial profile.
+    :param nproc:
+        Number of processes used to fit the fiber x column block grid.  
+        If larger than 1, each fiber is fit in a separate task of a process
+        pool, with the image and traces in shared memory.  The column blocks 
+        of a fiber are fit in order, each starting from the previous 
+        solution, but every fiber starts from the initial profile rather
+        than from the last solution of the fiber before it.  The serial
+        chain through all fibers cannot be split across processes, so the
+        profiles differ from nproc=1, by up to a few percent of the
+        profile peak; keep nproc=1 where the results must be reproducible.
         
     '''
     a,b = image.shape 
-    ygrid,xgrid = np.indices(image.shape)                       
     nfibs = len(Fibers) 
     ncols = b / col_group
     so = np.zeros((nfibs, ncols, bins+2))
     xcols = np.arange(col_group/2, int((ncols-1/2.)*col_group)+1, col_group)
     bins1, binx, sol = init_fibermodel(fsize=fsize, bins=bins, sigma=sigma,
                                        power=power)
-    PL = np.zeros((a,b,nfibs))
-    for i in xrange(b):
-        for j,fiber in enumerate(Fibers):
-            ix = ygrid[:,i] - fiber.trace[i]
-            PL[:,i,j] = plaw(ix, plaw_coeff)
-            
-            
     if debug:
         t1 = time.time()
+    if nproc > 1 and not use_default:
+        shared_image = RawArray('d', a*b)
+        np.frombuffer(shared_image).reshape((a, b))[:] = image
+        shared_traces = RawArray('d', nfibs*b)
+        np.frombuffer(shared_traces).reshape((nfibs, b))[:] = [fiber.trace 
+                                                           for fiber in Fibers]
+        kwargs = {'col_group': col_group, 'ncols': ncols, 'sol': sol,
+                  'debug': debug, 'fiber_group': fiber_group, 'bins': bins1,
+                  'plot': plot, 'outfolder': outfolder, 'binx': binx}
+        pool = Pool(processes=nproc, initializer=init_fibermodel_worker,
+                    initargs=(shared_image, shared_traces, (a, b),
+                              [fiber.basename for fiber in Fibers], kwargs))
+        try:
+            so[:] = pool.map(fit_fibermodel_nonparametric_fiber, 
+                             xrange(nfibs))
+        finally:
+            pool.close()
+            pool.join()
+        if debug:
+            t2 = time.time()
+            print("Fibermodel Solution took: %0.3f s" %(t2-t1))
+        return so, xcols, binx
+    ygrid,xgrid = np.indices(image.shape)                       
     for j in xrange(nfibs):
         for i in xrange(ncols):
             if not use_default:
                 sol = fit_fibermodel_nonparametric_bins(image, xgrid, ygrid, 
-                                                    Fibers, PL, fib=j, 
+                                                    Fibers, fib=j, 
                                                     debug=debug, 
                                                     group=fiber_group, 
                                                     bins=bins1,
@@ -770,7 +1022,7 @@ def init_fibermodel(fsize, bins, sigma=2.5, power=2.5):
 
     
         
-def fit_fibermodel_nonparametric_bins(image, xgrid, ygrid, Fibers, PL, fib=0, 
+def fit_fibermodel_nonparametric_bins(image, xgrid, ygrid, Fibers, fib=0, 
                                       xlow=0, xhigh=1032, plot=False, 
                                       group=4, bins=11, niter=3, debug=False,
                                       outfolder=None, sol=None, binx=None,
@@ -844,7 +1096,9 @@ def fit_fibermodel_nonparametric_bins(image, xgrid, ygrid, Fibers, PL, fib=0,
     x = xgrid[ylow:yhigh,xlow:xhigh].ravel()
     y = ygrid[ylow:yhigh,xlow:xhigh].ravel()
     z = image[ylow:yhigh,xlow:xhigh].ravel()
-    P = PL[ylow:yhigh,xlow:xhigh,lowfib:highfib+1].reshape((yhigh-ylow)*(xhigh-xlow),(highfib+1-lowfib))
+    P = get_plaw_slab(Fibers, ylow, yhigh, xlow, xhigh, lowfib, 
+                      highfib).reshape((yhigh-ylow)*(xhigh-xlow),
+                                       (highfib+1-lowfib))
     # Dummy error
     #zerr = np.sqrt(image[ylow:yhigh,xlow:xhigh].ravel())
     
@@ -854,14 +1108,12 @@ def fit_fibermodel_nonparametric_bins(image, xgrid, ygrid, Fibers, PL, fib=0,
     sel = np.where((y>=ycutl) * (y<=ycuth))[0]    
     # Create empty arrays for the fibermodel weights in each given pixel from 
     Fl = np.zeros((len(y), bins, len(fibers)))
-    fun = np.zeros((bins,))
+    r = np.arange(len(y))[:,np.newaxis]
     for i,fiber in enumerate(fibers):
         ytrace = (fiber.trace[xlow:xhigh]*np.ones((yhigh-ylow,1))).ravel()
         ix = y-ytrace
-        for j in xrange(bins):
-            fun[j] = 1.0
-            Fl[:,j,i] = np.interp(ix,binx,fun,left=0.0,right=0.0)
-            fun[j] = 0.0
+        ind, weight = get_hat_basis(ix, binx)
+        Fl[r,ind,i] = weight
         
     F = Fl.sum(axis=2)
     
@@ -959,32 +1211,433 @@ def fit_fibermodel_nonparametric_bins(image, xgrid, ygrid, Fibers, PL, fib=0,
     return sol
 
 
-def get_norm_nonparametric_fast(image, Fibers, cols=None, mask=None):
-    bins=len(Fibers[0].binx)
-    a,b = image.shape
-    if mask is None:
-        mask = np.zeros(image.shape)
-    ygrid,xgrid = np.indices(image.shape)
-    fun = np.zeros((bins,))
-    y=ygrid[:,0]
-    Fl = np.zeros((len(y), bins))
-    Pl = np.zeros((len(y),))
-    init_model = np.zeros((len(y),len(Fibers)))
-    if cols is None:
-        cols = np.arange(b)
-    norm = np.zeros((len(Fibers),b))
-    for col in cols:
-        for i,fiber in enumerate(Fibers):
-            ix = y-fiber.trace[col]
-            for j in xrange(bins):
-                fun[j] = 1.0
-                Fl[:,j] = np.interp(ix,fiber.binx,fun,left=0.0,right=0.0)
-                fun[j] = 0.0
-            Pl = plaw(ix, plaw_coeff)
-            init_model[:,i] = np.dot(Fl, fiber.fibmodel[col,:])+Pl
-        norm[:,col] = lstsq(init_model[mask[:,col]==0,:], 
-                            image[mask[:,col]==0,col])[0]
+def get_profile_windows(Fibers, a, cols):
+    '''
+    Evaluate the fiber profile of each fiber in each column over the compact
+    window of rows where the fibermodel is defined, i.e., where the distance
+    to the trace lies within [binx[0], binx[-1]].  Because each fiber only
+    overlaps its immediate neighbors, this is the only non-zero part of the
+    extraction design.  The power-law wing is evaluated within the same
+    window.
+
+    :param Fibers:
+        List of fiber class object for each fiber
+    :param a:
+        Number of rows in the amplifier image
+    :param cols:
+        Columns for which the profiles are evaluated
+
+    :returns y0:
+        First row of the window for each column and fiber (ncols x nfibs)
+    :returns P:
+        Profile values over the window (ncols x nfibs x W); rows falling
+        outside of the image are set to zero.
+    '''
+    nfibs = len(Fibers)
+    ncols = len(cols)
+    W = int(np.max([np.ceil(fiber.binx[-1] - fiber.binx[0])
+                    for fiber in Fibers])) + 1
+    t = np.arange(W)
+    y0 = np.zeros((ncols, nfibs), dtype=int)
+    P = np.zeros((ncols, nfibs, W))
+    for i, fiber in enumerate(Fibers):
+        binx = fiber.binx
+        trace = fiber.trace[cols]
+        y0[:,i] = np.ceil(trace + binx[0]).astype(int)
+        y = y0[:,i][:,np.newaxis] + t
+        ix = y - trace[:,np.newaxis]
+        # Linear interpolation of the fibermodel between the bracketing bins
+        ind, weight = get_hat_basis(ix, binx)
+        fm = fiber.fibmodel[cols,:]
+        r = np.arange(ncols)[:,np.newaxis,np.newaxis]
+        prof = (weight * fm[r,ind]).sum(axis=2)
+        inside = (ix >= binx[0]) * (ix <= binx[-1]) * (y >= 0) * (y < a)
+        P[:,i,:] = np.where(inside, prof + plaw(ix, plaw_coeff), 0.0)
+    return y0, P
+
+
+def get_banded_normal_equations(image, y0, P, cols, mask=None):
+    '''
+    Build the normal equations of the per-column extraction problem in
+    the upper banded storage used by scipy.linalg.solveh_banded.  Fibers are
+    assumed to be ordered by trace position so that the design only couples
+    fibers that are within the bandwidth of each other.
+
+    :param image:
+        Amplifier image
+    :param y0:
+        First row of the profile window (see get_profile_windows)
+    :param P:
+        Profile values over the window (see get_profile_windows)
+    :param cols:
+        Columns matching the first axis of y0 and P
+    :param mask:
+        Image with -1 as a mask for ignoring pixels when solving for the
+        spectrum.
+
+    :returns ab:
+        Banded normal matrix for each column (ncols x bandwidth+1 x nfibs)
+    :returns rhs:
+        Right hand side of the normal equations (ncols x nfibs)
+    '''
+    ab = get_banded_normal_matrix(image.shape, y0, P, cols, mask=mask)
+    rhs = get_banded_rhs(image, y0, P, cols, mask=mask)
+    return ab, rhs
+
+
+def get_masked_profiles(shape, y0, P, cols, mask=None):
+    '''
+    Profile windows with the rows outside of the image and masked pixels 
+    set to zero.  See get_banded_normal_equations for the parameters.
+    '''
+    a, b = shape
+    ncols, nfibs, W = P.shape
+    y = y0[:,:,np.newaxis] + np.arange(W)
+    P = P * (y >= 0) * (y < a)
+    if mask is not None:
+        yc = np.clip(y, 0, a-1)
+        c = np.asarray(cols)[:,np.newaxis,np.newaxis]
+        P = P * (mask[yc,c] == 0)
+    return P
+
+
+def get_banded_rhs(image, y0, P, cols, mask=None):
+    '''
+    Right hand side of the normal equations of the per-column extraction 
+    problem (ncols x nfibs).  See get_banded_normal_equations.
+    '''
+    a, b = image.shape
+    ncols, nfibs, W = P.shape
+    y = y0[:,:,np.newaxis] + np.arange(W)
+    yc = np.clip(y, 0, a-1)
+    c = np.asarray(cols)[:,np.newaxis,np.newaxis]
+    P = get_masked_profiles(image.shape, y0, P, cols, mask=mask)
+    return (P * image[yc,c]).sum(axis=2)
+
+
+def get_banded_normal_matrix(shape, y0, P, cols, mask=None):
+    '''
+    Normal matrix of the per-column extraction problem in upper banded 
+    storage (ncols x bandwidth+1 x nfibs).  It does not depend on the image
+    itself, only on its shape, the profiles and the mask.  See 
+    get_banded_normal_equations.
+    '''
+    ncols, nfibs, W = P.shape
+    P = get_masked_profiles(shape, y0, P, cols, mask=mask)
+    bands = [(P * P).sum(axis=2)]
+    for k in xrange(1, nfibs):
+        off = y0[:,:-k] - y0[:,k:]
+        if not np.any(np.abs(off) < W):
+            break
+        tp = np.arange(W) + off[:,:,np.newaxis]
+        inside = (tp >= 0) * (tp < W)
+        Pk = np.take_along_axis(P[:,k:,:], np.clip(tp, 0, W-1), axis=2)
+        bands.append(np.hstack([np.zeros((ncols, k)),
+                                (P[:,:-k,:] * Pk * inside).sum(axis=2)]))
+    ab = np.array(bands[::-1]).swapaxes(0, 1)
+    return ab
+
+
+def solve_banded_normal_equations(ab, rhs):
+    '''
+    Solve the banded normal equations for each column with a banded Cholesky
+    decomposition.  Fibers without any unmasked pixels in a column get a
+    normalization of zero (as in the minimum norm least squares solution).
+    If the matrix is not positive definite, the column is solved with a dense
+    least squares fit instead.
+
+    :param ab:
+        Banded normal matrix for each column (see get_banded_normal_equations)
+    :param rhs:
+        Right hand side of the normal equations for each column
+    '''
+    ncols, u, nfibs = ab.shape
+    u -= 1
+    norm = np.zeros((nfibs, ncols))
+    for i in xrange(ncols):
+        abc = ab[i].copy()
+        empty = abc[u] <= 0.
+        abc[u, empty] = 1.
+        try:
+            norm[:,i] = solveh_banded(abc, np.where(empty, 0., rhs[i]))
+        except LinAlgError:
+            G = np.diag(ab[i,u])
+            for k in xrange(1, u+1):
+                G += np.diag(ab[i,u-k,k:], k) + np.diag(ab[i,u-k,k:], -k)
+            norm[:,i] = lstsq(G, rhs[i])[0]
     return norm
+
+
+def factor_banded_normal_matrix(ab):
+    '''
+    Banded Cholesky factors of the normal matrix of each column, so that 
+    solving a column later only takes the two triangular solves in 
+    solve_banded_factors.  Fibers without any pixels in a column are 
+    handled as in solve_banded_normal_equations.
+
+    :param ab:
+        Banded normal matrix for each column (see get_banded_normal_matrix)
+    :returns cb:
+        Upper banded Cholesky factor for each column, same shape as ab
+    :returns empty:
+        Fibers without any pixels in each column (ncols x nfibs)
+    :returns ok:
+        Columns that were factored.  The matrix of the other columns is not 
+        positive definite and they need solve_banded_normal_equations.
+    '''
+    ncols, u, nfibs = ab.shape
+    u -= 1
+    cb = np.zeros(ab.shape)
+    empty = ab[:,u,:] <= 0.
+    ok = np.zeros((ncols,), dtype=bool)
+    for i in xrange(ncols):
+        abc = ab[i].copy()
+        abc[u, empty[i]] = 1.
+        try:
+            cb[i] = cholesky_banded(abc)
+            ok[i] = True
+        except LinAlgError:
+            pass
+    return cb, empty, ok
+
+
+def solve_banded_factors(cb, empty, rhs):
+    '''
+    Solve the normal equations of each column from the Cholesky factors of
+    factor_banded_normal_matrix.  With A = U^T U, the forward and back 
+    substitutions run over the fibers, for all columns at once.
+
+    :param cb:
+        Upper banded Cholesky factor for each column
+    :param empty:
+        Fibers without any pixels in each column
+    :param rhs:
+        Right hand side of the normal equations for each column (ncols x 
+        nfibs), or for several images at once (nimages x ncols x nfibs)
+    :returns norm:
+        Solution (nfibs x ncols), or (nimages x nfibs x ncols)
+    '''
+    ncols, u, nfibs = cb.shape
+    u -= 1
+    # U[j-k,j] is stored in cb[:,u-k,j]
+    z = np.where(empty, 0., rhs)
+    for j in xrange(nfibs):
+        for k in xrange(1, min(u, j)+1):
+            z[...,j] -= cb[:,u-k,j] * z[...,j-k]
+        z[...,j] /= cb[:,u,j]
+    for j in xrange(nfibs-1, -1, -1):
+        for k in xrange(1, min(u, nfibs-1-j)+1):
+            z[...,j] -= cb[:,u-k,j+k] * z[...,j+k]
+        z[...,j] /= cb[:,u,j]
+    return np.swapaxes(z, -1, -2)
+
+
+def get_masked_columns(shape, y0, P, cols, mask=None):
+    '''
+    Columns in which a masked pixel falls in the profile window of any 
+    fiber, i.e., the columns whose normal matrix differs from the unmasked 
+    one.  See get_banded_normal_equations for the parameters.
+    '''
+    if mask is None:
+        return np.zeros((len(cols),), dtype=bool)
+    a, b = shape
+    ncols, nfibs, W = P.shape
+    y = np.clip(y0[:,:,np.newaxis] + np.arange(W), 0, a-1)
+    c = np.asarray(cols)[:,np.newaxis,np.newaxis]
+    return ((P != 0.) * (mask[y,c] != 0)).reshape(ncols, -1).any(axis=1)
+
+
+def get_norm_nonparametric_fast(image, Fibers, cols=None, mask=None):
+    '''
+    This builds the normalization (aka spectrum) for each fiber in each
+    column by solving the least squares problem of all fibers at once.
+    Each fiber only overlaps its neighbors, so the design is built over
+    compact profile windows and solved through banded normal equations.
+
+    :param image:
+        Amplifier image
+    :param Fibers:
+        List of fiber class object for each fiber
+    :param cols:
+        Columns to extract.  The normalization is zero for other columns.
+    :param mask:
+        Image with -1 as a mask for ignoring pixels when solving for the
+        spectrum.
+    '''
+    return ProfileOperator(Fibers, image.shape, cols=cols).extract(image, 
+                                                                   mask=mask)
+
+
+class ProfileOperator:
+    '''
+    The fiber profiles of an amplifier, built once from the trace, fibermodel
+    and binx of each fiber.  It maps fiber spectra to an image with apply()
+    and does the inverse, extraction, with extract(), so the profile 
+    windows are evaluated only once for both.
+    '''
+    def __init__(self, Fibers, shape, cols=None):
+        '''
+        :param Fibers:
+            List of fiber class object for each fiber
+        :param shape:
+            Shape of the amplifier image
+        :param cols:
+            Columns covered by the operator, default all columns
+        '''
+        a, b = shape
+        if cols is None:
+            cols = np.arange(b)
+        self.shape = shape
+        self.cols = np.asarray(cols, dtype=int)
+        self.nfibs = len(Fibers)
+        self.y0, self.P = get_profile_windows(Fibers, a, self.cols)
+        self.matrix = None
+        self.factors = None
+        
+    def get_checksum(self):
+        '''
+        MD5 digest of the shape, columns and profile windows.  Factors saved
+        with one operator are only valid for an operator with the same 
+        digest.
+        '''
+        md5 = hashlib.md5()
+        for arr in [np.array(self.shape), self.cols, self.y0, self.P]:
+            md5.update(np.ascontiguousarray(arr).tobytes())
+        return md5.hexdigest()
+        
+    def get_factors(self):
+        '''
+        Cholesky factors of the unmasked normal matrix of each column (see 
+        factor_banded_normal_matrix).  They are computed on the first call 
+        and then used by extract() for the columns without masked pixels.
+        '''
+        if self.factors is None:
+            ab = get_banded_normal_matrix(self.shape, self.y0, self.P, 
+                                          self.cols)
+            self.factors = factor_banded_normal_matrix(ab)
+        return self.factors
+        
+    def set_factors(self, factors):
+        '''
+        Use previously computed factors, e.g., read from a calibration 
+        product.  They must come from an operator with the same checksum.
+        '''
+        self.factors = factors
+        
+    def get_matrix(self):
+        '''
+        Sparse matrix of shape (pixels, fibers x columns) with the profile 
+        value of each fiber in each column at each pixel.  It is built on 
+        the first call.
+        '''
+        if self.matrix is None:
+            a, b = self.shape
+            ncols, nfibs, W = self.P.shape
+            y = self.y0[:,:,np.newaxis] + np.arange(W)
+            c = self.cols[:,np.newaxis,np.newaxis]
+            fc = (np.arange(nfibs)[np.newaxis,:,np.newaxis] * ncols 
+                  + np.arange(ncols)[:,np.newaxis,np.newaxis])
+            sel = (y >= 0) * (y < a)
+            rows = (y * b + c)[sel]
+            columns = (fc * np.ones((1, 1, W), dtype=int))[sel]
+            self.matrix = csr_matrix((self.P[sel], (rows, columns)), 
+                                     shape=(a*b, nfibs*ncols))
+        return self.matrix
+        
+    def apply(self, spectra):
+        '''
+        Model image of the given spectra.
+        
+        :param spectra:
+            Array or list of the spectrum of each fiber (nfibs x columns)
+        '''
+        spectra = np.asarray(spectra, dtype=float)
+        return self.get_matrix().dot(spectra[:,self.cols].ravel()).reshape(
+                                                                   self.shape)
+    
+    def get_column_index(self, cols=None):
+        '''
+        Positions of the columns "cols" (default all) in self.cols.  Raises
+        ValueError if any of them is not a column of the operator.
+        '''
+        if cols is None:
+            return np.arange(len(self.cols))
+        cols = np.asarray(cols)
+        ind = np.searchsorted(self.cols, cols)
+        found = ind < len(self.cols)
+        found[found] = self.cols[ind[found]] == cols[found]
+        if not found.all():
+            raise ValueError("Columns %s are not in the ProfileOperator" 
+                             % cols[~found])
+        return ind
+    
+    def extract(self, image, mask=None, cols=None):
+        '''
+        Normalization (aka spectrum) of each fiber in each column, see
+        get_norm_nonparametric_fast.
+        
+        :param image:
+            Amplifier image
+        :param mask:
+            Image with -1 as a mask for ignoring pixels when solving for the
+            spectrum.
+        :param cols:
+            Columns to extract, a subset of the operator's columns.  The 
+            normalization is zero for other columns.  ValueError is raised
+            for a column that is not in the operator.
+        '''
+        a, b = self.shape
+        ind = self.get_column_index(cols)
+        if self.factors is not None:
+            return self.extract_many([image], masks=[mask], cols=cols)[0]
+        norm = np.zeros((self.nfibs, b))
+        y0, P, cols = self.y0[ind], self.P[ind], self.cols[ind]
+        ab, rhs = get_banded_normal_equations(image, y0, P, cols, mask=mask)
+        norm[:,cols] = solve_banded_normal_equations(ab, rhs)
+        return norm
+        
+    def extract_many(self, images, masks=None, cols=None):
+        '''
+        Extract several images that share these profiles, e.g., the dithered
+        exposures of one amplifier.  The unmasked normal matrix of each 
+        column is factored once (see get_factors) and all images are solved 
+        together as multiple right hand sides.  Columns where an image has a
+        masked pixel within a profile window are solved on their own for 
+        that image.
+        
+        :param images:
+            List of amplifier images
+        :param masks:
+            List of masks (or None) for the images, see extract()
+        :param cols:
+            Columns to extract, a subset of the operator's columns; 
+            ValueError is raised for a column that is not in the operator.
+        :returns norm:
+            Normalization of each fiber in each column of each image
+            (nimages x nfibs x columns)
+        '''
+        a, b = self.shape
+        if masks is None:
+            masks = [None] * len(images)
+        ind = self.get_column_index(cols)
+        y0, P, cols = self.y0[ind], self.P[ind], self.cols[ind]
+        cb, empty, ok = self.get_factors()
+        rhs = np.array([get_banded_rhs(image, y0, P, cols, mask=mask)
+                        for image, mask in zip(images, masks)])
+        norm = np.zeros((len(images), self.nfibs, b))
+        k = np.where(ok[ind])[0]
+        if len(k):
+            norm[:,:,cols[k]] = solve_banded_factors(cb[ind[k]], 
+                                                     empty[ind[k]], rhs[:,k])
+        for i, mask in enumerate(masks):
+            k = np.where(~ok[ind] + get_masked_columns(self.shape, y0, P, 
+                                                       cols, mask=mask))[0]
+            if len(k):
+                ab = get_banded_normal_matrix(self.shape, y0[k], P[k], 
+                                              cols[k], mask=mask)
+                norm[i][:,cols[k]] = solve_banded_normal_equations(ab, 
+                                                                   rhs[i,k])
+        return norm
         
 def get_norm_nonparametric_bins(image, mask, xgrid, ygrid, Fibers, fib=0, 
                                       xlow=0, xhigh=1032, fsize=8., 
@@ -1051,15 +1704,13 @@ def get_norm_nonparametric_bins(image, mask, xgrid, ygrid, Fibers, fib=0,
     binx = fibers[0].binx
     Fl = np.zeros((len(y), bins, len(fibers)))
     Pl = np.zeros((len(y),len(fibers)))
-    fun = np.zeros((bins,))
+    r = np.arange(len(y))[:,np.newaxis]
     i = 0
     for fiber in fibers:
         ytrace = (fiber.trace[xlow:xhigh]*np.ones((yhigh-ylow,1))).ravel()
         ix = y-ytrace
-        for j in xrange(bins):
-            fun[j] = 1.0
-            Fl[:,j,i] = np.interp(ix,binx,fun,left=0.0,right=0.0)
-            fun[j] = 0.0
+        ind, weight = get_hat_basis(ix, binx)
+        Fl[r,ind,i] = weight
         Pl[:,i] = plaw(ix, plaw_coeff)
         i+=1
         
@@ -1085,7 +1736,7 @@ def get_norm_nonparametric_bins(image, mask, xgrid, ygrid, Fibers, fib=0,
     return norm[fid,:]
  
 
-def get_model_image(image, fibers, prop, debug=False):
+def get_model_image(image, fibers, prop, debug=False, operator=None):
     '''
     Produce an amplifier image of a given fiber property, prop.  For example if 
     prop==spectrum, then this function produces a model of the image.
@@ -1100,37 +1751,15 @@ def get_model_image(image, fibers, prop, debug=False):
         A property of the fiber class to be used for the model image.
     :param debug:
         Timing and debugging
+    :param operator:
+        ProfileOperator for these fibers and image.  If None, one is built.
     
     '''
     if debug:
         t1 = time.time()    
-    
-    # Create empty arrays for the fibermodel weights in each given pixel from
-    dummy, bins = fibers[0].fibmodel.shape
-    binx = fibers[0].binx
-    low = binx.min()-1
-    high = binx.max()+1
-    fun = np.zeros((bins,))
-    def plaw(xp, plaw_coeff):
-        return plaw_coeff[0] / (plaw_coeff[1] + plaw_coeff[2]
-                  * np.power(abs(xp), plaw_coeff[3]))
-    model = np.zeros(image.shape)
-    a,b = image.shape
-    y = np.arange(a,dtype=float)
-    for i in xrange(b):
-        Fl = np.zeros((a, bins))
-        for fib, fiber in enumerate(fibers):
-            ix = y - fiber.trace[i]
-            li = np.searchsorted(ix,low)
-            hi = np.searchsorted(ix,high)
-            for j in xrange(bins):
-                fun[j] = 1.0
-                Fl[li:hi,j] = np.interp(ix[li:hi],binx,fun,left=0.0,right=0.0)
-                fun[j] = 0.0
-            model[li:hi,i] += (getattr(fiber,prop)[i] * 1.00
-                               * (np.dot(Fl[li:hi,:],fiber.fibmodel[i,:]) 
-                                  + plaw(ix[li:hi], plaw_coeff)))
-    
+    if operator is None:
+        operator = ProfileOperator(fibers, image.shape)
+    model = operator.apply([getattr(fiber, prop) for fiber in fibers])
     if debug:
         t2 = time.time()
         print("Solution for model image took: %0.3f s" %(t2-t1))  
@@ -1214,7 +1843,6 @@ def check_fiber_profile(image, Fibers, outfile, fiber_sel=[5,58,107],
     '''
     ylen,xlen = image.shape
     ypos, xpos = np.indices((ylen,xlen))
-    nfibs = len(Fibers)
     # initial plot position    
     fig = plt.figure(figsize=(12, 12))    
     pos = 0
@@ -1225,12 +1853,6 @@ def check_fiber_profile(image, Fibers, outfile, fiber_sel=[5,58,107],
     binx = Fibers[0].binx
     low = binx.min()-8
     high = binx.max()+8
-    fun = np.zeros((bins,))
-    PL = np.zeros((ylen,xlen,nfibs))
-    for i in xrange(xlen):
-        for j,fiber in enumerate(Fibers):
-            ix = ypos[:,i] - fiber.trace[i]
-            PL[:,i,j] = plaw(ix, plaw_coeff)
     for i in fiber_sel:
         for j in [0.2, 0.5, 0.8]:
             sub = fig.add_subplot(3, 3, plots[pos])
@@ -1257,20 +1879,14 @@ def check_fiber_profile(image, Fibers, outfile, fiber_sel=[5,58,107],
             normfits = np.zeros((image.shape + (len(Fibers),)))
             lmodel = np.zeros((image.shape + (len(Fibers),)))
             for k in xpos[0,minx:maxx]:
-                Fl = np.zeros((ylen, bins))
                 for fib, fiber in enumerate(fibers):
                     ix = ypos[:,k] - fiber.trace[k]
                     li = np.searchsorted(ix,low)
                     hi = np.searchsorted(ix,high)
-                    ytrace = ypos[li:hi,k] - Fibers[i].trace[k] 
-                    for l in xrange(bins):
-                        fun[l] = 1.0
-                        Fl[li:hi,l] = np.interp(ix[li:hi], binx, fun, left=0.0, 
-                                                right=0.0)
-                        fun[l] = 0.0
-                    lmodel[li:hi,k,fib] = (np.dot(Fl[li:hi,:],
-                                                  fiber.fibmodel[k,:]) 
-                                           + PL[li:hi,k,fib])
+                    ind, weight = get_hat_basis(ix[li:hi], binx)
+                    lmodel[li:hi,k,fib] = ((weight 
+                                            * fiber.fibmodel[k,ind]).sum(axis=1)
+                                           + plaw(ix[li:hi], plaw_coeff))
                     model[li:hi,k] += lmodel[li:hi,k,fib]
                     # TODO proper normalization
                     normfits[li:hi,k,fib] = fiber.spectrum[k] * 1.03
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Header Index
+------------
+Persistent index of the raw frame headers, to be used in conjuction with
+IFU reduction code, Panacea
+
+Finding the observations to reduce only needs a handful of keywords from
+each raw frame.  Those are kept in a sqlite database under the output
+directory, keyed on the path, modification time and size of the file, so
+only the headers of new or changed files are read from disk.  Headers are
+read block by block without touching the data, over a pool of threads so
+that the latency of a network filesystem is overlapped.
+
+"""
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import os.path as op
+import sqlite3
+from multiprocessing.pool import ThreadPool
+from astropy.io import fits
+
+__all__ = ["HEADER_INDEX_VERSION", "HEADER_INDEX_NAME", "HEADER_COLUMNS",
+           "SCAN_THREADS", "read_primary_header", "scan_headers",
+           "read_header_values", "HeaderIndex"]
+
+# Bump when the columns change; an index with another version is rebuilt
+HEADER_INDEX_VERSION = 1
+
+# File name of the index in the output directory
+HEADER_INDEX_NAME = 'header_index.sqlite'
+
+# Values kept for each raw frame, as used in the observation DataFrames
+HEADER_COLUMNS = ['Amp', 'Specid', 'Ifuslot', 'Ifuid']
+
+# Default number of threads reading headers at once
+SCAN_THREADS = 8
+
+# Size of a FITS block
+FITS_BLOCK = 2880
+
+
+def read_primary_header(fn):
+    '''
+    Read the primary header of "fn".  The file is read one FITS block at a
+    time up to the END card, so the data is never touched.  Files that do
+    not start with a plain FITS header (e.g., compressed files) are left to
+    fits.getheader.
+    '''
+    blocks = []
+    with open(fn, 'rb') as f:
+        while True:
+            block = f.read(FITS_BLOCK)
+            if (len(block) < FITS_BLOCK 
+                    or (not blocks and not block.startswith(b'SIMPLE'))):
+                return fits.getheader(fn)
+            blocks.append(block)
+            if any([block[i:i+8] == b'END     ' 
+                    for i in xrange(0, FITS_BLOCK, 80)]):
+                break
+    return fits.Header.fromstring(b''.join(blocks))
+
+
+def scan_headers(files, nthreads=SCAN_THREADS, func=read_primary_header):
+    '''
+    Apply "func" to each of "files" over a pool of "nthreads" threads.
+    
+    :param files:
+        List of file names
+    :param nthreads:
+        Number of files read at once; 1 reads them in turn
+    :param func:
+        Function of a file name, by default read_primary_header
+    :returns results:
+        List of the results in the order of "files"
+    '''
+    if nthreads <= 1 or len(files) <= 1:
+        return [func(fn) for fn in files]
+    pool = ThreadPool(min(nthreads, len(files)))
+    try:
+        return pool.map(func, files)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def read_header_values(fn):
+    '''
+    Read the values in HEADER_COLUMNS from the primary header of "fn".  Only
+    the header is read, not the image.
+    '''
+    hdr = read_primary_header(fn)
+    return (hdr['CCDPOS'].replace(' ', '') + hdr['CCDHALF'].replace(' ', ''),
+            '%03d' % hdr['SPECID'], '%03d' % hdr['IFUSLOT'],
+            hdr['IFUID'].replace(' ', ''))
+
+
+class HeaderIndex:
+    '''
+    Header values of raw frames, stored in a sqlite database.
+    '''
+    def __init__(self, fn):
+        '''
+        :param fn:
+            File name of the database, created if it does not exist
+        '''
+        self.fn = fn
+        self.hits = 0
+        self.misses = 0
+        # Other panacea processes may share the index, so wait for locks
+        self.db = sqlite3.connect(fn, timeout=60.)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != HEADER_INDEX_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS headers')
+            self.db.execute('PRAGMA user_version = %i'
+                            % HEADER_INDEX_VERSION)
+        self.db.execute('CREATE TABLE IF NOT EXISTS headers '
+                        '(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+                        '%s)' % ', '.join(['%s TEXT' % col
+                                            for col in HEADER_COLUMNS]))
+        self.db.commit()
+
+    def get_values(self, files, nthreads=SCAN_THREADS):
+        '''
+        Header values of each of "files".  Files that are not in the index,
+        or have changed since they were indexed, are read and added.
+
+        :param files:
+            List of raw frame file names
+        :param nthreads:
+            Number of threads reading the headers of new files
+        :returns values:
+            Dictionary with a list of the values over files for each of
+            HEADER_COLUMNS
+        '''
+        stats = [(op.abspath(fn), op.getmtime(fn), op.getsize(fn))
+                 for fn in files]
+        rows = {}
+        query = ('SELECT path, mtime, size, %s FROM headers WHERE path IN (%s)'
+                 % (', '.join(HEADER_COLUMNS), '%s'))
+        # Stay below the sqlite limit on the number of query parameters
+        for i in xrange(0, len(stats), 500):
+            paths = [stat[0] for stat in stats[i:i+500]]
+            for row in self.db.execute(query % ','.join('?' * len(paths)),
+                                       paths):
+                rows[row[0]] = row
+        values = []
+        missing = []
+        for i, stat in enumerate(stats):
+            row = rows.get(stat[0])
+            if row is not None and tuple(row[1:3]) == stat[1:]:
+                values.append(row[3:])
+            else:
+                values.append(None)
+                missing.append(i)
+        self.hits += len(files) - len(missing)
+        self.misses += len(missing)
+        new = []
+        for i, value in zip(missing, 
+                            scan_headers([files[i] for i in missing], 
+                                         nthreads, read_header_values)):
+            values[i] = value
+            new.append(stats[i] + value)
+        if new:
+            self.db.executemany('INSERT OR REPLACE INTO headers VALUES (%s)'
+                                % ','.join('?' * (3 + len(HEADER_COLUMNS))),
+                                new)
+            self.db.commit()
+        return dict([(col, [value[j] for value in values])
+                     for j, col in enumerate(HEADER_COLUMNS)])
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Master Frames
+-------------
+Node-local, memory mapped copies of the master bias, dark and pixel flat
+frames, to be used in conjuction with IFU reduction code, Panacea
+
+The first reader of a master frame on a node converts its FITS data to a
+native .npy file; every other process maps that file, so all of them share
+one copy of the frame in the page cache.  A copy is named after the master
+and its modification time and size.  When a new copy of a master is made,
+the older copies of the same master are removed.
+
+"""
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import numpy as np
+import os.path as op
+import os
+import glob
+import hashlib
+import tempfile
+from astropy.io import fits
+
+__all__ = ["MASTER_CACHE_DIR", "get_master_cache_name", "read_master_frame"]
+
+# Node-local directory for the memory mapped copies of the master frames
+MASTER_CACHE_DIR = op.join(tempfile.gettempdir(), 'panacea_masters')
+
+
+def get_master_cache_prefix(fn, cache_dir=MASTER_CACHE_DIR):
+    '''
+    Start of the names of all cached copies of the master frame "fn",
+    whatever its modification time.
+    '''
+    fn = op.abspath(fn)
+    return op.join(cache_dir, '%s_%s_'
+                   % (op.basename(fn)[:-5],
+                      hashlib.md5(fn.encode('utf-8')).hexdigest()))
+
+
+def get_master_cache_name(fn, cache_dir=MASTER_CACHE_DIR):
+    '''
+    File name of the cached copy of the master frame "fn".  The name depends
+    on the path, modification time and size of "fn", so a new master frame
+    gets a new copy.
+    '''
+    key = '%r:%i' % (op.getmtime(fn), op.getsize(fn))
+    return '%s%s.npy' % (get_master_cache_prefix(fn, cache_dir),
+                         hashlib.md5(key.encode('utf-8')).hexdigest())
+
+
+def remove_stale_copies(fn, cache_dir=MASTER_CACHE_DIR):
+    '''
+    Remove the cached copies of the master frame "fn" other than the
+    current one.  Processes that still map an old copy keep their pages.
+    '''
+    cn = get_master_cache_name(fn, cache_dir)
+    for old in glob.glob(get_master_cache_prefix(fn, cache_dir) + '*.npy'):
+        if old != cn:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+
+def read_master_frame(fn, cache_dir=MASTER_CACHE_DIR):
+    '''
+    Read a master bias, dark or pixel flat as a read-only, memory mapped
+    double precision array.
+
+    If there is no cached copy of the current "fn" in "cache_dir", it is
+    written and the older copies of "fn" are removed.  If the cache cannot
+    be written the converted frame is returned in memory instead.
+
+    :param fn:
+        File name of the master frame
+    :param cache_dir:
+        Directory for the cached copies
+    :returns data:
+        Image of the master frame
+    '''
+    cn = get_master_cache_name(fn, cache_dir)
+    if op.exists(cn):
+        try:
+            return np.load(cn, mmap_mode='r')
+        except (IOError, OSError):
+            # Removed in the meantime by a process with a newer master
+            pass
+    data = np.array(fits.getdata(fn), dtype=float)
+    # Write to a temporary file first so readers never see a partial file
+    tmp = cn + '.%i.tmp' % os.getpid()
+    try:
+        if not op.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.rename(tmp, cn)
+    except (IOError, OSError):
+        data.flags.writeable = False
+        return data
+    remove_stale_copies(fn, cache_dir)
+    return np.load(cn, mmap_mode='r')
@@ -16,6 +16,9 @@ import matplotlib
 matplotlib.use('agg')
 import time
 import re
+import traceback
+from multiprocessing import Pool
+from collections import OrderedDict
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -25,10 +28,14 @@ from pyhetdex.cure.distortion import Distortion
 from pyhetdex.het.ifu_centers import IFUCenter
 
 from args import parse_args
-from amplifier import Amplifier
+from amplifier import Amplifier, cal_cache, fiberextract_exposures
 from fiber_utils import get_model_image
-from utils import matrixCheby2D_7, biweight_filter, biweight_midvariance
-from utils import biweight_location
+from products import ProductFile, write_product, read_product
+from products import product_exists, start_product_writer
+from products import drain_product_writer
+from stage_cache import get_stage_cache_stats, add_stage_cache_stats
+from utils import matrixCheby2D_7, biweight_midvariance
+from utils import biweight_location, biweight_filter_rows, make_cube
 import config
 import glob
                       
@@ -71,21 +78,27 @@ def imstat(image1, image2, Fiber1, Fiber2, outname, fbins=50, fmax=8.):
     
                       
 def recreate_fiberextract(instr1, instr2, wavelim, disp):
+    '''
+    Resample the fiber spectra and sky-subtracted spectra of both sides to
+    the wavelength grid from wavelim[0] to wavelim[1] in steps of "disp",
+    with the fibers ordered by their trace in the middle column.  The 
+    fibers of each side are taken as whole arrays from its FiberSet.
+    '''
     col = int(instr1.D / 2)
     intv = [1, 1+instr1.D]
-    ypos = np.array([fiber.trace+intv[v] 
-                     for v,instr in enumerate([instr1, instr2]) 
-                     for fiber in instr.fibers])
-    allspec = np.array([fiber.spectrum / fiber.fiber_to_fiber * (1-fiber.dead)
-                        for v,instr in enumerate([instr1, instr2]) 
-                        for fiber in instr.fibers])                                       
-    allskys = np.array([(fiber.spectrum-fiber.sky_spectrum) 
-                            / fiber.fiber_to_fiber * (1-fiber.dead)
-                        for v,instr in enumerate([instr1, instr2]) 
-                        for fiber in instr.fibers])
-    allwave = np.array([fiber.wavelength 
-                        for v,instr in enumerate([instr1, instr2]) 
-                        for fiber in instr.fibers])
+    ypos, allspec, allskys, allwave = [], [], [], []
+    for v, instr in enumerate([instr1, instr2]):
+        fiberset = instr.get_fiberset()
+        alive = ~fiberset.get('dead')[:, np.newaxis]
+        spectrum = fiberset.get('spectrum')
+        fiber_to_fiber = fiberset.get('fiber_to_fiber')
+        ypos.append(fiberset.get('trace') + intv[v])
+        allspec.append(spectrum / fiber_to_fiber * alive)
+        allskys.append((spectrum - fiberset.get('sky_spectrum')) 
+                       / fiber_to_fiber * alive)
+        allwave.append(fiberset.get('wavelength'))
+    ypos, allspec, allskys, allwave = [np.vstack(x) for x in 
+                                       [ypos, allspec, allskys, allwave]]
     f1 = ypos[:,col]
     order = np.argsort(f1)[::-1]
     orderspec = allspec[order,:]
@@ -95,10 +108,12 @@ def recreate_fiberextract(instr1, instr2, wavelim, disp):
     a,b = orderspec.shape
     newspec = np.zeros((a, len(wv)))
     newskys = np.zeros((a, len(wv)))
+    diff_wave = np.diff(orderwave, axis=1)
+    # np.interp is already compiled per fiber; one call over all fibers 
+    # with shifted wavelengths was slower and not exact
     for i in xrange(a):
-        diff_wave = np.diff(orderwave[i,:])
         wi = orderwave[i,:-1]
-        df = np.interp(wv, wi, diff_wave, left=0.0, right=0.0)
+        df = np.interp(wv, wi, diff_wave[i], left=0.0, right=0.0)
         fl = np.interp(wv, wi, orderspec[i,:-1], left=0.0, right=0.0)
         fs = np.interp(wv, wi, orderskys[i,:-1], left=0.0, right=0.0)
         newspec[i,:] = np.where(df!=0, fl/df*disp, 0.0)
@@ -142,87 +157,81 @@ def recalculate_dist_coeff(D, instr1, instr2):
     D.wave_offsets = f0*0.
     return D
     
-def make_cube_file(args, filename, ifucen, scale, side):
+def make_cube_file(args, filename, ifucen, scale, side, products=None):
+    '''
+    Make the cube ("Cu") and collapsed cube ("Co") of the fiber extracted
+    image in "filename".  With "products", the image is read from and the
+    cubes are added to that ProductFile instead of separate files.
+    '''
     if args.instr.lower() == "lrs2":
         outname = op.join(op.dirname(filename),'Cu' + op.basename(filename))
         outname2 = op.join(op.dirname(filename),'Co' + op.basename(filename))
         print("Making Cube image for %s" %op.basename(outname))
         try:
-            F = fits.open(filename)
-        except IOError:
+            data, header = read_product(filename, products)
+        except (IOError, KeyError):
             print("Could not open %s" %filename)
             return None
-        data = F[0].data
         a,b = data.shape
-        x = np.arange(ifucen[:,1].min()-scale, ifucen[:,1].max()+scale, scale)
-        y = np.arange(ifucen[:,2].min()-scale, ifucen[:,2].max()+scale, scale)
-        xgrid, ygrid = np.meshgrid(x, y)
-        zgrid = np.zeros((b,)+xgrid.shape)
-        for k in xrange(b):
-            for i in xrange(len(x)):
-                for j in xrange(len(y)):
-                    d = np.sqrt((ifucen[:,1] - xgrid[j,i])**2 + 
-                                (ifucen[:,2] - ygrid[j,i])**2)
-                    w = np.exp(-1./2.*(d/1.)**2)
-                    sel = w > 1e-3
-                    zgrid[k,j,i] = np.sum(data[sel,k]*w[sel])/np.sum(w[sel])
+        zgrid = make_cube(data, ifucen, scale, 1., thresh=1e-3)
         hdu = fits.PrimaryHDU(np.array(zgrid, dtype='float32'))
         
         zcol = biweight_location(zgrid[int(b/3):int(2*b/3),:,:],axis=(0,))
-        hdu.header['CDELT3'] = F[0].header['CDELT1']
-        hdu.header['CRVAL3'] = F[0].header['CRVAL1']
-        hdu.header['CRPIX3'] = F[0].header['CRPIX1']
-        hdu.writeto(outname, overwrite=True)
+        hdu.header['CDELT3'] = header['CDELT1']
+        hdu.header['CRVAL3'] = header['CRVAL1']
+        hdu.header['CRPIX3'] = header['CRPIX1']
+        write_product(hdu, outname, products)
         hdu = fits.PrimaryHDU(np.array(zcol, dtype='float32'))
-        hdu.writeto(outname2, overwrite=True)
+        write_product(hdu, outname2, products)
     if args.instr.lower() == "virus":
         if side == "R":
             file2 =filename
             file1 = filename[:-6] + "L.fits"
         else:
             return None
-        if not op.exists(file2):
-            print("Could not open %s" %file2)
-            return None
-        if not op.exists(file1):
-            print("Could not open %s" %file1)
-            return None
         outname = op.join(op.dirname(filename),'Cu' 
                                           + op.basename(filename)[:-7]+'.fits')
         outname2 = op.join(op.dirname(filename),'Co' 
                                           + op.basename(filename)[:-7]+'.fits')
+        if products is None:
+            if not product_exists(file2):
+                print("Could not open %s" %file2)
+                return None
+            if not product_exists(file1):
+                print("Could not open %s" %file1)
+                return None
+            data1, header = read_product(file1)
+            data2, header = read_product(file2)
+            extnames = [None, None]
+        else:
+            # The L side was written to its own product file before
+            extname = products.get_extname(file2)
+            try:
+                data2, header = products.read(extname)
+                data1, header = products.read(extname, 
+                                              products.stem[:-6] + "L.fits")
+            except (IOError, KeyError):
+                print("Could not find %s for both sides" %extname)
+                return None
+            extnames = ['CU' + extname, 'CO' + extname]
         print("Making Cube image for %s" %op.basename(outname))
-        F2 = fits.open(file2)
-        F1 = fits.open(file1)
-        data1 = F1[0].data
-        data2 = F2[0].data
         a,b = data1.shape
         data = np.vstack([data1,data2])
         if len(data[:,0]) != len(ifucen[:,1]):
             print("Length of IFUcen file not the same as Fe. Skipping Cube")
             return None
-        x = np.arange(ifucen[:,1].min()-scale, ifucen[:,1].max()+scale, scale)
-        y = np.arange(ifucen[:,2].min()-scale, ifucen[:,2].max()+scale, scale)
-        xgrid, ygrid = np.meshgrid(x, y)
-        zgrid = np.zeros((b,)+xgrid.shape)
-        for k in xrange(b):
-            for i in xrange(len(x)):
-                for j in xrange(len(y)):
-                    d = np.sqrt((ifucen[:,1] - xgrid[j,i])**2 + 
-                                (ifucen[:,2] - ygrid[j,i])**2)
-                    w = np.exp(-1./2.*(d/(2./2.35*2.))**2)
-                    sel = w > 1e-3
-                    zgrid[k,j,i] = np.sum(data[sel,k]*w[sel])/np.sum(w[sel])
+        zgrid = make_cube(data, ifucen, scale, 2./2.35*2., thresh=1e-3)
         hdu = fits.PrimaryHDU(np.array(zgrid, dtype='float32'))
         zcol = biweight_location(zgrid[int(b/3):int(2*b/3),:,:],axis=(0,))
-        hdu.header['CDELT3'] = F1[0].header['CDELT1']
-        hdu.header['CRVAL3'] = F1[0].header['CRVAL1']
-        hdu.header['CRPIX3'] = F1[0].header['CRPIX1']
-        hdu.writeto(outname, overwrite=True)
+        hdu.header['CDELT3'] = header['CDELT1']
+        hdu.header['CRVAL3'] = header['CRVAL1']
+        hdu.header['CRPIX3'] = header['CRPIX1']
+        write_product(hdu, outname, products, extnames[0])
         hdu = fits.PrimaryHDU(np.array(zcol, dtype='float32'))
-        hdu.writeto(outname2, overwrite=True)
+        write_product(hdu, outname2, products, extnames[1])
     
-def make_error_frame(image1, image2, mask1, mask2, header, outname):
+def make_error_frame(image1, image2, mask1, mask2, header, outname, 
+                     products=None):
     print("Making error image for %s" %op.basename(outname))
     a,b = image1.shape
     new = np.zeros((a*2,b))
@@ -232,19 +241,16 @@ def make_error_frame(image1, image2, mask1, mask2, header, outname):
     new[a:,:] = image2
     mas[:a,:] = mask1
     mas[a:,:] = mask2
-    err = np.zeros(new.shape)
-    for i in xrange(2*a):
-        err[i,:] = np.where(mas[i,:]<0, mas[i,:], 
-                            biweight_filter(new[i,:], 31, 
-                                            func=biweight_midvariance))
+    err = np.where(mas<0, mas, biweight_filter_rows(new, 31, 
+                                              func=biweight_midvariance))
     hdu = fits.PrimaryHDU(np.array(err, dtype='float32'), header=header)
     hdu.header.remove('BIASSEC')
     hdu.header.remove('TRIMSEC')
     hdu.header['DATASEC'] = '[%i:%i,%i:%i]' %(1,b,1,2*a)
     outname = op.join(op.dirname(outname), 'e.' + op.basename(outname))
-    hdu.writeto(outname, overwrite=True)   
+    write_product(hdu, outname, products)
     
-def make_fiber_image(Fe, header, outname, args, amp):
+def make_fiber_image(Fe, header, outname, args, amp, products=None):
     print("Making Fiberextract image for %s" %op.basename(outname))
     a,b = Fe.shape
     hdu = fits.PrimaryHDU(np.array(Fe, dtype='float32'), header=header)
@@ -255,14 +261,12 @@ def make_fiber_image(Fe, header, outname, args, amp):
     hdu.header['CDELT1'] = args.disp[amp]
     hdu.header['CD1_1'] = args.disp[amp]
     hdu.header['CRPIX1'] = 1
-    hdu.writeto(outname, overwrite=True)    
+    write_product(hdu, outname, products)
 
-def make_fiber_error(Fe, header, outname, args, amp):
+def make_fiber_error(Fe, header, outname, args, amp, products=None):
     print("Making Fiberextract image for %s" %op.basename(outname))
     a,b = Fe.shape
-    err = np.zeros(Fe.shape)
-    for i in xrange(a):
-        err[i,:] = biweight_filter(Fe[i,:], 21, func=biweight_midvariance)
+    err = biweight_filter_rows(Fe, 21, func=biweight_midvariance)
     hdu = fits.PrimaryHDU(np.array(err, dtype='float32'), header=header)
     hdu.header.remove('BIASSEC')
     hdu.header.remove('TRIMSEC')
@@ -272,9 +276,9 @@ def make_fiber_error(Fe, header, outname, args, amp):
     hdu.header['CD1_1'] = args.disp[amp]
     hdu.header['CRPIX1'] = 1
     outname = op.join(op.dirname(outname), 'e.' + op.basename(outname))
-    hdu.writeto(outname, overwrite=True)  
+    write_product(hdu, outname, products)
     
-def make_spectrograph_image(image1, image2, header, outname):
+def make_spectrograph_image(image1, image2, header, outname, products=None):
     print("Making spectrograph image for %s" %op.basename(outname))
     a,b = image1.shape
     new = np.zeros((a*2,b))
@@ -284,215 +288,343 @@ def make_spectrograph_image(image1, image2, header, outname):
     hdu.header.remove('BIASSEC')
     hdu.header.remove('TRIMSEC')
     hdu.header['DATASEC'] = '[%i:%i,%i:%i]' %(1,b,1,2*a)
-    hdu.writeto(outname, overwrite=True)    
+    write_product(hdu, outname, products)
 
-def make_amplifier_image(image, header, outname):
+def make_amplifier_image(image, header, outname, products=None):
     print("Making amplifier image for %s" %op.basename(outname))
     a,b = image.shape
     hdu = fits.PrimaryHDU(np.array(image, dtype='float32'), header=header)
     hdu.header.remove('BIASSEC')
     hdu.header.remove('TRIMSEC')
     hdu.header['DATASEC'] = '[%i:%i,%i:%i]' %(1,b,1,a)
-    hdu.writeto(outname, overwrite=True) 
+    write_product(hdu, outname, products)
             
-def reduce_science(args):
+def get_science_ifucen(args, amp, ind):
+    '''
+    IFU fiber positions for row "ind" of args.sci_df, used for the cubes.
+    '''
+    if args.instr == "virus":
+        if not args.use_trace_ref:
+            ifucen = np.loadtxt(op.join(args.configdir, 
+                                        'IFUcen_files', 
+                                        args.ifucen_fn[amp][0]
+                                        + args.sci_df['Ifuid'][ind] 
+                                        + '.txt'), 
+                                        usecols=[0,1,2,4], 
+                                   skiprows=args.ifucen_fn[amp][1])
+
+        else:
+            if args.sci_df['Ifuid'][ind] == '004':
+                ifucen = np.loadtxt(op.join(args.configdir,
+                                        'IFUcen_files',
+                                        'IFUcen_HETDEX_reverse_R.txt'),
+                                        usecols=[0,1,2,4],
+                                   skiprows=args.ifucen_fn[amp][1])
+                ifucen[224:,:] = ifucen[-1:223:-1,:]
+            else:
+                ifucen = np.loadtxt(op.join(args.configdir,
+                                        'IFUcen_files',
+                                        'IFUcen_HETDEX.txt'),
+                                        usecols=[0,1,2,4],
+                                   skiprows=args.ifucen_fn[amp][1])
+    else:
+        ifucen = np.loadtxt(op.join(args.configdir, 'IFUcen_files', 
+                            args.ifucen_fn[amp][0]), 
+                  usecols=[0,1,2], skiprows=args.ifucen_fn[amp][1])
+    return ifucen
+
+
+def get_science_amplifiers(args, spec, amp, ind):
+    '''
+    The two Amplifiers of one science exposure and spectrograph side: "amp"
+    and its partner in config.Amp_dict for row "ind" of args.sci_df.
+    '''
+    if args.check_if_twi_exists:
+        fn = op.join(args.twi_dir,'fiber_*_%s_%s_%s_%s.pkl' %(spec, 
+                                       args.sci_df['Ifuslot'][ind],
+                                         args.sci_df['Ifuid'][ind],
+                                                              amp))
+        calfiles = glob.glob(fn)
+        if not calfiles:
+            print("No cals found for %s,%s: %s"
+                  %(spec, amp, args.sci_df['Files'][ind]))
+            print("If you want to produce cals include "
+                  "--reduce_twi")
+    if args.stage_cache:
+        stage_cache = op.join(args.output, 'stage_cache')
+    else:
+        stage_cache = None
+    stage_cache_size = int(args.stage_cache_size * 1024**3)
+    sci1 = Amplifier(args.sci_df['Files'][ind],
+                     args.sci_df['Output'][ind],
+                     calpath=args.twi_dir, skypath=args.sky_dir,
+                     debug=False, refit=False, 
+                     dark_mult=args.dark_mult[amp],
+                     darkpath=args.darkdir, biaspath=args.biasdir,
+                     virusconfig=args.configdir, 
+                     specname=args.specname[amp],
+                     use_pixelflat=(args.pixelflats<1),
+                     use_trace_ref=args.use_trace_ref,
+                     calculate_shift=args.adjust_trace,
+                     fiber_date=args.fiber_date,
+                     cont_smooth=args.cont_smooth,
+                     use_factors=args.extraction_factors,
+                     binned_master=args.binned_master,
+                     float32=args.float32,
+                     stage_cache=stage_cache,
+                     stage_cache_size=stage_cache_size)
+    sci2 = Amplifier(args.sci_df['Files'][ind].replace(amp, 
+                                          config.Amp_dict[amp][0]),
+                     args.sci_df['Output'][ind],
+                     calpath=args.twi_dir, skypath=args.sky_dir, 
+                     debug=False, refit=False, 
+                 dark_mult=args.dark_mult[config.Amp_dict[amp][0]],
+                     darkpath=args.darkdir, biaspath=args.biasdir,
+                     virusconfig=args.configdir, 
+                     specname=args.specname[amp],
+                     use_pixelflat=(args.pixelflats<1),
+                     use_trace_ref=args.use_trace_ref,
+                     calculate_shift=args.adjust_trace,
+                     fiber_date=args.fiber_date,
+                     cont_smooth=args.cont_smooth,
+                     use_factors=args.extraction_factors,
+                     binned_master=args.binned_master,
+                     float32=args.float32,
+                     stage_cache=stage_cache,
+                     stage_cache_size=stage_cache_size)
+    return sci1, sci2
+
+
+def write_science_products(args, amp, ind, sci1, sci2):
+    '''
+    Write the frames, fiber extracted images and cubes of one reduced 
+    science exposure and spectrograph side.  With args.single_product they
+    are the extensions of one ProductFile instead of separate files.
+    '''
+    ifucen = get_science_ifucen(args, amp, ind)
+    path = args.sci_df['Output'][ind]
+    stem = '%s_%s_sci_%s.fits' %(
+              op.basename(args.sci_df['Files'][ind]).split('_')[0],
+                                       args.sci_df['Ifuslot'][ind], 
+                                          config.Amp_dict[amp][1])
+    if args.single_product:
+        products = ProductFile(path, stem, sci1.header, 
+                               compress=args.compress_products)
+    else:
+        products = None
+    outname = op.join(path, 'S' + stem)
+    make_spectrograph_image(sci1.clean_image, sci2.clean_image, 
+                            sci1.header, outname, products)
+    make_spectrograph_image(sci1.error, sci2.error, 
+                            sci1.header, op.join(path, 'ee.S' + stem), 
+                            products)
+    make_error_frame(sci1.clean_image, sci2.clean_image, sci1.mask,
+                     sci2.mask, sci1.header, outname, products)
+    outname = op.join(path, 'cS' + stem)
+    make_spectrograph_image(np.where(sci1.mask==0, 
+                                     sci1.clean_image, 0.0),
+                            np.where(sci2.mask==0, 
+                                     sci2.clean_image, 0.0),
+                            sci1.header, outname, products)
+    make_error_frame(sci1.clean_image, sci2.clean_image, sci1.mask,
+                     sci2.mask, sci1.header, outname, products)
+    outname = op.join(path, 'CsS' + stem)
+    make_spectrograph_image(sci1.continuum_sub, sci2.continuum_sub, 
+                            sci1.header, outname, products)
+    make_error_frame(sci1.continuum_sub, sci2.continuum_sub, 
+                     sci1.mask, sci2.mask, sci1.header, outname, products)
+    outname = op.join(path, 'cCsS' + stem)
+    make_spectrograph_image(np.where(sci1.mask==0, 
+                                     sci1.continuum_sub, 0.0),
+                            np.where(sci2.mask==0, 
+                                     sci2.continuum_sub, 0.0),
+                            sci1.header, outname, products)
+    make_error_frame(sci1.continuum_sub, sci2.continuum_sub,
+                     sci1.mask, sci2.mask, sci1.header, outname, products)
+    outname = op.join(path, 'cCsS' + stem[:-5] + '_imstat.png')
+    imstat(sci1.residual, sci2.residual, sci1.fibers,
+           sci2.fibers, outname)
+    Fe, FeS = recreate_fiberextract(sci1, sci2, 
+                                    wavelim=args.wvl_dict[amp], 
+                                    disp=args.disp[amp])
+    outname = op.join(path, 'Fe' + stem)
+    make_fiber_image(Fe, sci1.header, outname, args, amp, products)
+    make_fiber_error(Fe, sci1.header, outname, args, amp, products)
+    make_cube_file(args, outname, ifucen, args.cube_scale, 
+                   config.Amp_dict[amp][1], products)
+    outname = op.join(path, 'FeS' + stem)
+    make_fiber_image(FeS, sci1.header, outname, args, amp, products)
+    make_fiber_error(FeS, sci1.header, outname, args, amp, products)
+    make_cube_file(args, outname, ifucen, args.cube_scale, 
+                   config.Amp_dict[amp][1], products)
+    if products is not None:
+        products.write()
+    if args.save_sci_fibers:
+        sci1.save_fibers()
+        sci2.save_fibers()
+    if args.save_sci_amplifier:
+        sci1.save()
+        sci2.save()
+
+
+def reduce_science_unit(args, spec, amp, inds):
+    '''
+    Reduce science exposures for one spectrograph side: the amplifier "amp"
+    and its partner in config.Amp_dict for the rows "inds" of args.sci_df.
+    The exposures go through each step together and are first 
+    fiberextracted with fiberextract_exposures, so exposures that share a 
+    calibration are extracted as one multi-exposure problem.  After 
+    clean_cosmics() only the columns with a changed mask are extracted 
+    again.  With args.stage_cache, a stage whose inputs did not change 
+    since an earlier run is loaded from the stage cache instead.
+    '''
+    if args.debug:
+        print("Working on Sci for %s, %s" %(spec, amp)) 
+    scis = []
+    for ind in inds:
+        scis.extend(get_science_amplifiers(args, spec, amp, ind))
+    for sci in scis:
+        if not sci.load_stage('prepare'):
+            sci.prepare_image()
+            sci.save_stage('prepare')
+        sci.load_all_cal()
+        sci.chain_stage('calibration')
+        if args.adjust_trace and not sci.load_stage('trace'):
+            sci.refit=True
+            sci.get_trace()
+            sci.refit=False
+            sci.save_stage('trace')
+    todo = [sci for sci in scis if not sci.load_stage('extract')]
+    fiberextract_exposures(todo)
+    for sci in todo:
+        sci.save_stage('extract')
+    for sci in scis:
+        if args.refit_fiber_to_fiber and not sci.load_stage('fiber_to_fiber'):
+            sci.refit=True
+            sci.get_fiber_to_fiber()
+            sci.refit=False
+            sci.save_stage('fiber_to_fiber')
+        if not sci.load_stage('sky'):
+            sci.sky_subtraction()
+            sci.save_stage('sky')
+        if not sci.load_stage('cosmics'):
+            sci.clean_cosmics()
+            sci.save_stage('cosmics')
+    for sci in scis:
+        if not sci.load_stage('reextract'):
+            sci.refiberextract()
+            sci.save_stage('reextract')
+        if not sci.load_stage('sky'):
+            sci.sky_subtraction()
+            sci.save_stage('sky')
+    for i, ind in enumerate(inds):
+        write_science_products(args, amp, ind, scis[2*i], scis[2*i+1])
+    if args.debug:
+        print("Finished working on Sci for %s, %s" %(spec, amp))
+
+
+# Arguments for the reduce_science workers, set by init_science_worker
+_science_args = {}
+
+
+def init_science_worker(args):
+    _science_args['args'] = args
+    start_product_writer(args.write_threads, args.write_queue)
+    
+
+def reduce_science_exposure(args, spec, sides):
+    '''
+    Reduce the spectrograph sides of one unit of work, made by 
+    get_science_units.  "sides" is a tuple of (amp, inds) in the order of 
+    config.Amps, so the L side products are written before the R side 
+    cubes read them.
+    '''
+    for amp, inds in sides:
+        reduce_science_unit(args, spec, amp, inds)
+
+
+def reduce_science_worker(unit):
+    '''
+    Run reduce_science_exposure in a worker process.  Errors are caught so 
+    one failed unit does not stop the others; the traceback is returned, 
+    with the stage cache counts of the unit.
+    '''
+    get_stage_cache_stats(reset=True)
+    try:
+        reduce_science_exposure(_science_args['args'], *unit)
+        # The products of the unit are written before it is reported done
+        drain_product_writer(close=False)
+    except (Exception, SystemExit):
+        return unit, traceback.format_exc(), get_stage_cache_stats()
+    return unit, None, get_stage_cache_stats()
+
+
+def get_science_units(args):
+    '''
+    Group the science exposures into units of work of (spec, sides), where
+    sides is a tuple of (amp, inds) for the rows "inds" of args.sci_df.
+    Both sides of an exposure are in the same unit, as the VIRUS cubes of 
+    the R side are built from the L side products.  With 
+    args.batch_exposures, a unit holds all exposures of an IFU so they are
+    fiberextracted together.
+    '''
+    units = []
     for spec in args.specid:
         spec_ind_sci = np.where(args.sci_df['Specid'] == spec)[0]
+        groups = OrderedDict()
         for amp in config.Amps:
             amp_ind_sci = np.where(args.sci_df['Amp'] == amp)[0]
             sci_sel = np.intersect1d(spec_ind_sci, amp_ind_sci) 
             for ind in sci_sel:
-                if args.instr == "virus":
-                    if not args.use_trace_ref:
-                        ifucen = np.loadtxt(op.join(args.configdir, 
-                                                    'IFUcen_files', 
-                                                    args.ifucen_fn[amp][0]
-                                                    + args.sci_df['Ifuid'][ind] 
-                                                    + '.txt'), 
-                                                    usecols=[0,1,2,4], 
-                                               skiprows=args.ifucen_fn[amp][1])
-                        
-                    else:
-                        if args.sci_df['Ifuid'][ind] == '004':
-                            ifucen = np.loadtxt(op.join(args.configdir,
-                                                    'IFUcen_files',
-                                                    'IFUcen_HETDEX_reverse_R.txt'),
-                                                    usecols=[0,1,2,4],
-                                               skiprows=args.ifucen_fn[amp][1])
-                            ifucen[224:,:] = ifucen[-1:223:-1,:]
-                        else:
-                            ifucen = np.loadtxt(op.join(args.configdir,
-                                                    'IFUcen_files',
-                                                    'IFUcen_HETDEX.txt'),
-                                                    usecols=[0,1,2,4],
-                                               skiprows=args.ifucen_fn[amp][1])
+                ifuslot = args.sci_df['Ifuslot'][ind]
+                if args.batch_exposures:
+                    key = ifuslot
                 else:
-                    ifucen = np.loadtxt(op.join(args.configdir, 'IFUcen_files', 
-                                        args.ifucen_fn[amp][0]), 
-                              usecols=[0,1,2], skiprows=args.ifucen_fn[amp][1])
-                if args.debug:
-                    print("Working on Sci for %s, %s" %(spec, amp)) 
-                if args.check_if_twi_exists:
-                    fn = op.join(args.twi_dir,'fiber_*_%s_%s_%s_%s.pkl' %(spec, 
-                                                   args.sci_df['Ifuslot'][ind],
-                                                     args.sci_df['Ifuid'][ind],
-                                                                          amp))
-                    calfiles = glob.glob(fn)
-                    if not calfiles:
-                        print("No cals found for %s,%s: %s"
-                              %(spec, amp, args.sci_df['Files'][ind]))
-                        print("If you want to produce cals include "
-                              "--reduce_twi")
-                  
-                sci1 = Amplifier(args.sci_df['Files'][ind],
-                                 args.sci_df['Output'][ind],
-                                 calpath=args.twi_dir, skypath=args.sky_dir,
-                                 debug=False, refit=False, 
-                                 dark_mult=args.dark_mult[amp],
-                                 darkpath=args.darkdir, biaspath=args.biasdir,
-                                 virusconfig=args.configdir, 
-                                 specname=args.specname[amp],
-                                 use_pixelflat=(args.pixelflats<1),
-                                 use_trace_ref=args.use_trace_ref,
-                                 calculate_shift=args.adjust_trace,
-                                 fiber_date=args.fiber_date,
-                                 cont_smooth=args.cont_smooth)
-                #sci1.load_fibers()
-                #if sci1.fibers and not args.start_from_scratch:
-                #    if sci1.fibers[0].spectrum is not None:
-                #        sci1.prepare_image()
-                #        sci1.sky_subtraction()
-                #        sci1.clean_cosmics()
-                #else:
-                sci1.load_all_cal()
-                if args.adjust_trace:
-                    sci1.refit=True
-                    sci1.get_trace()
-                    sci1.refit=False
-                sci1.fiberextract()
-                if args.refit_fiber_to_fiber:
-                    sci1.refit=True
-                    sci1.get_fiber_to_fiber()
-                    sci1.refit=False
-                sci1.sky_subtraction()
-                sci1.clean_cosmics()
-                sci1.fiberextract()
-                sci1.sky_subtraction()
-                sci2 = Amplifier(args.sci_df['Files'][ind].replace(amp, 
-                                                      config.Amp_dict[amp][0]),
-                                 args.sci_df['Output'][ind],
-                                 calpath=args.twi_dir, skypath=args.sky_dir, 
-                                 debug=False, refit=False, 
-                             dark_mult=args.dark_mult[config.Amp_dict[amp][0]],
-                                 darkpath=args.darkdir, biaspath=args.biasdir,
-                                 virusconfig=args.configdir, 
-                                 specname=args.specname[amp],
-                                 use_pixelflat=(args.pixelflats<1),
-                                 use_trace_ref=args.use_trace_ref,
-                                 calculate_shift=args.adjust_trace,
-                                 fiber_date=args.fiber_date,
-                                 cont_smooth=args.cont_smooth)
-                #sci2.load_fibers()
-                #if sci2.fibers and not args.start_from_scratch:
-                #    if sci2.fibers[0].spectrum is not None:
-                #        sci2.prepare_image()
-                #        sci2.sky_subtraction()
-                #        sci2.clean_cosmics()
-                #else:
-                sci2.load_all_cal()
-                if args.adjust_trace:
-                    sci2.refit=True
-                    sci2.get_trace()
-                    sci2.refit=False
-                sci2.fiberextract()
-                if args.refit_fiber_to_fiber:
-                    sci2.refit=True
-                    sci2.get_fiber_to_fiber()
-                    sci2.refit=False
-                sci2.sky_subtraction()
-                sci2.clean_cosmics()
-                sci2.fiberextract()
-                sci2.sky_subtraction()
-                outname = op.join(args.sci_df['Output'][ind],
-                                  'S%s_%s_sci_%s.fits' %(
-                          op.basename(args.sci_df['Files'][ind]).split('_')[0],
-                                                   args.sci_df['Ifuslot'][ind], 
-                                                      config.Amp_dict[amp][1]))
-                make_spectrograph_image(sci1.clean_image, sci2.clean_image, 
-                                        sci1.header, outname)
-                make_spectrograph_image(sci1.error, sci2.error, 
-                                        sci1.header, op.join(op.dirname(outname), 'ee.'+op.basename(outname)))                   
-                make_error_frame(sci1.clean_image, sci2.clean_image, sci1.mask,
-                                 sci2.mask, sci1.header, outname)
-                outname = op.join(args.sci_df['Output'][ind],
-                                  'cS%s_%s_sci_%s.fits' %(
-                          op.basename(args.sci_df['Files'][ind]).split('_')[0],
-                                                   args.sci_df['Ifuslot'][ind], 
-                                                      config.Amp_dict[amp][1]))
-                make_spectrograph_image(np.where(sci1.mask==0, 
-                                                 sci1.clean_image, 0.0),
-                                        np.where(sci2.mask==0, 
-                                                 sci2.clean_image, 0.0),
-                                        sci1.header, outname)
-                make_error_frame(sci1.clean_image, sci2.clean_image, sci1.mask,
-                                 sci2.mask, sci1.header, outname)
-                outname = op.join(args.sci_df['Output'][ind],
-                                  'CsS%s_%s_sci_%s.fits' %(
-                          op.basename(args.sci_df['Files'][ind]).split('_')[0],
-                                                   args.sci_df['Ifuslot'][ind], 
-                                                      config.Amp_dict[amp][1]))
-                make_spectrograph_image(sci1.continuum_sub, sci2.continuum_sub, 
-                                        sci1.header, outname)
-                make_error_frame(sci1.continuum_sub, sci2.continuum_sub, 
-                                 sci1.mask, sci2.mask, sci1.header, outname)
-                outname = op.join(args.sci_df['Output'][ind],
-                                  'cCsS%s_%s_sci_%s.fits' %(
-                          op.basename(args.sci_df['Files'][ind]).split('_')[0],
-                                                   args.sci_df['Ifuslot'][ind], 
-                                                      config.Amp_dict[amp][1]))
-                make_spectrograph_image(np.where(sci1.mask==0, 
-                                                 sci1.continuum_sub, 0.0),
-                                        np.where(sci2.mask==0, 
-                                                 sci2.continuum_sub, 0.0),
-                                        sci1.header, outname)
-                make_error_frame(sci1.continuum_sub, sci2.continuum_sub,
-                                 sci1.mask, sci2.mask, sci1.header, outname)
-                outname = op.join(args.sci_df['Output'][ind],
-                                  'cCsS%s_%s_sci_%s_imstat.png' %(
-                          op.basename(args.sci_df['Files'][ind]).split('_')[0],
-                                                   args.sci_df['Ifuslot'][ind], 
-                                                      config.Amp_dict[amp][1]))
-                imstat(sci1.residual, sci2.residual, sci1.fibers,
-                       sci2.fibers, outname)
-                Fe, FeS = recreate_fiberextract(sci1, sci2, 
-                                                wavelim=args.wvl_dict[amp], 
-                                                disp=args.disp[amp])
-                outname = op.join(args.sci_df['Output'][ind],
-                                  'Fe%s_%s_sci_%s.fits' %(
-                          op.basename(args.sci_df['Files'][ind]).split('_')[0],
-                                                   args.sci_df['Ifuslot'][ind], 
-                                                      config.Amp_dict[amp][1]))
-                make_fiber_image(Fe, sci1.header, outname, args, amp)
-                make_fiber_error(Fe, sci1.header, outname, args, amp)
-                make_cube_file(args, outname, ifucen, args.cube_scale, 
-                               config.Amp_dict[amp][1])
-                outname = op.join(args.sci_df['Output'][ind],
-                                  'FeS%s_%s_sci_%s.fits' %(
-                          op.basename(args.sci_df['Files'][ind]).split('_')[0],
-                                                   args.sci_df['Ifuslot'][ind], 
-                                                      config.Amp_dict[amp][1]))
-                make_fiber_image(FeS, sci1.header, outname, args, amp)
-                make_fiber_error(FeS, sci1.header, outname, args, amp)
-                make_cube_file(args, outname, ifucen, args.cube_scale, 
-                               config.Amp_dict[amp][1])
-                if args.save_sci_fibers:
-                    sci1.save_fibers()
-                    sci2.save_fibers()
-                if args.save_sci_amplifier:
-                    sci1.save()
-                    sci2.save()
-                if args.debug:
-                    print("Finished working on Sci for %s, %s" %(spec, amp))                    
+                    # The products of both sides share a directory and the
+                    # exposure part of the stem (see write_science_products)
+                    key = (args.sci_df['Output'][ind], ifuslot,
+                           op.basename(args.sci_df['Files'][ind]).split('_')[0])
+                sides = groups.setdefault(key, OrderedDict())
+                sides.setdefault(amp, []).append(ind)
+        for sides in groups.values():
+            units.append((spec, tuple((amp, tuple(inds)) 
+                                      for amp, inds in sides.items())))
+    return units
+    
+
+def reduce_science(args):
+    '''
+    Reduce all science exposures.  With args.jobs > 1 the units of 
+    get_science_units are reduced in a pool of processes and the results 
+    are reported in the same order as the serial loop.
+    '''
+    units = get_science_units(args)
+    if args.jobs > 1:
+        pool = Pool(processes=args.jobs, initializer=init_science_worker,
+                    initargs=(args,))
+        failed = 0
+        try:
+            for unit, error, stats in pool.imap(reduce_science_worker, 
+                                                units):
+                add_stage_cache_stats(stats)
+                spec, sides = unit
+                files = ', '.join([args.sci_df['Files'][ind] 
+                                   for amp, inds in sides for ind in inds])
+                amps = ', '.join([amp for amp, inds in sides])
+                if error is None:
+                    print("Finished Sci for %s, %s: %s" %(spec, amps, files))
+                else:
+                    failed += 1
+                    print("Failed Sci for %s, %s: %s" %(spec, amps, files))
+                    print(error)
+        finally:
+            pool.close()
+            pool.join()
+        if failed:
+            print("%i of %i science units failed" %(failed, len(units)))
+    else:
+        for unit in units:
+            reduce_science_exposure(args, *unit)
                 
 
 def reduce_twighlight(args):
@@ -522,7 +654,11 @@ def reduce_twighlight(args):
                                  power=args.fibmodel_pow,
                                  use_trace_ref=args.use_trace_ref,
                                  default_fib = args.default_fib,
-                                 wave_nbins = args.wave_nbins)
+                                 wave_nbins = args.wave_nbins,
+                                 fibmodel_nproc = args.fibmodel_nproc,
+                                 use_factors = args.extraction_factors,
+                                 binned_master = args.binned_master,
+                                 float32 = args.float32)
                 #twi1.load_fibers()
                 twi1.get_fiber_to_fiber()
                 twi1.sky_subtraction()
@@ -543,14 +679,20 @@ def reduce_twighlight(args):
                                  power=args.fibmodel_pow,
                                  use_trace_ref=args.use_trace_ref,
                                  default_fib = args.default_fib,
-                                 wave_nbins = args.wave_nbins)
+                                 wave_nbins = args.wave_nbins,
+                                 fibmodel_nproc = args.fibmodel_nproc,
+                                 use_factors = args.extraction_factors,
+                                 binned_master = args.binned_master,
+                                 float32 = args.float32)
                 #twi2.load_fibers()
                 twi2.get_fiber_to_fiber()
                 twi2.sky_subtraction()
                 image1 = get_model_image(twi1.image, twi1.fibers, 
-                                         'fiber_to_fiber', debug=twi1.debug)
+                                         'fiber_to_fiber', debug=twi1.debug,
+                                         operator=twi1.get_profile_operator())
                 image2 = get_model_image(twi2.image, twi2.fibers, 
-                                         'fiber_to_fiber', debug=twi2.debug)
+                                         'fiber_to_fiber', debug=twi2.debug,
+                                         operator=twi2.get_profile_operator())
                 outname = op.join(args.twi_df['Output'][ind], 
                                   'mastertrace_%s_%s.fits' 
                                   %(args.twi_df['Specid'][ind],
@@ -804,6 +946,7 @@ def custom(args):
              
 def main():
     args = parse_args()
+    start_product_writer(args.write_threads, args.write_queue)
     if args.debug:
         t1 = time.time()
     if args.make_masterbias:
@@ -818,8 +961,15 @@ def main():
         reduce_twighlight(args)
     if args.reduce_sci:
         reduce_science(args)                                        
+    drain_product_writer()
+    if args.reduce_sci and args.stage_cache:
+        stats = get_stage_cache_stats()
+        print("Stage cache: %i stages loaded, %i run" 
+              %(stats['hits'], stats['misses']))
     if args.debug:
         t2=time.time()
+        print("Calibration cache: %i hits, %i misses, %0.1f MB" 
+              %(cal_cache.hits, cal_cache.misses, cal_cache.nbytes/1024.**2))
         print("Total Time taken: %0.2f s" %(t2-t1))
     
 
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Product File
+------------
+Multi-extension output of the science products, to be used in conjuction
+with IFU reduction code, Panacea
+
+By default every product of a science exposure and spectrograph side
+("S", "e.S", "cS", "Fe", ...) is written to its own FITS file with a full
+copy of the header.  A ProductFile collects them instead as the named
+extensions of one file.  The header shared by the products is kept once in
+the primary HDU and the extensions only hold the keywords that differ,
+with INHERIT = T.  The extensions can be Rice tile compressed.
+
+Products are written through write_product.  Once start_product_writer has
+been called, the writing happens in background threads fed by a bounded
+queue, so the reduction can go on with the next exposure.  A full queue
+blocks the caller until a write is done.
+
+Every product is written to a temporary file next to its target and renamed
+into place, so a reader in another process sees either the whole file or 
+no file.
+
+
+"""
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import numpy as np
+import os
+import os.path as op
+import sys
+import threading
+import traceback
+import Queue
+from astropy.io import fits
+
+__all__ = ["PRODUCT_PREFIX", "ProductFile", "ProductWriter", 
+           "start_product_writer", "drain_product_writer", "write_product", 
+           "read_product", "product_exists", "writeto_atomic"]
+
+# Prefix of the product file name, followed by the name the products share
+PRODUCT_PREFIX = 'P'
+
+# Commentary keywords are not compared with the primary header
+COMMENTARY = ['COMMENT', 'HISTORY', '']
+
+# Keywords that describe the data and are set by the extension itself
+STRUCTURAL = ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'EXTEND', 'PCOUNT', 
+              'GCOUNT', 'EXTNAME', 'BSCALE', 'BZERO']
+
+
+class ProductFile:
+    '''
+    All products of one science exposure and spectrograph side as the
+    extensions of one FITS file.  A product that would be written to
+    "<prefix><stem>" becomes the extension named "<prefix>" (upper case,
+    e.g. "E.CS" for "e.cS<stem>").
+    '''
+    def __init__(self, path, stem, header, compress=False):
+        '''
+        :param path:
+            Output directory
+        :param stem:
+            File name the products share after their prefix, e.g.
+            "20170101T012345.6_093_sci_R.fits"
+        :param header:
+            Header of the exposure, kept in the primary HDU
+        :param compress:
+            If True, the extensions are Rice tile compressed.  Floating
+            point images are quantized in the process, like fpack does.
+        '''
+        self.path = path
+        self.stem = stem
+        self.fn = op.join(path, PRODUCT_PREFIX + stem)
+        self.compress = compress
+        self.header = header.copy()
+        self.header.remove('BIASSEC', ignore_missing=True)
+        self.header.remove('TRIMSEC', ignore_missing=True)
+        self.hdus = []
+
+    def get_extname(self, outname):
+        '''
+        Extension name of the product that would be written to "outname".
+        '''
+        base = op.basename(outname)
+        if not base.endswith(self.stem) or base == self.stem:
+            print("%s is not a product of %s" % (base, self.stem))
+            raise KeyError(base)
+        return base[:-len(self.stem)].upper()
+
+    def add(self, hdu, extname):
+        '''
+        Add the image and header of "hdu" as extension "extname".  Only the
+        keywords that differ from the primary header are kept.
+        '''
+        header = fits.Header()
+        for card in hdu.header.cards:
+            if (card.keyword in STRUCTURAL 
+                    or card.keyword.startswith('NAXIS')):
+                continue
+            if (card.keyword in COMMENTARY or card.keyword not in self.header
+                    or self.header[card.keyword] != card.value):
+                header.append(card)
+        header['INHERIT'] = True
+        new = fits.ImageHDU(hdu.data, header=header, name=extname)
+        if self.compress:
+            # The tile compression needs a C ordered array (the cubes are not)
+            new = fits.CompImageHDU(np.ascontiguousarray(new.data), 
+                                    header=new.header, 
+                                    compression_type='RICE_1')
+        self.hdus = [h for h in self.hdus if h.name != new.name] + [new]
+
+    def read(self, extname, stem=None):
+        '''
+        Data and header of extension "extname", with the primary header
+        keywords it inherits.  With "stem", the extension is read from the
+        product file of another exposure or side in the same directory.
+        Raises IOError if that file does not exist and KeyError if the
+        extension does not.
+        '''
+        if stem is None or stem == self.stem:
+            for hdu in self.hdus:
+                if hdu.name == extname.upper():
+                    header = self.header.copy()
+                    header.update(hdu.header)
+                    return hdu.data, header
+            raise KeyError(extname)
+        fn = op.join(self.path, PRODUCT_PREFIX + stem)
+        wait_for_product(fn)
+        with fits.open(fn) as F:
+            header = F[0].header.copy()
+            header.update(F[extname].header)
+            return np.array(F[extname].data), header
+
+    def write(self):
+        '''
+        Write the product file.
+        '''
+        print("Making product file %s" % op.basename(self.fn))
+        write_product(fits.HDUList([fits.PrimaryHDU(header=self.header)]
+                                   + self.hdus), self.fn)
+
+
+class ProductWriter:
+    '''
+    Background writer of FITS products.  Jobs of an HDU (or HDUList) and a 
+    file name are put on a bounded queue and written by a pool of threads.
+    The HDUs must not be changed after they are submitted.
+    '''
+    def __init__(self, nthreads=1, maxsize=8):
+        '''
+        :param nthreads:
+            Number of writing threads
+        :param maxsize:
+            Number of jobs that may wait in the queue before submit() blocks
+        '''
+        self.queue = Queue.Queue(maxsize)
+        self.pending = {}
+        self.failed = []
+        self.cond = threading.Condition()
+        self.threads = []
+        for i in xrange(nthreads):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            hdu, outname = job
+            try:
+                writeto_atomic(hdu, outname)
+            except Exception:
+                with self.cond:
+                    self.failed.append((outname, traceback.format_exc()))
+            finally:
+                with self.cond:
+                    self.pending[outname] -= 1
+                    if not self.pending[outname]:
+                        del self.pending[outname]
+                    self.cond.notify_all()
+
+    def submit(self, hdu, outname):
+        '''
+        Queue "hdu" to be written to "outname".  Blocks while the queue is
+        full.
+        '''
+        outname = op.abspath(outname)
+        with self.cond:
+            self.pending[outname] = self.pending.get(outname, 0) + 1
+        self.queue.put((hdu, outname))
+
+    def wait(self, outname=None):
+        '''
+        Wait until the queued writes of "outname", or of all files if None,
+        are done.
+        '''
+        if outname is not None:
+            outname = op.abspath(outname)
+        with self.cond:
+            while (self.pending if outname is None 
+                   else outname in self.pending):
+                # A timeout keeps the wait interruptible
+                self.cond.wait(1.)
+
+    def drain(self):
+        '''
+        Wait for all queued writes.  If any failed, the errors are printed 
+        and the program exits.
+        '''
+        self.wait()
+        with self.cond:
+            failed, self.failed = self.failed, []
+        if failed:
+            for outname, error in failed:
+                print("Could not write %s" % outname)
+                print(error)
+            sys.exit(1)
+
+    def close(self):
+        '''
+        Drain the queue and stop the threads.
+        '''
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.drain()
+
+
+# Writer used by write_product, set by start_product_writer
+_writer = {}
+
+
+def start_product_writer(nthreads=1, maxsize=8):
+    '''
+    Write the products of this process in "nthreads" background threads
+    from now on.  With nthreads < 1 they are written in the calling thread.
+    A writer inherited from the parent of a forked process is dropped, as
+    its threads do not exist in the child.
+    '''
+    _writer.pop('writer', None)
+    if nthreads >= 1:
+        _writer['writer'] = ProductWriter(nthreads, maxsize)
+
+
+def drain_product_writer(close=True):
+    '''
+    Wait until the products queued in this process are written; with 
+    "close", also stop the background writer.
+    '''
+    writer = _writer.get('writer')
+    if writer is None:
+        return
+    if close:
+        del _writer['writer']
+        writer.close()
+    else:
+        writer.drain()
+
+
+def wait_for_product(fn):
+    '''
+    Wait until a queued write of "fn" is done.
+    '''
+    writer = _writer.get('writer')
+    if writer is not None:
+        writer.wait(fn)
+
+
+def product_exists(fn):
+    '''
+    True if the product "fn" exists, after its queued write is done.
+    '''
+    wait_for_product(fn)
+    return op.exists(fn)
+
+
+def writeto_atomic(hdu, outname):
+    '''
+    Write "hdu" to a temporary file and rename it to "outname".  The 
+    temporary name is unique to the process and thread.
+    '''
+    tmp = '%s.%i.%i.tmp' % (outname, os.getpid(), 
+                            threading.current_thread().ident)
+    try:
+        hdu.writeto(tmp, overwrite=True)
+        os.rename(tmp, outname)
+    finally:
+        if op.exists(tmp):
+            os.remove(tmp)
+
+
+def write_product(hdu, outname, products=None, extname=None):
+    '''
+    Write "hdu" to "outname", or add it to "products" as the extension for
+    "outname" (or "extname" if given).  With a background writer (see 
+    start_product_writer) the write is queued.
+    '''
+    if products is None:
+        writer = _writer.get('writer')
+        if writer is None:
+            writeto_atomic(hdu, outname)
+        else:
+            writer.submit(hdu, outname)
+    else:
+        if extname is None:
+            extname = products.get_extname(outname)
+        products.add(hdu, extname)
+
+
+def read_product(filename, products=None):
+    '''
+    Data and header of the product written to "filename" by write_product.
+    Raises IOError or KeyError if it has not been written.
+    '''
+    if products is None:
+        wait_for_product(filename)
+        with fits.open(filename) as F:
+            return np.array(F[0].data), F[0].header.copy()
+    return products.read(products.get_extname(filename))
@@ -21,7 +21,7 @@ from astropy.io import fits
 
 from args import parse_args
 from amplifier import Amplifier
-from utils import biweight_location
+from utils import biweight_location, make_cube
 import config
 import glob
 
@@ -79,18 +79,7 @@ def make_cube_file(args, filename, ifucen, scale, side):
             return None
         data = F[0].data
         a,b = data.shape
-        x = np.arange(ifucen[:,1].min()-scale, ifucen[:,1].max()+scale, scale)
-        y = np.arange(ifucen[:,2].min()-scale, ifucen[:,2].max()+scale, scale)
-        xgrid, ygrid = np.meshgrid(x, y)
-        zgrid = np.zeros((b,)+xgrid.shape)
-        for k in xrange(b):
-            for i in xrange(len(x)):
-                for j in xrange(len(y)):
-                    d = np.sqrt((ifucen[:,1] - xgrid[j,i])**2 + 
-                                (ifucen[:,2] - ygrid[j,i])**2)
-                    w = np.exp(-1./2.*(d/1.)**2)
-                    sel = w > 1e-3
-                    zgrid[k,j,i] = np.sum(data[sel,k]*w[sel])/np.sum(w[sel])
+        zgrid = make_cube(data, ifucen, scale, 1., thresh=1e-3)
         hdu = fits.PrimaryHDU(np.array(zgrid, dtype='float32'))
         
         zcol = biweight_location(zgrid[int(b/3):int(2*b/3),:,:],axis=(0,))
@@ -127,18 +116,7 @@ def make_cube_file(args, filename, ifucen, scale, side):
         if len(data[:,0]) != len(ifucen[:,1]):
             print("Length of IFUcen file not the same as Fe. Skipping Cube")
             return None
-        x = np.arange(ifucen[:,1].min()-scale, ifucen[:,1].max()+scale, scale)
-        y = np.arange(ifucen[:,2].min()-scale, ifucen[:,2].max()+scale, scale)
-        xgrid, ygrid = np.meshgrid(x, y)
-        zgrid = np.zeros((b,)+xgrid.shape)
-        for k in xrange(b):
-            for i in xrange(len(x)):
-                for j in xrange(len(y)):
-                    d = np.sqrt((ifucen[:,1] - xgrid[j,i])**2 + 
-                                (ifucen[:,2] - ygrid[j,i])**2)
-                    w = np.exp(-1./2.*(d/(2./2.35*2.))**2)
-                    sel = w > 1e-4
-                    zgrid[k,j,i] = np.sum(data[sel,k]*w[sel])/np.sum(w[sel])
+        zgrid = make_cube(data, ifucen, scale, 2./2.35*2., thresh=1e-4)
         hdu = fits.PrimaryHDU(np.array(zgrid, dtype='float32'))
         zcol = biweight_location(zgrid[:,:,:],axis=(0,))
         hdu.header['CDELT3'] = F1[0].header['CDELT1']
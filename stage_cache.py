@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stage Cache
+-----------
+Content-addressed cache of the reduction stages of an amplifier, to be
+used in conjuction with IFU reduction code, Panacea
+
+The key of a stage is a hash of the key of the stage before it, the name of
+the stage and its inputs: parameters and the contents of the files it
+reads.  The first key is the hash of the raw frame and of the source of
+the code that reduces it (see amplifier.STAGE_SOURCES).  A stage whose key is
+in the cache loads its outputs instead of running, and a changed input
+only changes the keys of its stage and the stages after it.
+
+The stages are saved compressed.  The cache is bounded by a size in bytes:
+after a save, the least recently used stages are removed until it fits.
+The cache directory can also be deleted at any time; it is only a cache.
+
+"""
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import numpy as np
+import os.path as op
+import os
+import hashlib
+
+__all__ = ["STAGE_CACHE_VERSION", "STAGE_CACHE_SIZE", "get_file_digest", 
+           "get_value_digest", "get_stage_cache_stats", 
+           "add_stage_cache_stats", "StageCache"]
+
+# Bump when a stage changes what it computes; all keys change with it
+STAGE_CACHE_VERSION = 3
+
+# Default size limit of the cache in bytes
+STAGE_CACHE_SIZE = 20 * 1024**3
+
+# Stages loaded (hits) and not found (misses) by the stage caches of this
+# process
+_stats = {'hits': 0, 'misses': 0}
+
+# Digests of files already hashed in this process, keyed on the path,
+# modification time and size
+_file_digests = {}
+
+
+def get_file_digest(fn):
+    '''
+    MD5 of the contents of "fn", or of "missing" if it does not exist.
+    '''
+    if not op.exists(fn):
+        return hashlib.md5(b'missing').hexdigest()
+    key = (op.abspath(fn), op.getmtime(fn), op.getsize(fn))
+    if key not in _file_digests:
+        md5 = hashlib.md5()
+        with open(fn, 'rb') as f:
+            for block in iter(lambda: f.read(1024**2), b''):
+                md5.update(block)
+        _file_digests[key] = md5.hexdigest()
+    return _file_digests[key]
+
+
+def get_value_digest(value):
+    '''
+    MD5 of a parameter value: the bytes of an array or the repr of anything
+    else.
+    '''
+    if isinstance(value, np.ndarray):
+        md5 = hashlib.md5(repr((value.dtype.str, value.shape)).encode('utf-8'))
+        md5.update(np.ascontiguousarray(value).tostring())
+        return md5.hexdigest()
+    return hashlib.md5(repr(value).encode('utf-8')).hexdigest()
+
+
+def get_stage_cache_stats(reset=False):
+    '''
+    Dictionary of the hits and misses of the stage caches of this process;
+    with "reset", the counts start again from zero.
+    '''
+    stats = dict(_stats)
+    if reset:
+        for name in _stats:
+            _stats[name] = 0
+    return stats
+
+
+def add_stage_cache_stats(stats):
+    '''
+    Add the counts of get_stage_cache_stats from another process.
+    '''
+    for name in _stats:
+        _stats[name] += stats.get(name, 0)
+
+
+class StageCache:
+    '''
+    Stage outputs stored as one .npz file per key in a directory.
+    '''
+    def __init__(self, path, max_bytes=STAGE_CACHE_SIZE):
+        '''
+        :param path:
+            Directory of the cache, created when the first stage is saved
+        :param max_bytes:
+            Size limit of the files in the cache directory, None for none
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def get_key(self, parent, stage, inputs):
+        '''
+        Key of "stage" after the stage with key "parent".
+
+        :param parent:
+            Key of the stage before, or of the raw frame
+        :param stage:
+            Name of the stage
+        :param inputs:
+            List of (name, value) pairs of the inputs of the stage; values
+            are hashed with get_value_digest
+        '''
+        md5 = hashlib.md5(repr((STAGE_CACHE_VERSION, parent,
+                                stage)).encode('utf-8'))
+        for name, value in inputs:
+            md5.update(('%s=%s;' % (name, get_value_digest(value)))
+                       .encode('utf-8'))
+        return md5.hexdigest()
+
+    def get_filename(self, key):
+        return op.join(self.path, 'stage_%s.npz' % key)
+
+    def load(self, key):
+        '''
+        Dictionary of the arrays saved for "key", or None if there are none.
+        '''
+        fn = self.get_filename(key)
+        try:
+            with np.load(fn) as F:
+                values = dict([(name, F[name]) for name in F.files])
+            # The modification time marks the last use for prune()
+            os.utime(fn, None)
+        except (IOError, OSError):
+            # Not saved, or removed by prune() in another process
+            _stats['misses'] += 1
+            return None
+        _stats['hits'] += 1
+        return values
+
+    def save(self, key, values):
+        '''
+        Save the dictionary of arrays "values" for "key".
+        '''
+        if not op.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Made by another process in the meantime
+                pass
+        fn = self.get_filename(key)
+        # Write to a temporary file first so readers never see a partial file
+        tmp = fn[:-4] + '.%i.tmp.npz' % os.getpid()
+        np.savez_compressed(tmp, **values)
+        os.rename(tmp, fn)
+        if self.max_bytes is not None:
+            self.prune(self.max_bytes)
+
+    def prune(self, max_bytes):
+        '''
+        Remove the least recently used stages until the saved stages take
+        at most "max_bytes".
+        '''
+        files = []
+        for name in os.listdir(self.path):
+            # Temporary files of saves in progress are left alone
+            if (not (name.startswith('stage_') and name.endswith('.npz'))
+                    or '.tmp' in name):
+                continue
+            fn = op.join(self.path, name)
+            try:
+                files.append((op.getmtime(fn), op.getsize(fn), fn))
+            except OSError:
+                continue
+        nbytes = sum([f[1] for f in files])
+        for mtime, size, fn in sorted(files):
+            if nbytes <= max_bytes:
+                break
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            nbytes -= size
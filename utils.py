@@ -12,6 +12,9 @@ Copyright (c) 2012, Free Software Foundation
 
 import numpy as np
 import sys
+import hashlib
+from collections import OrderedDict
+from scipy.sparse import csr_matrix
 
 def median_absolute_deviation(a, axis=None):
     """
@@ -63,10 +66,16 @@ def median_absolute_deviation(a, axis=None):
     # See https://github.com/numpy/numpy/issues/7330 why using np.ma.median
     # for normal arrays should not be done (summary: np.ma.median always
     # returns an masked array even if the result should be scalar). (#4658)
+    # np.nanmedian along a short axis goes through masked arrays, so it is 
+    # only used when there are NaNs; otherwise np.median gives the same value.
     if isinstance(a, np.ma.MaskedArray):
         func = np.ma.median
     else:
-        func = np.nanmedian
+        a = np.asanyarray(a)
+        if np.isnan(a).any():
+            func = np.nanmedian
+        else:
+            func = np.median
 
     a = np.asanyarray(a)
 
@@ -134,10 +143,47 @@ def biweight_filter2d(a, Order, Ignore_central=(3,3), c=6.0, M=None, func=None):
     return func(C, axis=(2,))
 
 
-def biweight_filter(a, order, ignore_central=3, c=6.0, M=None, func=None):
+def get_biweight_filter_indices(order, ignore_central):
     '''
-    Compute the biweight location with a moving window of size "order"
-
+    Indices used by biweight_filter for the interior and edge windows.
+
+    :param order:
+        Odd window size of the filter
+    :param ignore_central:
+        Odd number of central pixels left out of each window
+    :returns order_array:
+        Positions within a full window of size "order" that are kept
+    :returns edges:
+        For each edge pixel i (0 to order/2-1), the kept positions within
+        a[:(order/2+i+1)] for the low edge and a[-(order/2+i+1):] for the 
+        high edge.  The two are mirror images and have equal length.
+    '''
+    half_order = order / 2
+    ignore = [half_order]
+    for i in xrange(ignore_central/2):
+        ignore.append(half_order - i - 1)
+        ignore.append(half_order + i + 1)
+    order_array = np.delete(np.arange(order), ignore)
+    edges = []
+    for i in xrange(half_order):
+        ignore_l = [i]
+        ignore_h = [half_order]
+        for j in xrange(ignore_central/2):
+            if (i - j - 1) >=0:
+                ignore_l.append(i - j - 1)
+            ignore_l.append(i + j + 1)
+            if i > j:
+                ignore_h.append(half_order+j+1)
+            ignore_h.append(half_order-j-1)
+        edges.append((np.delete(np.arange(half_order+i+1), ignore_l),
+                      np.delete(np.arange(half_order+i+1), ignore_h)))
+    return order_array, edges
+    
+    
+def check_biweight_filter_args(order, ignore_central):
+    '''
+    Check the window arguments of biweight_filter and biweight_filter_rows
+    and return them as odd integers.
     '''
     if not isinstance(order, int):
         print("The order should be an integer")
@@ -152,43 +198,129 @@ def biweight_filter(a, order, ignore_central=3, c=6.0, M=None, func=None):
     if order-3 <= ignore_central:
         print("The order-3 should be larger than ignore_central.")
         sys.exit(1)
+    return order, ignore_central
+
+
+def biweight_filter_interior(A, order, order_array, func, chunk):
+    '''
+    Evaluate "func" over the full-size windows along the rows of the 2-d 
+    array A.  The windows are read from a strided view of A, and about 
+    "chunk" windows (whole rows where possible) are copied at a time.  
+    Returns an array of shape (len(A), A.shape[1]-order+1).
+    '''
+    nrows, N = A.shape
+    nwin = N - order + 1
+    windows = np.lib.stride_tricks.as_strided(A, shape=(nrows, nwin, order),
+                                              strides=(A.strides[0],
+                                                       A.strides[1],
+                                                       A.strides[1]))
+    result = np.zeros((nrows, nwin), dtype=A.dtype)
+    row_chunk = max(1, chunk / nwin)
+    for j in xrange(0, nrows, row_chunk):
+        rows = slice(j, j+row_chunk)
+        for i in xrange(0, nwin, chunk):
+            # The copy must be C-ordered so each window is summed in the 
+            # same order as in a row-by-row evaluation
+            W = np.ascontiguousarray(windows[rows, i:i+chunk][:, :, 
+                                                              order_array])
+            n = W.shape[1]
+            W = W.reshape((-1, len(order_array)))
+            result[rows, i:i+n] = func(W, axis=(1,)).reshape((-1, n))
+    return result
+
+
+def biweight_filter(a, order, ignore_central=3, c=6.0, M=None, func=None,
+                    dtype=None, chunk=32768):
+    '''
+    Compute the biweight location with a moving window of size "order"
+
+    The interior windows are read from a strided view of the input, so no
+    (len(a), order) copy of the array is made.  The statistic is evaluated 
+    over blocks of "chunk" windows at a time.
+    
+    :param dtype:
+        If given (e.g., np.float32), the input is cast to this type and the
+        statistic is evaluated in it.  The default evaluates the interior 
+        in float64 as before.
+    :param chunk:
+        Number of windows evaluated at once, which bounds the memory used.
+    '''
+    order, ignore_central = check_biweight_filter_args(order, ignore_central)
     if func is None:
         func = biweight_location
     a = np.array(a, copy=False)
     if a.ndim != 1:
         print("Input array/list should be 1-dimensional")
         sys.exit()
-    ignore = [order/2]
-    for i in xrange(ignore_central/2):
-        ignore.append(order/2 - i - 1)
-        ignore.append(order/2 + i + 1)
-    half_order = order / 2    
-    order_array = np.delete(np.arange(order), ignore)
-    A = np.zeros((len(a)-order+1, len(order_array)))
-    k=0
-    for i in order_array:
-        if (order-i-1) == 0:
-            A[:,k] = a[i:]
-        else:
-            A[:,k] = a[i:-(order-i-1)]
-        k+=1
+    if dtype is None:
+        A = np.asarray(a, dtype=float)
+    else:
+        a = np.asarray(a, dtype=dtype)
+        A = a
+    half_order = order / 2
+    order_array, edges = get_biweight_filter_indices(order, ignore_central)
+    result = np.zeros((len(a),), dtype=A.dtype)
+    result[half_order:len(a)-half_order] = biweight_filter_interior(
+                                      A[np.newaxis,:], order, order_array, 
+                                      func, chunk)[0]
+    for i in xrange(half_order):
+        ind_l, ind_h = edges[i]
+        result[i] = func(a[:(half_order+i+1)][ind_l])
+        result[-(i+1)] = func(a[-(half_order+i+1):][ind_h])
+    return result
+    
+
+def biweight_filter_rows(a, order, ignore_central=3, c=6.0, M=None, 
+                         func=None, dtype=None, chunk=32768):
+    '''
+    Apply biweight_filter to each row of a 2-d array
     
-    Ab = func(A, axis=(1,))
-    A1 = np.zeros((half_order,))
-    A2 = np.zeros((half_order,))
+    All rows are filtered together: the windows of a block of rows are 
+    stacked and "func" is called once per block rather than once per row.
+    The edge windows are likewise evaluated for all rows at once, which 
+    for biweight_midvariance can differ from biweight_filter in the last 
+    bit (the n**0.5 factor is computed on an array instead of a scalar).
+    
+    :param a:
+        2-d array, filtered along the second axis
+    :param order:
+        Size of the moving window
+    :param func:
+        Statistic evaluated over each window, default biweight_location
+    :param dtype:
+        If given (e.g., np.float32), the input is cast to this type and the
+        statistic is evaluated in it.
+    :param chunk:
+        Approximate number of windows evaluated at once.  Whole rows are
+        taken together up to this limit, which bounds the memory used.
+    '''
+    order, ignore_central = check_biweight_filter_args(order, ignore_central)
+    if func is None:
+        func = biweight_location
+    a = np.array(a, copy=False)
+    if a.ndim != 2:
+        print("Input array/list should be 2-dimensional")
+        sys.exit()
+    if dtype is None:
+        A = np.asarray(a, dtype=float)
+    else:
+        a = np.asarray(a, dtype=dtype)
+        A = a
+    nrows, N = a.shape
+    half_order = order / 2
+    order_array, edges = get_biweight_filter_indices(order, ignore_central)
+    result = np.zeros((nrows, N), dtype=A.dtype)
+    result[:, half_order:N-half_order] = biweight_filter_interior(A, order, 
+                                                               order_array,
+                                                               func, chunk)
+    # The low and high edge windows of the same size are done together
     for i in xrange(half_order):
-        ignore_l = [i]
-        ignore_h = [half_order]
-        for j in xrange(ignore_central/2):
-            if (i - j - 1) >=0:
-                ignore_l.append(i - j - 1)
-            ignore_l.append(i + j + 1)
-            if i > j:
-                ignore_h.append(half_order+j+1)
-            ignore_h.append(half_order-j-1)
-        A1[i] = func(np.delete(a[:(half_order+i+1)], ignore_l))
-        A2[-(i+1)] = func(np.delete(a[-(half_order+i+1):], ignore_h))
-    return np.hstack([A1,Ab,A2])
+        ind_l, ind_h = edges[i]
+        E = np.ascontiguousarray(np.vstack([a[:, :(half_order+i+1)][:, ind_l],
+                                        a[:, -(half_order+i+1):][:, ind_h]]))
+        Eb = func(E, axis=(1,))
+        result[:, i], result[:, -(i+1)] = Eb[:nrows], Eb[nrows:]
+    return result
     
     
 
@@ -404,6 +536,189 @@ def biweight_midvariance(a, c=9.0, M=None, axis=None):
         / np.abs(((1 - u * mask) * (1 - 5 * u * mask)).sum(axis=axis))
 
 
+def biweight_bin(x, y, binsize, c=6.0, max_ratio=4.):
+    '''
+    Biweight location of "y" in uniform bins of "x", e.g., the spectra of
+    all fibers in bins of wavelength.  This replaces sorting all samples by
+    "x" and running biweight_filter over them: the samples are grouped by
+    bin with a stable sort of their bin numbers and the bins are evaluated
+    at once as the rows of a masked array.  Only the binned curve is
+    returned, so the result is also much smaller than the input.
+
+    :param x:
+        Array of the coordinate to bin in; it does not need to be sorted
+    :param y:
+        Array of values, same shape as "x"
+    :param binsize:
+        Average number of samples per bin, comparable to the "order" of
+        biweight_filter
+    :param c:
+        Tuning constant for the biweight estimator
+    :param max_ratio:
+        Bins with more than "max_ratio" times the mean number of samples
+        are evaluated one at a time, so one crowded bin does not make the
+        masked array as wide as itself
+    :returns xb:
+        Mean of "x" in each non-empty bin (increasing)
+    :returns yb:
+        Biweight location of "y" in each non-empty bin, NaN where it is
+        undefined
+    '''
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+    nbins = max(int(len(x) / binsize), 1)
+    lo = x.min()
+    width = (x.max() - lo) / nbins
+    if width > 0.:
+        idx = np.minimum(((x - lo) / width).astype(int), nbins - 1)
+    else:
+        idx = np.zeros(x.shape, dtype=int)
+    counts = np.bincount(idx, minlength=nbins)
+    starts = np.cumsum(counts) - counts
+    keep = counts > 0
+    xb = np.bincount(idx, weights=x, minlength=nbins)[keep] / counts[keep]
+    order = np.argsort(idx, kind='mergesort')
+    ncol = min(counts.max(), max(int(max_ratio * counts[keep].mean()), 1))
+    row = idx[order]
+    col = np.arange(len(x)) - starts[row]
+    sel = counts[row] <= ncol
+    Y = np.ma.array(np.zeros((nbins, ncol)), mask=True)
+    Y[row[sel], col[sel]] = y[order[sel]]
+    dense = keep & (counts <= ncol)
+    yb = np.nan * np.ones((nbins,))
+    yb[dense] = np.ma.filled(biweight_location(Y[dense], c=c, axis=(1,)),
+                             np.nan)
+    for i in np.where(counts > ncol)[0]:
+        yb[i] = biweight_location(y[order[starts[i]:starts[i]+counts[i]]],
+                                  c=c)
+    yb = yb[keep]
+    # A bin whose biweight is undefined (NaN values in "y") stays NaN, like
+    # the windows of biweight_filter, and is not dropped: a curve
+    # interpolated from the result is NaN next to it rather than bridged
+    # over it.
+    yb[~np.isfinite(yb)] = np.nan
+    return xb, yb
+
+
+# Spatial weights for make_cube, keyed by the fiber positions and the
+# scale, sigma and threshold of the grid
+_cube_weights = {}
+
+
+def get_cube_weights(ifucen, scale, sigma, thresh=1e-3):
+    '''
+    Gaussian weights of each fiber for each spaxel of a cube grid
+    
+    The grid spans the fiber positions plus "scale" on each side with a 
+    pixel size of "scale".  A fiber contributes to a spaxel with the weight
+    exp(-d**2/(2*sigma**2)) if that weight is larger than "thresh".  The 
+    weights depend only on the fiber positions and not on wavelength, so 
+    they are computed once and cached.
+    
+    :param ifucen:
+        Fiber positions with x in column 1 and y in column 2
+    :param scale:
+        Pixel size of the cube
+    :param sigma:
+        Gaussian sigma of the weights
+    :param thresh:
+        Weights at or below this value are dropped
+    :returns W:
+        scipy.sparse.csr_matrix of shape (number of spaxels, number of 
+        fibers), with spaxels ordered as the flattened (y, x) grid
+    :returns norm:
+        Sum of the weights for each spaxel
+    :returns x, y:
+        Grid coordinates
+    '''
+    pos = np.ascontiguousarray(ifucen[:,1:3], dtype=float)
+    key = (hashlib.md5(pos.tobytes()).hexdigest(), pos.shape, scale, sigma, 
+           thresh)
+    if key in _cube_weights:
+        return _cube_weights[key]
+    x = np.arange(pos[:,0].min()-scale, pos[:,0].max()+scale, scale)
+    y = np.arange(pos[:,1].min()-scale, pos[:,1].max()+scale, scale)
+    xgrid, ygrid = np.meshgrid(x, y)
+    d = np.sqrt((pos[np.newaxis,:,0] - xgrid.ravel()[:,np.newaxis])**2 + 
+                (pos[np.newaxis,:,1] - ygrid.ravel()[:,np.newaxis])**2)
+    w = np.exp(-1./2.*(d/sigma)**2)
+    w[w <= thresh] = 0.
+    W = csr_matrix(w)
+    norm = np.asarray(W.sum(axis=1)).ravel()
+    _cube_weights[key] = (W, norm, x, y)
+    return W, norm, x, y
+    
+    
+def make_cube(data, ifucen, scale, sigma, thresh=1e-3):
+    '''
+    Build a data cube from fiber spectra
+    
+    Each spaxel is the weighted mean of the fibers near it, using the 
+    weights from get_cube_weights, for all wavelengths at once.  Spaxels
+    without any fiber above the threshold are NaN.
+    
+    :param data:
+        Fiber spectra with shape (number of fibers, number of wavelengths)
+    :param ifucen, scale, sigma, thresh:
+        See get_cube_weights
+    :returns zgrid:
+        Cube with shape (number of wavelengths, len(y), len(x))
+    '''
+    W, norm, x, y = get_cube_weights(ifucen, scale, sigma, thresh=thresh)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zgrid = W.dot(data) / norm[:,np.newaxis]
+    return zgrid.T.reshape((data.shape[1], len(y), len(x)))
+
+
+class LRUCache:
+    '''
+    Least recently used cache with a memory budget
+
+    Entries are dropped, oldest use first, once the total size of the
+    entries exceeds "max_bytes".  The number of hits and misses is counted.
+    '''
+    def __init__(self, max_bytes=512*1024**2):
+        '''
+        :param max_bytes:
+            Memory budget in bytes for the entries of the cache
+        '''
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        
+    def get(self, key):
+        '''
+        Return the value for "key" or None if it is not in the cache.
+        '''
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value, nbytes = self.entries.pop(key)
+        self.entries[key] = (value, nbytes)
+        return value
+        
+    def put(self, key, value, nbytes):
+        '''
+        Add "value" with a size of "nbytes" to the cache.  A value larger 
+        than the budget is not cached.
+        '''
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
+            
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+        
+
 def is_outlier(points, thresh=3.5):
     """
     Copyright (c) 2012, Free Software Foundation   